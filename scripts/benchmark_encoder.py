@@ -0,0 +1,81 @@
+#
+# Author: sascha_lammers@gmx.de
+#
+
+import argparse
+import re
+import sys
+import time
+import random
+from generator import DatabaseHelpers
+
+# microbenchmark of the string literal encoder
+#
+# compares the previous implementation, which appended each character to the output, with
+# DatabaseHelpers.encode_literal() and encode_literals(). the results of all implementations
+# must be identical
+
+# previous implementation
+def legacy_encode_binary(s: str):
+    bytes = s.encode('ascii', errors='backslashreplace')
+    out = ''
+    for byte in bytes:
+        if byte&0x80:
+            out += '\\x%02x' % byte
+        else:
+            out += chr(byte)
+    return out
+
+def legacy_split_hex(value):
+    def repl(m):
+        return '%s\" \"%s' % (m.group(1), m.group(2))
+    return re.sub('(\\\\x[0-9a-fA-F]{2})([0-9a-fA-F])', repl, value)
+
+def legacy_encode_literal(value):
+    return legacy_split_hex(legacy_encode_binary(value))
+
+# random strings with ascii, hex digits, non-ascii characters, NUL and lone surrogates
+def create_strings(count, seed):
+    rnd = random.Random(seed)
+    chars = [chr(n) for n in range(0x20, 0x7f)] + list('0123456789abcdefABCDEF' * 4) + ['°', 'ä', '€', '\U0001f600', '\0', '\ud800', '\\', '"']
+    return [''.join(rnd.choice(chars) for n in range(rnd.randint(1, 64))) for n in range(count)]
+
+# returns the best time of all rounds in seconds and the results
+def measure(func, values, rounds, reset=None):
+    best = None
+    for n in range(rounds):
+        if reset:
+            reset()
+        start = time.perf_counter()
+        result = func(values)
+        best = min(best or float('inf'), time.perf_counter() - start)
+    return best, result
+
+def reset_literals():
+    DatabaseHelpers._literals = {}
+
+parser = argparse.ArgumentParser(description='benchmark the string literal encoder')
+parser.add_argument('-n', '--count', help='number of strings', type=int, default=10000)
+parser.add_argument('-r', '--rounds', help='number of rounds, the best time is displayed', type=int, default=3)
+parser.add_argument('-s', '--seed', help='seed for the random strings', type=int, default=0)
+args = parser.parse_args()
+
+values = create_strings(args.count, args.seed)
+
+results = [
+    ('legacy', measure(lambda values: [legacy_encode_literal(value) for value in values], values, args.rounds)),
+    ('per value', measure(lambda values: [DatabaseHelpers.encode_literal(value) for value in values], values, args.rounds, reset_literals)),
+    ('batch', measure(DatabaseHelpers.encode_literals, values, args.rounds, reset_literals)),
+    ('memoized', measure(lambda values: [DatabaseHelpers.encode_literal(value) for value in values], values, args.rounds))
+]
+
+expected = results[0][1][1]
+failed = False
+print('%-10s %10s' % ('encoder', 'ms'))
+for name, (best, result) in results:
+    print('%-10s %10.2f' % (name, best * 1000))
+    if result!=expected:
+        print('%s: results differ from the legacy encoder' % name, file=sys.stderr)
+        failed = True
+
+sys.exit(failed and 1 or 0)
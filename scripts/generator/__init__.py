@@ -3,13 +3,25 @@
 # Author: sascha_lammers@gmx.de
 #
 
-from .types import ExportType, SubstListType, SplitSepType, ItemType, DefinitionType, DebugType, CompressionType
+from .types import ExportType, SubstListType, SplitSepType, ItemType, DefinitionType, DebugType, CompressionType, DatabaseEngineType
 from .cache import SpgmCache
 from .config import SpgmConfig
 from .file_wrapper import FileWrapper
-from .database2 import v2, Database, DatabaseHelpers
+from .fingerprint import Fingerprint
+from .fragment_cache import FragmentCache
+from .file_table import FileTable
+from .binary_database import BinaryDatabase, BinaryDatabaseReader
+from .storage import DatabaseStorage, PickleStorage, BinaryStorage, SqliteStorage, ShardedStorage, JournalStorage
+from .export import DebugExport
+from .database2 import v2, Database, DatabaseHelpers, FileLock
 from .generator import Generator
 from .location import Location, SourceLocation
 from .i18n import i18n_config, i18n_lang, i18n
 from .item import Item
 from .spgm_preprocessor import SpgmPreprocessor
+from .token_cache import TokenCache
+from .macro_cache import MacroCache
+from .header_index import HeaderIndex
+from .lexical import LexicalExtractor, LexicalFallback
+from .worker_pool import PreprocessorWorker, PreprocessorPool
+from .daemon import PreprocessorDaemon, PreprocessorDaemonServer
@@ -0,0 +1,342 @@
+#
+# Author: sascha_lammers@gmx.de
+#
+
+import os
+import json
+import mmap
+import struct
+import fnmatch
+import threading
+from typing import Dict, List
+
+# binary database format
+#
+# the file is opened with mmap and items are only created when they are accessed. the file
+# contains the same data as the dictionary returned by DatabaseStorage.read() and can be converted
+# in both directions without changes
+#
+# layout, all integers are little endian
+#
+#   header
+#   string offsets      uint32[strings + 1], string i is data[offsets[i]:offsets[i + 1]] encoded as utf-8
+#   string data
+#   items               ITEM[items], the items of the targets followed by the defined items
+#   targets             TARGET[targets] in the order of the 'targets' dictionary, followed by targets
+#                       that only have items
+#   target files        uint32[] string ids of the files of the targets
+#   items order         uint32[] targets in the order of the 'items' dictionary
+#   target index        uint32[targets] targets sorted by name
+#   names               NAME[names] sorted by name
+#   name items          uint32[] items of each name in the order of the database
+#
+# missing strings are stored as NONE, line and column as -1
+class BinaryDatabase(object):
+
+    MAGIC = b'SPGMDB\x00\x00'
+
+    # increase if the format changes
+    VERSION = 1
+
+    NONE = 0xffffffff
+
+    HEADER = struct.Struct('<8s17I')
+    # index, name, type, path, line, column, value, data
+    ITEM = struct.Struct('<IIIIiiII')
+    # target, hash, files start, files count, items start, items count, flags
+    TARGET = struct.Struct('<7I')
+    # name, defined item, start, count
+    NAME = struct.Struct('<4I')
+
+    TARGET_HAS_DATA = 0x01
+    TARGET_HAS_ITEMS = 0x02
+
+    def _encode(value):
+        return value.encode('utf-8', 'surrogatepass')
+
+    def _pack_array(values):
+        return struct.pack('<%uI' % len(values), *values)
+
+    # write database to filename and replace it atomically
+    # database: dictionary returned by DatabaseStorage.read()
+    def write(database: dict, filename):
+        strings = {}
+        string_data = []
+
+        def add_string(value):
+            if value==None:
+                return BinaryDatabase.NONE
+            id = strings.get(value, None)
+            if id==None:
+                id = len(string_data)
+                strings[value] = id
+                string_data.append(BinaryDatabase._encode(value))
+            return id
+
+        def add_item(index, item):
+            items.append(BinaryDatabase.ITEM.pack(
+                add_string(index),
+                add_string(item.name),
+                add_string(item.type.value),
+                add_string(item.file),
+                item.line==None and -1 or item.line,
+                item.column==None and -1 or item.column,
+                add_string(item.own_value),
+                add_string(item._data and json.dumps(item._data) or None)
+            ))
+            name_items.setdefault(item.name, []).append(len(items) - 1)
+
+        # targets in the order of both dictionaries
+        target_ids = list(database['targets'].keys())
+        for target_idx in database['items'].keys():
+            if not target_idx in database['targets']:
+                target_ids.append(target_idx)
+        target_numbers = dict((target_idx, n) for n, target_idx in enumerate(target_ids))
+
+        items = []
+        name_items = {}
+        target_items = {}
+        for target_idx, target_item_dict in database['items'].items():
+            target_items[target_idx] = (len(items), len(target_item_dict))
+            for index, item in target_item_dict.items():
+                add_item(index, item)
+
+        first_defined = len(items)
+        defined = {}
+        for name, item in database['defined'].items():
+            defined[name] = len(items)
+            add_item(None, item)
+        # defined items are not part of the items of the name
+        for name in defined.keys():
+            name_items[name] = [n for n in name_items[name] if n<first_defined]
+
+        targets = []
+        target_files = []
+        for target_idx in target_ids:
+            data = database['targets'].get(target_idx, None)
+            flags = 0
+            hash = None
+            files = []
+            if data!=None:
+                flags |= BinaryDatabase.TARGET_HAS_DATA
+                hash = data['hash']
+                files = data['files']
+            start, count = target_items.get(target_idx, (0, 0))
+            if target_idx in database['items']:
+                flags |= BinaryDatabase.TARGET_HAS_ITEMS
+            targets.append(BinaryDatabase.TARGET.pack(add_string(target_idx), add_string(hash), len(target_files), len(files), start, count, flags))
+            target_files.extend([add_string(file) for file in files])
+
+        items_order = [target_numbers[target_idx] for target_idx in database['items'].keys()]
+        target_index = sorted(range(len(target_ids)), key=lambda n: BinaryDatabase._encode(target_ids[n]))
+
+        names = []
+        name_item_list = []
+        for name in sorted(name_items.keys(), key=BinaryDatabase._encode):
+            names.append(BinaryDatabase.NAME.pack(add_string(name), defined.get(name, BinaryDatabase.NONE), len(name_item_list), len(name_items[name])))
+            name_item_list.extend(name_items[name])
+
+        string_offsets = [0]
+        for data in string_data:
+            string_offsets.append(string_offsets[-1] + len(data))
+
+        sections = [
+            BinaryDatabase._pack_array(string_offsets),
+            b''.join(string_data),
+            b''.join(items),
+            b''.join(targets),
+            BinaryDatabase._pack_array(target_files),
+            BinaryDatabase._pack_array(items_order),
+            BinaryDatabase._pack_array(target_index),
+            b''.join(names),
+            BinaryDatabase._pack_array(name_item_list)
+        ]
+        offsets = []
+        pos = BinaryDatabase.HEADER.size
+        for section in sections:
+            offsets.append(pos)
+            pos += len(section)
+
+        header = BinaryDatabase.HEADER.pack(
+            BinaryDatabase.MAGIC, BinaryDatabase.VERSION, pos,
+            len(string_data), offsets[0], offsets[1],
+            len(items), offsets[2], first_defined,
+            len(target_ids), offsets[3], offsets[4], offsets[5], len(items_order), offsets[6],
+            len(names), offsets[7], offsets[8]
+        )
+
+        tmp_file = '%s.%u.%u.tmp' % (filename, os.getpid(), threading.get_ident())
+        with open(tmp_file, 'wb') as file:
+            file.write(header)
+            for section in sections:
+                file.write(section)
+        os.replace(tmp_file, filename)
+
+# read access to a binary database
+#
+# opening the file only reads the header. strings and items are decoded when they are accessed
+class BinaryDatabaseReader(object):
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._strings = {} # type: Dict[int, str]
+        with open(filename, 'rb') as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if len(self._mmap)<BinaryDatabase.HEADER.size:
+                raise RuntimeError('invalid database %s' % filename)
+            (magic, version, size,
+             self._string_count, self._string_offsets, self._string_data,
+             self._item_count, self._items, self._first_defined,
+             self._target_count, self._targets, self._target_files, self._items_order, self._items_order_count, self._target_index,
+             self._name_count, self._names, self._name_items) = BinaryDatabase.HEADER.unpack_from(self._mmap, 0)
+            if magic!=BinaryDatabase.MAGIC:
+                raise RuntimeError('invalid database %s' % filename)
+            if version!=BinaryDatabase.VERSION:
+                raise RuntimeError('unsupported database version %u: %s' % (version, filename))
+            if size!=len(self._mmap):
+                raise RuntimeError('database truncated: %s' % filename)
+        except:
+            self._mmap.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        self._mmap.close()
+
+    def _get_uint(self, offset, n):
+        return struct.unpack_from('<I', self._mmap, offset + n * 4)[0]
+
+    def _get_array(self, offset, start, count):
+        return struct.unpack_from('<%uI' % count, self._mmap, offset + start * 4)
+
+    def _get_bytes(self, id):
+        start, end = struct.unpack_from('<II', self._mmap, self._string_offsets + id * 4)
+        return self._mmap[self._string_data + start:self._string_data + end]
+
+    def get_string(self, id):
+        if id==BinaryDatabase.NONE:
+            return None
+        value = self._strings.get(id, None)
+        if value==None:
+            value = self._get_bytes(id).decode('utf-8', 'surrogatepass')
+            self._strings[id] = value
+        return value
+
+    # returns (index, item)
+    def _get_item(self, n):
+        from .storage import DatabaseStorage
+        index, name, type, file, line, column, value, data = BinaryDatabase.ITEM.unpack_from(self._mmap, self._items + n * BinaryDatabase.ITEM.size)
+        data = self.get_string(data)
+        item = DatabaseStorage._create_item(None, self.get_string(name), self.get_string(type), self.get_string(file),
+            None if line==-1 else line, None if column==-1 else column, self.get_string(value), data and json.loads(data) or None)
+        return (self.get_string(index), item)
+
+    def _get_target(self, n):
+        return BinaryDatabase.TARGET.unpack_from(self._mmap, self._targets + n * BinaryDatabase.TARGET.size)
+
+    def _get_target_data(self, target):
+        return {
+            'files': [self.get_string(id) for id in self._get_array(self._target_files, target[2], target[3])],
+            'hash': self.get_string(target[1])
+        }
+
+    def _get_target_items(self, target):
+        return dict(self._get_item(n) for n in range(target[4], target[4] + target[5]))
+
+    def _get_name(self, n):
+        return BinaryDatabase.NAME.unpack_from(self._mmap, self._names + n * BinaryDatabase.NAME.size)
+
+    # binary search in a sorted index. get_key(n) returns the key of entry n
+    def _find(self, count, get_key, key):
+        key = BinaryDatabase._encode(key)
+        lo = 0
+        hi = count
+        while lo<hi:
+            mid = (lo + hi) // 2
+            mid_key = get_key(mid)
+            if mid_key==key:
+                return mid
+            if mid_key<key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def _find_target(self, target_idx):
+        n = self._find(self._target_count, lambda n: self._get_bytes(self._get_target(self._get_uint(self._target_index, n))[0]), target_idx)
+        if n==None:
+            return None
+        return self._get_target(self._get_uint(self._target_index, n))
+
+    def _find_name(self, name):
+        n = self._find(self._name_count, lambda n: self._get_bytes(self._get_name(n)[0]), name)
+        if n==None:
+            return None
+        return self._get_name(n)
+
+    @property
+    def item_count(self):
+        return self._first_defined
+
+    # names of all items sorted by their utf-8 encoding
+    def get_names(self):
+        for n in range(self._name_count):
+            yield self.get_string(self._get_name(n)[0])
+
+    # names matching the pattern. wildcards allowed
+    def find_names(self, pattern):
+        return [name for name in self.get_names() if fnmatch.fnmatch(name, pattern)]
+
+    # items of a name in the order of the database
+    def get_items(self, name) -> List:
+        entry = self._find_name(name)
+        if entry==None:
+            return []
+        return [self._get_item(n)[1] for n in self._get_array(self._name_items, entry[2], entry[3])]
+
+    def get_defined(self, name):
+        entry = self._find_name(name)
+        if entry==None or entry[1]==BinaryDatabase.NONE:
+            return None
+        return self._get_item(entry[1])[1]
+
+    # targets in the order of the database
+    def get_targets(self):
+        for n in range(self._target_count):
+            yield self.get_string(self._get_target(n)[0])
+
+    # returns the files and hash of the target or None
+    def get_target(self, target_idx):
+        target = self._find_target(target_idx)
+        if target==None or not target[6] & BinaryDatabase.TARGET_HAS_DATA:
+            return None
+        return self._get_target_data(target)
+
+    # returns {index: item} of the target or None
+    def get_target_items(self, target_idx):
+        target = self._find_target(target_idx)
+        if target==None or not target[6] & BinaryDatabase.TARGET_HAS_ITEMS:
+            return None
+        return self._get_target_items(target)
+
+    # create the dictionary returned by DatabaseStorage.read()
+    def read(self):
+        database = {'defined': {}, 'targets': {}, 'items': {}}
+        for n in range(self._target_count):
+            target = self._get_target(n)
+            if target[6] & BinaryDatabase.TARGET_HAS_DATA:
+                database['targets'][self.get_string(target[0])] = self._get_target_data(target)
+        for n in self._get_array(self._items_order, 0, self._items_order_count):
+            target = self._get_target(n)
+            database['items'][self.get_string(target[0])] = self._get_target_items(target)
+        for n in range(self._first_defined, self._item_count):
+            item = self._get_item(n)[1]
+            database['defined'][item.name] = item
+        return database
@@ -2,8 +2,9 @@
 # Author: sascha_lammers@gmx.de
 #
 
-from .types import SubstListType, SplitSepType, CompressionType
+from .types import SubstListType, SplitSepType, CompressionType, DatabaseEngineType
 from .cache import SpgmCache
+from .file_wrapper import FileWrapper
 from os import path
 from typing import List, Tuple
 import fnmatch
@@ -96,6 +97,19 @@ class SpgmConfig(SpgmCache):
                 return False
         raise RuntimeError('custom_spgm_generator.%s: expected true or false, got %s' % (name, value))
 
+    def _get_compression_type(self, name, default):
+        value = CompressionType.fromString(self._get_string(name, default))
+        if not FileWrapper.is_available(value):
+            raise RuntimeError('custom_spgm_generator.%s: %s requires the python module %s' % (name, value.value, FileWrapper.CODECS[value][0].split('.')[0]))
+        return value
+
+    def _get_int(self, name, default=None):
+        value = self._env.subst(self._env.GetProjectOption('custom_spgm_generator.%s' % name, default=default))
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            raise RuntimeError('custom_spgm_generator.%s: expected integer, got %s' % (name, value))
+
     def _subst_list(self, list, type=SubstListType.STR, sep=SplitSepType.NEWLINE) -> List[str]:
         parts = []
         if not list:
@@ -166,7 +180,30 @@ class SpgmConfig(SpgmCache):
 
     @property
     def build_database_compression(self):
-        return self.cache('build_database_compression', lambda: CompressionType.fromString(self._get_string('build_database_compression', 'none')))
+        return self.cache('build_database_compression', lambda: self._get_compression_type('build_database_compression', 'none'))
+
+    # compression level, None for the default of the codec
+    @property
+    def build_database_compression_level(self):
+        def get_level():
+            if self._get_string('build_database_compression_level', '').strip()=='':
+                return None
+            return self._get_int('build_database_compression_level')
+        return self.cache('build_database_compression_level', get_level)
+
+    @property
+    def build_database_engine(self):
+        return self.cache('build_database_engine', lambda: DatabaseEngineType.fromString(self._get_string('build_database_engine', 'pickle')))
+
+    # write build_database_dir/_debug.json at the end of the build
+    @property
+    def build_database_debug_json(self):
+        return self.cache('build_database_debug_json', lambda: self._get_bool('build_database_debug_json', False))
+
+    # maximum size of the journal in KB before it is folded into the snapshot. 0 to compact at exit only
+    @property
+    def build_database_journal_size(self):
+        return self.cache('build_database_journal_size', lambda: self._get_int('build_database_journal_size', 4096))
 
     @property
     def output_language(self):
@@ -186,7 +223,8 @@ class SpgmConfig(SpgmCache):
 
     @property
     def is_clean(self):
-        return len(glob.glob(path.join(self.build_database_dir, 'database.pickle*'))) == 0
+        # database.lock is created by readers as well and database.version does not contain any data
+        return len([file for file in glob.glob(path.join(self.build_database_dir, 'database.*')) if not path.basename(file) in ('database.lock', 'database.version')]) == 0
 
     @property
     def definition_file(self):
@@ -208,12 +246,67 @@ class SpgmConfig(SpgmCache):
     def build_database_dir(self):
         return self.cache('build_database_dir', lambda: self._get_path('build_database_dir', '$BUILD_DIR/spgm'))
 
+    # engine for extracting the strings
+    #   auto        use the lexical extractor and fall back to pcpp if the files require the preprocessor
+    #   lexical     lexical extractor only, an error is raised if the files require the preprocessor
+    #   pcpp        preprocess all files
+    @property
+    def extractor(self):
+        extractor = self.cache('extractor', lambda: self._get_string('extractor', 'auto').strip().lower())
+        extractor_options = ['auto', 'lexical', 'pcpp']
+        if extractor in extractor_options:
+            return extractor
+        raise RuntimeError('Invalid setting for custom_spgm_generator.extractor: got %s: expected %s' % (extractor, extractor_options))
+
+    # number of worker processes for the preprocessor. 0 uses the number of jobs of the build (-j)
+    @property
+    def jobs(self):
+        return self.cache('jobs', lambda: self._get_int('jobs', 0) or self._get_num_jobs())
+
+    def _get_num_jobs(self):
+        try:
+            return int(self._env.GetOption('num_jobs'))
+        except Exception:
+            return 1
+
+    # extract strings for each object and create the output files once before the definition file is compiled
+    @property
+    def batch(self):
+        return self.cache('batch', lambda: self._get_bool('batch', False))
+
+    # preprocess files with a daemon that keeps the preprocessor and caches in memory between builds
+    # the daemon is only used if jobs is 1
+    @property
+    def daemon(self):
+        return self.cache('daemon', lambda: self._get_bool('daemon', False))
+
+    # time in seconds until the daemon exits if it does not receive any requests
+    @property
+    def daemon_idle_timeout(self):
+        return self.cache('daemon_idle_timeout', lambda: self._get_int('daemon_idle_timeout', 600))
+
+    # skip headers that do not contain any strings
+    @property
+    def header_index(self):
+        return self.cache('header_index', lambda: self._get_bool('header_index', False))
+
+    # size of the token cache in MB, 0 to disable
+    @property
+    def token_cache_size(self):
+        return self.cache('token_cache_size', lambda: self._get_int('token_cache_size', 64))
+
     def replace_regex(self, pattern):
         return eval("re.compile(%s)" % pattern)
 
     @property
     def include_pattern(self):
-        return self.cache('include_pattern',  lambda: self.replace_regex(self._get_string('include_pattern', None)))
+        return self.cache('include_pattern',  lambda: self._get_string('include_pattern', '') and self.replace_regex(self._get_string('include_pattern')) or None)
+
+    # include_pattern as bytes regex for matching the entire file at once
+    # each line is matched from the beginning like re.match() for a single line
+    @property
+    def include_pattern_bytes(self):
+        return self.cache('include_pattern_bytes', lambda: self.include_pattern and re.compile(b'^(?:' + self.include_pattern.pattern.encode() + b')', re.M | (self.include_pattern.flags & (re.I | re.X))) or None)
 
     @property
     def skip_includes(self):
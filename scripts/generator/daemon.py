@@ -0,0 +1,217 @@
+#
+# Author: sascha_lammers@gmx.de
+#
+
+import os
+import sys
+import json
+import time
+import glob
+import hashlib
+import threading
+import subprocess
+from os import path
+from multiprocessing.connection import Listener, Client
+from typing import List
+
+# preprocessor daemon started with pcpp_cli.py --daemon
+#
+# the daemon keeps the preprocessors, macro caches and token caches in memory across objects and builds. it
+# listens on a unix socket or named pipe and stores the address and the key for authentication in
+# build_database_dir/pcpp_daemon.json. the daemon exits after being idle for the configured time or if
+# the file has been replaced by another daemon
+class PreprocessorDaemon(object):
+
+    FILENAME = 'pcpp_daemon.json'
+
+    # seconds to wait for a new daemon
+    START_TIMEOUT = 30
+
+    def __init__(self, args: List[str], dir, idle_timeout):
+        self._args = args
+        self._dir = dir
+        self._file = path.join(dir, PreprocessorDaemon.FILENAME)
+        self._idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+
+    # identifies the code of the preprocessor. a daemon running older code is not used
+    def get_code_version():
+        scripts_dir = path.dirname(path.dirname(path.abspath(__file__)))
+        files = sorted(glob.glob(path.join(scripts_dir, 'generator', '*.py')) + [path.join(scripts_dir, 'pcpp_cli.py')])
+        md5 = hashlib.md5()
+        for file in files:
+            try:
+                md5.update(('%s:%u;' % (file, os.stat(file).st_mtime_ns)).encode())
+            except OSError:
+                pass
+        return md5.digest().hex()
+
+    def read_info(file):
+        try:
+            with open(file, 'rt') as fh:
+                info = json.loads(fh.read())
+            if info['code_version']==PreprocessorDaemon.get_code_version():
+                return info
+        except (OSError, ValueError, KeyError):
+            pass
+        return None
+
+    def _connect(self):
+        info = PreprocessorDaemon.read_info(self._file)
+        if info==None:
+            return None
+        try:
+            return Client(info['address'], authkey=bytes.fromhex(info['authkey']))
+        except Exception:
+            return None
+
+    def _start(self):
+        try:
+            os.unlink(self._file)
+        except OSError:
+            pass
+        os.makedirs(self._dir, exist_ok=True)
+        args = self._args + ['--daemon', '--cache-dir', self._dir, '--idle-timeout', str(self._idle_timeout)]
+        kwargs = {}
+        if sys.platform=='win32':
+            kwargs['creationflags'] = subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
+        else:
+            kwargs['start_new_session'] = True
+        with open(path.join(self._dir, 'pcpp_daemon.log'), 'ab') as log:
+            proc = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=log, stderr=log, **kwargs)
+        timeout = time.monotonic() + PreprocessorDaemon.START_TIMEOUT
+        while time.monotonic()<timeout:
+            conn = self._connect()
+            if conn:
+                return conn
+            if proc.poll()!=None:
+                break
+            time.sleep(0.05)
+        raise RuntimeError('failed to start preprocessor daemon. exit code %s, see %s. cmd: %s' % (proc.poll(), path.join(self._dir, 'pcpp_daemon.log'), ' '.join(args)))
+
+    # get connection to the daemon, starts a new daemon if none is running
+    def _get_connection(self, restart=False):
+        with self._lock:
+            conn = None
+            if not restart:
+                conn = self._connect()
+            if conn==None:
+                conn = self._start()
+            return conn
+
+    # send request to the daemon and wait for the result
+    # the daemon is restarted once if it is not running or has terminated while processing the request
+    def run(self, config):
+        for restart in (False, True):
+            try:
+                with self._get_connection(restart) as conn:
+                    conn.send(config)
+                    result = conn.recv()
+                break
+            except (OSError, EOFError) as e:
+                if restart:
+                    raise RuntimeError('preprocessor daemon failed: %s' % e)
+        if 'error' in result:
+            raise RuntimeError('preprocessor daemon: %s' % result['error'])
+        return result
+
+# server side of the daemon
+#
+# each connection is handled in its own thread. handler(config) must return a dictionary with the result
+class PreprocessorDaemonServer(object):
+
+    def __init__(self, dir, idle_timeout, handler):
+        self._dir = dir
+        self._file = path.join(dir, PreprocessorDaemon.FILENAME)
+        self._idle_timeout = idle_timeout
+        self._handler = handler
+        self._authkey = os.urandom(32)
+        self._listener = None
+        self._lock = threading.Lock()
+        self._active = 0
+        self._last_request = time.monotonic()
+        self._running = True
+
+    def _write_info(self):
+        info = {
+            'address': self._listener.address,
+            'authkey': self._authkey.hex(),
+            'pid': os.getpid(),
+            'code_version': PreprocessorDaemon.get_code_version()
+        }
+        tmp_file = '%s.%u.tmp' % (self._file, os.getpid())
+        # the file contains the key for authentication
+        fd = os.open(tmp_file, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wt') as file:
+            file.write(json.dumps(info))
+        os.replace(tmp_file, self._file)
+
+    # the daemon has been replaced if the file does not contain its address anymore
+    def _is_replaced(self):
+        try:
+            with open(self._file, 'rt') as file:
+                return json.loads(file.read())['address']!=self._listener.address
+        except (OSError, ValueError, KeyError):
+            return True
+
+    def _handle(self, conn):
+        try:
+            with conn:
+                config = conn.recv()
+                try:
+                    result = self._handler(config)
+                except Exception as e:
+                    result = {'error': '%s: %s' % (e.__class__.__name__, e)}
+                conn.send(result)
+        except (OSError, EOFError) as e:
+            print('connection failed: %s' % e, file=sys.stderr)
+        finally:
+            with self._lock:
+                self._active -= 1
+                self._last_request = time.monotonic()
+
+    # stop the server if idle and wake up the accept() call
+    def _watchdog(self):
+        while True:
+            time.sleep(min(5, max(1, self._idle_timeout / 10)))
+            with self._lock:
+                idle = self._active==0 and time.monotonic() - self._last_request>=self._idle_timeout
+            if idle or self._is_replaced():
+                self._running = False
+                try:
+                    Client(self._listener.address, authkey=self._authkey).close()
+                except Exception:
+                    pass
+                return
+
+    def serve(self):
+        self._listener = Listener(authkey=self._authkey)
+        try:
+            self._write_info()
+            threading.Thread(target=self._watchdog, daemon=True).start()
+            while self._running:
+                try:
+                    conn = self._listener.accept()
+                except Exception as e:
+                    # failed authentication
+                    print('accept failed: %s' % e, file=sys.stderr)
+                    continue
+                if not self._running:
+                    conn.close()
+                    break
+                with self._lock:
+                    self._active += 1
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+            # wait for requests being processed
+            while True:
+                with self._lock:
+                    if self._active==0:
+                        break
+                time.sleep(0.05)
+        finally:
+            if not self._is_replaced():
+                try:
+                    os.unlink(self._file)
+                except OSError:
+                    pass
+            self._listener.close()
@@ -4,19 +4,29 @@
 
 import threading
 import sys
-import pickle
 import time
 import glob
 import os
 import re
 import json
 from os import path
-from .types import CompressionType, DefinitionType
-from .file_wrapper import FileWrapper
+from .types import DefinitionType
 from .config import SpgmConfig
+from .fingerprint import Fingerprint
+from .storage import DatabaseStorage
+from .file_table import FileTable
+from .export import DebugExport
 from io import TextIOWrapper
-from typing import Dict, Generator
+from typing import Dict, List, Generator
 import hashlib
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    try:
+        import msvcrt
+    except ImportError:
+        msvcrt = None
 
 class v2:
 
@@ -38,96 +48,190 @@ class v2:
         def __eq__(self, obj):
             return id(self)==id(obj)
 
-    class Item(dict):
-        def __init__(self, name, type, source, value=None, data={}):
+    # item stored in the database
+    #
+    # the value of an item is resolved by the database, which stores the first value of each name.
+    # the source is stored as file id, line and column. empty data is stored as None
+    class Item(object):
+
+        __slots__ = ('name', 'type', 'file_id', 'line', 'column', 'own_value', '_data')
+
+        def __init__(self, name, type, source, value=None, data=None):
+            self._init(name, type, *FileTable.split_source(source), value, data)
+
+        def _init(self, name, type, path, line, column, value, data):
             if not isinstance(type, DefinitionType):
                 type = DefinitionType.fromString(type)
-            dict.__init__(self, {
-                'name': name,
-                'type': type,
-                'source': source,
-                'value': value,
-                'data': data
-            });
+            self.name = sys.intern(name)
+            self.type = type
+            self.file_id = FileTable.get_id(path)
+            self.line = line
+            self.column = column
+            self.own_value = value
+            self._data = data or None
+
+        # create item from the path, line and column of the source
+        def from_path(name, type, path, line, column, value=None, data=None):
+            item = v2.Item.__new__(v2.Item)
+            item._init(name, type, path, line, column, value, data)
+            return item
 
-        # def __init_item__(self, item):
-        #     self.__init__(item['name'], item['type'], item['source'], item['value'], item['data']);
+        @property
+        def data(self):
+            return self._data or {}
+
+        @property
+        def file(self):
+            return FileTable.get_path(self.file_id)
 
         @property
-        def name(self):
-            return dict.__getitem__(self, 'name')
+        def source(self):
+            return FileTable.format_source(self.file_id, self.line, self.column)
 
         @property
         def index(self):
             # unique key on c source file, line and name
             # in theory there could be multiple per line but the column is not stored
-            id_str = ':'.join([self.__getitem__('source'), str(self.__getitem__('type')), self.name])
+            id_str = ':'.join([self.source, str(self.type), self.name])
             return id_str
             # return hashlib.md5(id_str.encode()).digest().hex()
 
+        # location as tuple for sorting and comparing, see FileTable.format_location()
         @property
-        def value(self):
-            value = self.__getitem__('value')
-            if value==None:
-                value = DatabaseHelpers.beautify(self.name)
-            return value
-
-        @property
-        def locations(self):
-            return self._database.get_locations(self)
+        def location_tuple(self):
+            return (self.type, self.file_id, self.line, self.column)
 
         @property
         def location(self):
-            return '%s:%s' % (self.__getitem__('type'), self.__getitem__('source'))
+            return FileTable.format_location(self.location_tuple)
 
-        @property
-        def has_value(self):
-            return self.__getitem__('value')!=None
+        # access the attributes by key
+        # 'value' returns the value of the item. use Database.get_item_value() to get the value of its name
+        def __getitem__(self, key):
+            if key=='value' or key=='own_value':
+                return self.own_value
+            if key=='data':
+                return self.data
+            if key in ('name', 'type', 'source'):
+                return getattr(self, key)
+            raise KeyError(key)
 
-        @property
-        def database(self):
-            return self._database
+        def __eq__(self, obj):
+            if not isinstance(obj, v2.Item):
+                return False
+            return (self.name, self.location_tuple, self.own_value, self._data)==(obj.name, obj.location_tuple, obj.own_value, obj._data)
 
-        @database.setter
-        def database(self, db):
-            self._database = db
-            value = super().__getitem__('value')
-            if value!=None:
-                self._database.set_value(self, self.name, value)
+        def __hash__(self):
+            return hash((self.name, self.location_tuple))
 
-        def __getitem__(self, key):
-            if key=='locations':
-                return self.locations
-            if key=='own_value':
-                return super().__getitem__('value')
-            if key=='value':
-                val = self._database.get_value(self, self.name)
-                if val!=None:
-                    return val
-            return super().__getitem__(key)
-
-        def __setitem__(self, key, val):
-            if key=='locations':
-                return None
-            if key=='value':
-                super().__setitem__(key, val)
-                if not self._database.set_value(self, self.name, val):
-                    return
-            return super().__setitem__(key, val)
+        def __repr__(self):
+            return repr({'name': self.name, 'type': self.type, 'source': self.source, 'value': self.own_value, 'data': self.data})
 
+        # the path is pickled once for all items of the same file
+        # items created by older versions have been pickled with the arguments of the constructor
         def __reduce__(self):
-            return (self.__class__, (self['name'], self['type'], self['source'], self['value'], self['data']))
+            return (v2.Item.from_path, (self.name, self.type.value, self.file, self.line, self.column, self.own_value, self._data))
 
 
 
+# lock for the database files shared between processes
+#
+# readers hold a shared lock and writers an exclusive lock while the database is merged and
+# replaced. the lock is a flock() on build_database_dir/database.lock. msvcrt.locking() does
+# not support shared locks and is used as exclusive lock for both on Windows
+#
+# with FileLock(dir, shared=True, timeout=60) as lock:
+#     lock.wait_time    seconds waited for the lock
+class FileLock(object):
+
+    FILENAME = 'database.lock'
+
+    # maximum seconds between attempts
+    MAX_POLL_INTERVAL = 0.05
+
+    def __init__(self, dir, shared, timeout):
+        self._dir = dir
+        self._filename = path.join(dir, FileLock.FILENAME)
+        self._shared = shared
+        self._timeout = timeout
+        self._fd = None
+        self.wait_time = 0
+
+    @property
+    def mode(self):
+        return self._shared and 'shared' or 'exclusive'
+
+    def _try_lock(self):
+        if fcntl:
+            try:
+                fcntl.flock(self._fd, (self._shared and fcntl.LOCK_SH or fcntl.LOCK_EX) | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+        elif msvcrt:
+            try:
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                msvcrt.locking(self._fd, msvcrt.LK_NBLCK, 1)
+            except OSError:
+                return False
+        return True
+
+    def _unlock(self):
+        if fcntl:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        elif msvcrt:
+            os.lseek(self._fd, 0, os.SEEK_SET)
+            msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+
+    def acquire(self):
+        os.makedirs(self._dir, exist_ok=True)
+        # each lock uses its own file descriptor. locks of other threads are respected as well
+        self._fd = os.open(self._filename, os.O_RDWR|os.O_CREAT, 0o666)
+        start = time.monotonic()
+        interval = 0.001
+        try:
+            while not self._try_lock():
+                if time.monotonic() - start>self._timeout:
+                    raise RuntimeError('timeout waiting for %s lock: %s' % (self.mode, self._filename))
+                time.sleep(interval)
+                interval = min(interval * 2, FileLock.MAX_POLL_INTERVAL)
+        except:
+            os.close(self._fd)
+            self._fd = None
+            raise
+        self.wait_time = time.monotonic() - start
+        return self
+
+    def release(self):
+        try:
+            self._unlock()
+        finally:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, type, value, traceback):
+        self.release()
+        return False
+
 class DatabaseHelpers(object):
 
+    # bytes above 0x7f are encoded as hex
+    ENCODE_TABLE = {byte: '\\x%02x' % byte for byte in range(0x80, 0x100)}
+
+    SPLIT_HEX_RE = re.compile(r'(\\x[0-9a-fA-F]{2})([0-9a-fA-F])')
+
+    # {value: literal} of encode_literal()
+    _literals = {} # type: Dict[str, str]
+    MAX_LITERALS = 0x10000
+
     # write locations
     def write_locations(self, file: TextIOWrapper, item, indent=''):
         if self.config.locations_one_per_line:
-            file.write('%s//' + ('\n%s//' % indent).join(indent, item.locations))
+            file.write('%s//' + ('\n%s//' % indent).join(indent, self.get_locations(item)))
         else:
-            file.write('%s// %s\n' % (indent, ', '.join(item.locations)))
+            file.write('%s// %s\n' % (indent, ', '.join(self.get_locations(item))))
 
     def acquire_lock(database, lock, timeout):
         if lock=='exit':
@@ -157,20 +261,22 @@ class DatabaseHelpers(object):
         # print('releasing lock %u. target=%s' % (id(lock), database._target))
         lock.release()
 
-    # create md5 hash for a list of files
-    # size and modificaton time is used to detect changes
-    def get_hash(files):
-        hash_files = []
-        for file in files:
-            file = path.realpath(file)
-            if path.isfile(file):
-                st = os.stat(file)
-                file += (',%u,%u' % (st.st_size, st.st_mtime))
-            else:
-                file += ',-,-'
-            hash_files.append(file);
-        hash_files.sort()
-        return hashlib.md5(json.dumps(hash_files).encode()).digest().hex()
+    # create hash for a list of files
+    # the contents of the files is used to detect changes
+    def get_hash(self, files):
+        return self.fingerprint.get_hash(files)
+
+    # create md5 hash for a list of files and the preprocessor configuration
+    # the target does not need to be preprocessed again if the hash did not change
+    def get_target_hash(self, files, config):
+        return hashlib.md5(json.dumps([
+            self.get_hash(files),
+            config['defines'],
+            config['pcpp_defines'],
+            config['include_dirs'],
+            config['skip_includes'],
+            config['pcpp_version']
+        ]).encode()).digest().hex()
 
     def beautify(name):
         name = name.replace('_', ' ')
@@ -181,20 +287,15 @@ class DatabaseHelpers(object):
     def split_hex(value):
         if value.find('\\x')==-1:
             return value
-        def repl(m):
-            return '%s\" \"%s' % (m.group(1), m.group(2))
-        new_value = re.sub('(\\\\x[0-9a-fA-F]{2})([0-9a-fA-F])', repl, value);
-        # if new_value != value:
-        #     print('"%s" "%s"' % (new_value, value))
-        return new_value
+        return DatabaseHelpers.SPLIT_HEX_RE.sub(r'\1" "\2', value)
 
     # get unique items that are not static
     def get_items(self, static=False) -> Dict[str,v2.Item]:
         items_out = {}
-        for items in self._items_per_file.values():
-            for item in items.values():
-                if item.name not in items_out and self.is_static(item)==static:
-                    items_out[item.name] = item
+        # all items of a name are either static or not
+        for item in self._get_first_items().values():
+            if self.is_static(item)==static:
+                items_out[item.name] = item
         for item in self._defined.values():
             if item.name not in items_out and self.is_static(item)==static:
                 items_out[item.name] = item
@@ -206,22 +307,42 @@ class DatabaseHelpers(object):
 
     # encode binary data into hexadecimal string
     def encode_binary(s: str):
-        bytes = s.encode('ascii', errors='backslashreplace')
-        out = ''
-        for byte in bytes:
-            if byte&0x80:
-                out += '\\x%02x' % byte
-            else:
-                out += chr(byte)
-        return out
+        return s.encode('ascii', errors='backslashreplace').decode('latin1').translate(DatabaseHelpers.ENCODE_TABLE)
+
+    # encode string for a string literal. the results are memoized
+    def encode_literal(value: str):
+        literal = DatabaseHelpers._literals.get(value, None)
+        if literal==None:
+            literal = DatabaseHelpers.split_hex(DatabaseHelpers.encode_binary(value))
+            DatabaseHelpers._add_literal(value, literal)
+        return literal
+
+    def _add_literal(value, literal):
+        if len(DatabaseHelpers._literals)>=DatabaseHelpers.MAX_LITERALS:
+            DatabaseHelpers._literals = {}
+        DatabaseHelpers._literals[value] = literal
+
+    # encode a list of strings for string literals
+    # the strings that are not memoized are joined and encoded in one pass. strings containing NUL
+    # are encoded separately
+    def encode_literals(values: List[str]) -> List[str]:
+        # NUL is neither escaped nor a hex digit and separates the strings
+        missing = list(dict.fromkeys([value for value in values if not value in DatabaseHelpers._literals and not '\0' in value]))
+        if missing:
+            literals = DatabaseHelpers.split_hex(DatabaseHelpers.encode_binary('\0'.join(missing))).split('\0')
+            if len(literals)!=len(missing):
+                literals = [DatabaseHelpers.split_hex(DatabaseHelpers.encode_binary(value)) for value in missing]
+            for value, literal in zip(missing, literals):
+                DatabaseHelpers._add_literal(value, literal)
+        return [DatabaseHelpers.encode_literal(value) for value in values]
 
     def create_define(self, item):
         try:
-            ascii_str = DatabaseHelpers.encode_binary(item.value)
+            literal = DatabaseHelpers.encode_literal(self.get_display_value(item))
         except UnicodeEncodeError as e:
             self.add_error('failed to encode string', item=item, fatal=True)
 
-        s = '(%s, "%s");' % (item.name, DatabaseHelpers.split_hex(ascii_str))
+        s = '(%s, "%s");' % (item.name, literal)
         return s
 
     # write definition string
@@ -231,14 +352,14 @@ class DatabaseHelpers(object):
             print('%s%s' % ('PROGMEM_STRING_DEF', self.create_define(item)), file=file)
         else:
             lang = 'language: default'
-            if not item.has_value:
+            if not self.has_value(item):
                 lang += ' (auto value)'
             print('// %s' % lang, file=file)
             print('%s%s' % ('PROGMEM_STRING_DEF', self.create_define(item)), file=file)
 
     # write auto definition
     def write_auto_init(self, file: TextIOWrapper, item: v2.Item):
-        if item['value']!=None:
+        if self.get_item_value(item)!=None:
             raise RuntimeError('value expected to be None')
         indent = 4*' '
         self.write_locations(file, item, indent)
@@ -246,6 +367,10 @@ class DatabaseHelpers(object):
 
 
 class Database(DatabaseHelpers):
+
+    # random token that is replaced by each write
+    VERSION_FILE = 'database.version'
+
     def __init__(self, generator, target):
 
         self._generator = generator
@@ -259,8 +384,10 @@ class Database(DatabaseHelpers):
         # human readable version of the database fopr debugging
         self._json_file = path.join(self._dir, '_debug.json');
 
-        # lock for the database files
-        self._lock = None #threading.Lock()
+        # seconds to wait for the lock of the database files
+        self._lock_timeout = 300
+        # version of the database files when they have been read or None if unknown
+        self._version = None
 
         # all values by name
         self._values = {}
@@ -270,6 +397,21 @@ class Database(DatabaseHelpers):
         self._items_per_file = {}
         # list of targets and dependecies
         self._targets = {}
+        # names added to _defined since the database has been read
+        self._defined_added = []
+
+        # indexes of the items of all targets by name
+        # number of static items
+        self._static_count = {} # type: Dict[str, int]
+        # number of items in use
+        self._used_count = {} # type: Dict[str, int]
+        # {location tuple: number of items}
+        self._locations = {} # type: Dict[str, Dict[tuple, int]]
+        # first item of each name in the order of the targets or None if it has to be created
+        self._first_items = None # type: Dict[str, v2.Item]
+
+        # storage engine
+        self._storage = DatabaseStorage.create(self.config.build_database_engine, self._dir, self.config.build_database_compression, self.config.build_database_journal_size * 1024, self.config.build_database_compression_level)
 
         # hash target and sources to identify in database
         self._target = target;
@@ -283,6 +425,11 @@ class Database(DatabaseHelpers):
     def config(self):
         return self._generator.config
 
+    # shared file fingerprints of the build directory
+    @property
+    def fingerprint(self):
+        return Fingerprint.get_instance(self._dir)
+
     def get_target(self):
         if not self._target_idx in self._targets:
             self._targets[self._target_idx] = {
@@ -297,30 +444,104 @@ class Database(DatabaseHelpers):
             'hash': hash
         }
 
-    # create a sorted list of all stored locations
-    def get_locations(self, find_item):
-        locations = []
-        if find_item.name in self._defined:
-            locations.append(self._defined[find_item.name].location)
+    # returns True if the target has been preprocessed before and none of
+    # its files or the preprocessor configuration have been modified
+    def is_target_up_to_date(self, config):
+        if not self._target_idx in self._targets or not self._target_idx in self._items_per_file:
+            return False
+        target = self._targets[self._target_idx]
+        if not target['hash'] or not target['files']:
+            return False
+        return self.get_target_hash(target['files'], config)==target['hash']
 
-        # for item in self._defined.values():
-        #     if find_item.name==item.name:
-        #         locations.append(item.location)
+    def _get_location_tuples(self, find_item):
+        locations = set(self._locations.get(find_item.name, {}).keys())
+        if find_item.name in self._defined:
+            locations.add(self._defined[find_item.name].location_tuple)
+        return sorted(list(locations), key=FileTable.get_location_sort_key)
 
+    # create a sorted list of all stored locations
+    def get_locations(self, find_item):
+        return [FileTable.format_location(location) for location in self._get_location_tuples(find_item)]
+
+    # create a key for all stored locations that is valid in other processes
+    def get_locations_key(self, find_item):
+        return tuple((str(type), FileTable.get_path(file_id), line, column) for type, file_id, line, column in self._get_location_tuples(find_item))
+
+    # add item of a target to the indexes
+    def _index_add(self, item):
+        name = item.name
+        if item.type==DefinitionType.DEFINE:
+            self._static_count[name] = self._static_count.get(name, 0) + 1
+        elif item.type==DefinitionType.SPGM:
+            self._used_count[name] = self._used_count.get(name, 0) + 1
+        locations = self._locations.setdefault(name, {})
+        location = item.location_tuple
+        locations[location] = locations.get(location, 0) + 1
+        self._first_items = None
+
+    # remove item of a target from the indexes
+    def _index_remove(self, item):
+        name = item.name
+        counts = None
+        if item.type==DefinitionType.DEFINE:
+            counts = self._static_count
+        elif item.type==DefinitionType.SPGM:
+            counts = self._used_count
+        if counts!=None:
+            counts[name] -= 1
+            if counts[name]==0:
+                del counts[name]
+        locations = self._locations[name]
+        location = item.location_tuple
+        locations[location] -= 1
+        if locations[location]==0:
+            del locations[location]
+            if not locations:
+                del self._locations[name]
+        self._first_items = None
+
+    # create indexes for all items
+    def _index_create(self):
+        self._static_count = {}
+        self._used_count = {}
+        self._locations = {}
         for items in self._items_per_file.values():
-            # if find_item.index in items:
-            #     locations.append(items[find_item.index].location)
             for item in items.values():
-                if find_item.name==item.name:
-                    locations.append(item.location)
-        locations = sorted(list(set(locations)), key=lambda val: val)
-        return locations
+                self._index_add(item)
+        self._first_items = None
+
+    def _get_first_items(self):
+        if self._first_items==None:
+            self._first_items = {}
+            for items in self._items_per_file.values():
+                for item in items.values():
+                    if not item.name in self._first_items:
+                        self._first_items[item.name] = item
+        return self._first_items
 
     def get_value(self, item, name):
         if name in self._values:
             return self._values[name]
         return None
 
+    # returns the value of the item's name
+    def get_item_value(self, item):
+        value = self._values.get(item.name, None)
+        if value!=None:
+            return value
+        return item.own_value
+
+    def has_value(self, item):
+        return self.get_item_value(item)!=None
+
+    # returns the value or the name if the item does not have a value
+    def get_display_value(self, item):
+        value = self.get_item_value(item)
+        if value==None:
+            value = DatabaseHelpers.beautify(item.name)
+        return value
+
     def set_value(self, item, name, value):
         if name in self._values:
             if value!=self._values[name]:
@@ -332,11 +553,11 @@ class Database(DatabaseHelpers):
 
     def add_error(self, msg, item=None, item2=None, fatal=False):
         if item:
-            msg += '\nitem name: %s source: %s' % (item.name, item['source'])
-            if item.has_value:
-                msg += ' value: "%s"' % item['value']
+            msg += '\nitem name: %s source: %s' % (item.name, item.source)
+            if self.has_value(item):
+                msg += ' value: "%s"' % self.get_item_value(item)
         if item2:
-            msg += '\nitem name: %s source: %s' % (item2.name, item2['source'])
+            msg += '\nitem name: %s source: %s' % (item2.name, item2.source)
         self._errors.append(msg)
         if fatal:
             try:
@@ -355,128 +576,103 @@ class Database(DatabaseHelpers):
             print(error, file=sys.stderr)
             print('', file=sys.stderr)
 
-    def _add_extension(self, file):
-        if self.config.build_database_compression == CompressionType.LZMA:
-            file += '.xz'
-        return file
-
     # create a human readable version of the database for debugging
     def write_json(self):
-
         os.makedirs(self._dir, exist_ok=True)
+        DebugExport({'defined': self._defined, 'targets': self._targets, 'items': self._items_per_file}).write_file(self._json_file)
 
-        tmp = {
-            'defined': {},
-            'unique': {},
-            'targets': self._targets
-        }
-        for target_idx, items in self._items_per_file.items():
-            tmp[target_idx] = {}
-            for index, item in items.items():
-                item_out = {'name': item['name'], 'source': item['source'], 'type': str(item['type']), 'value': item['value']}
-                if not item.name in tmp['unique']:
-                    tmp['unique'][item.name] = {'name': item['name'], 'source': item['source'], 'type': str(item['type']), 'value': item['value'], 'locations': str(item.locations)}
-                tmp[target_idx][index] = item_out
-        if self._defined:
-            for index, item in self._defined.items():
-                tmp['defined'][index] = {'name': item['name'], 'source': item['source'], 'type': str(item['type']), 'value': item['value']}
-                if not item.name in tmp['unique']:
-                    tmp['unique'][item.name] = {'name': item['name'], 'source': item['source'], 'type': str(item['type']), 'value': item['value'], 'locations': str(item.locations)}
-
-        with open(self._json_file, 'wt') as file:
-            file.write(json.dumps(tmp, indent=2))
-
-    # assign self to _database of each item
+    # add the values of the items to the database
     def _update_items(self, items: dict):
         for item in items.values():
-            item.database = self
+            if item.own_value!=None:
+                self.set_value(item, item.name, item.own_value)
 
-    # load database from file if it is exists
-    def _read(self, filename):
-        if not path.isfile(filename):
-            return {'defined': {}, 'targets': {}, 'items': {}}
-
-        file = FileWrapper.open(filename, 'rb')
+    # lock the database files for reading or writing
+    def _lock_files(self, shared):
+        lock = FileLock(self._dir, shared, self._lock_timeout)
         try:
-            database = pickle.load(file)
-        finally:
-            file.close()
-
-        return database
-
-    # write database to file
-    def _write(self, filename, database: dict):
-
-        file = FileWrapper.open(filename, 'wb')
+            lock.acquire()
+        except RuntimeError as e:
+            self.add_error(str(e), fatal=True)
+        # waiting for less than a millisecond means that the lock was free
+        if lock.wait_time>=0.001:
+            SpgmConfig.verbose('waited %.3f seconds for %s database lock: %s' % (lock.wait_time, lock.mode, self._target_idx))
+        return lock
+
+    def _read_version(self):
         try:
-            pickle.dump(database, file)
-        finally:
-            file.close()
+            with open(path.join(self._dir, Database.VERSION_FILE), 'rt') as file:
+                return file.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def _write_version(self):
+        version = os.urandom(8).hex()
+        filename = path.join(self._dir, Database.VERSION_FILE)
+        tmp_file = '%s.%u.%u.tmp' % (filename, os.getpid(), threading.get_ident())
+        with open(tmp_file, 'wt') as file:
+            file.write(version)
+        os.replace(tmp_file, filename)
+        return version
+
+    # returns True if the database files have been modified since they have been read
+    def is_modified(self):
+        return self._version==None or self._read_version()!=self._version
 
     # read database
     def read(self):
 
-        DatabaseHelpers.acquire_lock(self, self._lock, 60)
+        lock = self._lock_files(True)
         try:
+            version = self._read_version()
+            database = self._storage.read()
+        finally:
+            lock.release()
+        self._version = version
 
-            file = self._add_extension(path.join(self._dir, 'database.pickle'))
-            database = self._read(file)
-            self._targets = database['targets']
-            self._defined = database['defined']
-            self._items_per_file = database['items']
+        self._targets = database['targets']
+        self._defined = database['defined']
+        self._items_per_file = database['items']
+        self._defined_added = []
 
-            self._update_items(self._defined)
-            for items in self._items_per_file.values():
-                self._update_items(items)
-        finally:
-            DatabaseHelpers.release_lock(self, self._lock)
+        self._update_items(self._defined)
+        for items in self._items_per_file.values():
+            self._update_items(items)
+        self._index_create()
 
     # write database
+    # the exclusive lock is only held while the storage merges and replaces the files
     def write(self):
 
-        DatabaseHelpers.acquire_lock(self, self._lock, 60)
+        lock = self._lock_files(False)
         try:
-
-            os.makedirs(self._dir, exist_ok=True)
-            file = self._add_extension(path.join(self._dir, 'database.pickle'))
-
-            merged_database = self._read(file)
-            merged_database['targets'].update(self._targets)
-            merged_database['defined'].update(self._defined)
-            if self._target_idx in self._items_per_file:
-                merged_database['items'].update({self._target_idx: self._items_per_file[self._target_idx]})
-            self._update_items(merged_database['defined'])
-            for items in merged_database['items'].values():
-                self._update_items(items)
-            self._write(file, merged_database)
-
-            self.write_json()
-
+            is_modified = self.is_modified()
+            self._storage.write(self)
+            version = self._write_version()
         finally:
-            DatabaseHelpers.release_lock(self, self._lock)
+            lock.release()
+        # the data written by others is only known after reading the database again
+        self._version = not is_modified and version or None
+
+        if self.config.build_database_debug_json:
+            DebugExport.schedule(self._storage, self._json_file)
 
     # returns True for items that are statically defined
     def is_static(self, find_item):
-        if find_item['type']==DefinitionType.DEFINE:
+        if find_item.type==DefinitionType.DEFINE:
             return True
-        for items in self._items_per_file.values():
-            for item in items.values():
-                if item['type']==DefinitionType.DEFINE and find_item['name']==item['name']:
-                    return True
-        return False
+        return find_item.name in self._static_count
 
     # returns True if the item is currently in use
     def is_used(self, find_item):
-        for items in self._items_per_file.values():
-            for item in items.values():
-                if item['type']==DefinitionType.SPGM and item.name==find_item.name:
-                    return True
-        return False
+        return find_item.name in self._used_count
 
     # remove the values from the current target
+    # targets without any items are stored as well to detect if they are up to date
     def flush(self):
-        if self._target_idx in self._items_per_file:
-            self._items_per_file[self._target_idx] = {}
+        for item in self._items_per_file.get(self._target_idx, {}).values():
+            self._index_remove(item)
+        self._items_per_file[self._target_idx] = {}
 
     # add or update an item
     def add(self, source, name, type, value, data):
@@ -489,20 +685,25 @@ class Database(DatabaseHelpers):
 
         # check if item already exists
         new_item = v2.Item(name, type, source, value, data);
-        new_item.database = self
+        if value!=None:
+            self.set_value(new_item, new_item.name, value)
         if new_item.index in items:
             self.add_error('item already exists. currently only one item per line may exist', item=new_item, fatal=True) #TODO fix issue
 
         # add item
         items[new_item.index] = new_item
+        self._index_add(new_item)
 
         # add item to defined items if it has a value
-        if new_item['value']!=None:
+        new_value = self.get_item_value(new_item)
+        if new_value!=None:
             if new_item.name in self._defined:
-                if self._defined[new_item.name]['value']!=new_item['value']:
-                    self.add_error('cannot redefine different value: %s!=%s' % (new_item['value'], self._defined[new_item.name]['value']), item=new_item, item2=self._defined[new_item.name])
+                defined_value = self.get_item_value(self._defined[new_item.name])
+                if defined_value!=new_value:
+                    self.add_error('cannot redefine different value: %s!=%s' % (new_value, defined_value), item=new_item, item2=self._defined[new_item.name])
             else:
                 self._defined[new_item.name] = new_item
+                self._defined_added.append(new_item.name)
 
     # add items from preprocessor
     def add_items(self, items):
@@ -0,0 +1,119 @@
+#
+# Author: sascha_lammers@gmx.de
+#
+
+import os
+import sys
+import json
+import types
+import atexit
+import threading
+from os import path
+from typing import Dict
+from .file_table import FileTable
+
+# human readable version of the database for debugging
+#
+# the JSON output is written incrementally, one item at a time. the output is created at exit if
+# build_database_debug_json is enabled or by querydb.py --export-json
+class DebugExport(object):
+
+    # storages to export at exit
+    _pending = {}
+    _pending_lock = threading.Lock()
+
+    # database: dictionary returned by DatabaseStorage.read()
+    def __init__(self, database: dict):
+        self._defined = database['defined']
+        self._targets = database['targets']
+        self._items_per_file = database['items']
+        # the first value of each name
+        self._values = {}
+        for item in self._get_all_items():
+            if item.own_value!=None and not item.name in self._values:
+                self._values[item.name] = item.own_value
+
+    def _get_all_items(self):
+        yield from self._defined.values()
+        for items in self._items_per_file.values():
+            yield from items.values()
+
+    # group: all items with the name of the item to create the locations
+    def _get_item(self, item, group=None):
+        value = self._values.get(item.name, item.own_value)
+        item_out = {'name': item.name, 'source': item.source, 'type': str(item.type), 'value': value}
+        if group!=None:
+            locations = sorted(set(item.location_tuple for item in group), key=FileTable.get_location_sort_key)
+            item_out['locations'] = str([FileTable.format_location(location) for location in locations])
+        return item_out
+
+    # the items are grouped by name while the section is written. each group is removed after
+    # its locations have been written
+    def _get_unique(self):
+        groups = {}
+        for item in self._get_all_items():
+            groups.setdefault(item.name, []).append(item)
+        for items in list(self._items_per_file.values()) + [self._defined]:
+            for item in items.values():
+                group = groups.pop(item.name, None)
+                if group!=None:
+                    yield (item.name, self._get_item(item, group))
+
+    def _get_items(self, items):
+        for index, item in items.items():
+            yield (index, self._get_item(item))
+
+    def _get_sections(self):
+        yield ('defined', ((index, self._get_item(item)) for index, item in self._defined.items()))
+        yield ('unique', self._get_unique())
+        yield ('targets', self._targets)
+        for target_idx, items in self._items_per_file.items():
+            yield (target_idx, self._get_items(items))
+
+    # write the pairs of an iterator as object. values that are generators are written incrementally
+    # the output is the same as json.dumps(obj, indent=2)
+    def _write_object(self, file, pairs, level=0):
+        indent = '  ' * (level + 1)
+        first = True
+        for key, value in pairs:
+            file.write(first and '{\n' or ',\n')
+            first = False
+            file.write('%s%s: ' % (indent, json.dumps(key)))
+            if isinstance(value, types.GeneratorType):
+                self._write_object(file, value, level + 1)
+            else:
+                file.write(json.dumps(value, indent=2).replace('\n', '\n' + indent))
+        if first:
+            file.write('{}')
+        else:
+            file.write('\n%s}' % ('  ' * level))
+
+    def write(self, file):
+        self._write_object(file, self._get_sections())
+
+    # write to file and replace it atomically
+    def write_file(self, filename):
+        tmp_file = '%s.%u.tmp' % (filename, os.getpid())
+        with open(tmp_file, 'wt') as file:
+            self.write(file)
+        os.replace(tmp_file, filename)
+
+    # export the database of the storage at exit
+    def schedule(storage, filename):
+        with DebugExport._pending_lock:
+            if not DebugExport._pending:
+                atexit.register(DebugExport._write_pending)
+            DebugExport._pending[filename] = storage
+
+    def _write_pending():
+        with DebugExport._pending_lock:
+            pending = DebugExport._pending
+            DebugExport._pending = {}
+        from .database2 import FileLock
+        for filename, storage in pending.items():
+            try:
+                with FileLock(storage._dir, True, 60):
+                    data = storage.read()
+                DebugExport(data).write_file(filename)
+            except Exception as e:
+                print('failed to write %s: %s' % (filename, e), file=sys.stderr)
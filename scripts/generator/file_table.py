@@ -0,0 +1,56 @@
+#
+# Author: sascha_lammers@gmx.de
+#
+
+import sys
+import threading
+from typing import Dict, List
+
+# table of the source files of all items
+#
+# items store the id of the file, the line and the column instead of the source string. the ids
+# are only valid in the current process, the storage engines store the paths
+class FileTable(object):
+
+    _ids = {} # type: Dict[str, int]
+    _paths = [] # type: List[str]
+    _lock = threading.Lock()
+
+    def get_id(path):
+        id = FileTable._ids.get(path, None)
+        if id==None:
+            with FileTable._lock:
+                id = FileTable._ids.get(path, None)
+                if id==None:
+                    path = sys.intern(path)
+                    id = len(FileTable._paths)
+                    FileTable._paths.append(path)
+                    FileTable._ids[path] = id
+        return id
+
+    def get_path(id):
+        return FileTable._paths[id]
+
+    # split "<path>:<line>:<column>" into path, line and column
+    # line and column are None if the source does not contain them
+    def split_source(source):
+        parts = source.rsplit(':', 2)
+        if len(parts)==3:
+            try:
+                return (parts[0], int(parts[1]), int(parts[2]))
+            except ValueError:
+                pass
+        return (source, None, None)
+
+    def format_source(id, line, column):
+        if line==None:
+            return FileTable._paths[id]
+        return '%s:%d:%u' % (FileTable._paths[id], line, column)
+
+    # location: (type, file id, line, column)
+    def format_location(location):
+        return '%s:%s' % (location[0], FileTable.format_source(*location[1:]))
+
+    # sort locations by type, path, line and column
+    def get_location_sort_key(location):
+        return (str(location[0]), FileTable._paths[location[1]], location[2] or 0, location[3] or 0)
@@ -2,22 +2,55 @@
 # Author: sascha_lammers@gmx.de
 #
 
+import importlib
+from .types import CompressionType
 
 # detect compression format by file extension
+#
+# compressed files are read and written as stream. level is the compression level for writing
+# files, None for the default of the codec
 class FileWrapper(object):
+
+    # module and name of the keyword argument for the compression level
+    CODECS = {
+        CompressionType.LZMA: ('lzma', 'preset'),
+        CompressionType.GZIP: ('gzip', 'compresslevel'),
+        CompressionType.BZ2: ('bz2', 'compresslevel'),
+        CompressionType.ZSTD: ('zstandard', None),
+        CompressionType.LZ4: ('lz4.frame', 'compression_level')
+    }
+
     def __init__(self, file, filename, mode, is_open=True):
         self._file = file
         self._filename = filename
         self._mode = mode
         self._is_open = is_open
 
-    def open(filename, mode):
-        if filename.lower().endswith('.xz'):
-            module = 'lzma'
-        else:
-            module = 'builtins'
-        module = __import__(module)
-        return FileWrapper(getattr(module, 'open')(filename, mode), filename, mode, True)
+    def _get_module(type):
+        return importlib.import_module(FileWrapper.CODECS[type][0])
+
+    # returns False if the module of the codec cannot be imported
+    def is_available(type):
+        if type==CompressionType.NONE:
+            return True
+        try:
+            FileWrapper._get_module(type)
+        except ImportError:
+            return False
+        return True
+
+    def open(filename, mode, level=None):
+        type = CompressionType.fromFilename(filename)
+        if type==CompressionType.NONE:
+            return FileWrapper(open(filename, mode), filename, mode, True)
+        module = FileWrapper._get_module(type)
+        kwargs = {}
+        if level!=None and ('w' in mode or 'a' in mode or 'x' in mode):
+            if type==CompressionType.ZSTD:
+                kwargs['cctx'] = module.ZstdCompressor(level=level)
+            else:
+                kwargs[FileWrapper.CODECS[type][1]] = level
+        return FileWrapper(module.open(filename, mode, **kwargs), filename, mode, True)
 
     def __enter__(self):
         return object.__getattribute__(self, '_file')
@@ -0,0 +1,174 @@
+#
+# Author: sascha_lammers@gmx.de
+#
+
+import os
+import sys
+import stat
+import time
+import pickle
+import atexit
+import hashlib
+import threading
+from os import path
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+# content based fingerprints of files
+#
+# the digest of each file is stored with its inode, modification time and size in
+# build_database_dir/fingerprints.pickle. files are read and hashed again only if
+# the result of os.stat() changes
+class Fingerprint(object):
+
+    # increase to discard existing caches if the format changes
+    VERSION = 2
+
+    # use a thread pool to stat the files if the list is longer
+    PARALLEL_STAT_MIN_FILES = 64
+
+    # files modified within this time are hashed but not cached. the modification time
+    # might not change if the file is modified again within the resolution of the file system
+    RACY_MTIME_NS = 2 * 1000000000
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, dir):
+        self._dir = dir
+        self._file = path.join(dir, 'fingerprints.pickle')
+        self._lock = threading.Lock()
+        # realpath: (st_ino, st_mtime_ns, st_size, digest)
+        self._files = None # type: Dict[str, tuple]
+        # name: {digest: verdict}
+        self._verdicts = None # type: Dict[str, Dict[str, object]]
+        self._modified = False
+
+    # get shared instance for the database directory
+    def get_instance(dir):
+        dir = path.abspath(dir)
+        with Fingerprint._instances_lock:
+            if not dir in Fingerprint._instances:
+                instance = Fingerprint(dir)
+                Fingerprint._instances[dir] = instance
+                atexit.register(instance.write)
+            return Fingerprint._instances[dir]
+
+    # create digest of the file contents
+    def hash_file(filename):
+        digest = hashlib.blake2b(digest_size=16)
+        with open(filename, 'rb') as file:
+            while True:
+                data = file.read(1 << 16)
+                if not data:
+                    break
+                digest.update(data)
+        return digest.hexdigest()
+
+    # create digest of bytes or str
+    def hash_data(data):
+        if isinstance(data, str):
+            data = data.encode()
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+    def _load(self):
+        if self._files!=None:
+            return
+        self._files = {}
+        self._verdicts = {}
+        try:
+            with open(self._file, 'rb') as file:
+                data = pickle.load(file)
+            if data['version']==Fingerprint.VERSION:
+                self._files = data['files']
+                self._verdicts = data['verdicts']
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print('failed to read %s: %s' % (self._file, e), file=sys.stderr)
+
+    # store cache if it has been modified. the file is replaced atomically
+    def write(self):
+        with self._lock:
+            if not self._modified:
+                return
+            try:
+                os.makedirs(self._dir, exist_ok=True)
+                tmp_file = '%s.%u.tmp' % (self._file, os.getpid())
+                # remove verdicts for contents that does not exist anymore
+                digests = set([entry[3] for entry in self._files.values()])
+                for name, verdicts in self._verdicts.items():
+                    self._verdicts[name] = {digest: verdict for digest, verdict in verdicts.items() if digest in digests}
+                with open(tmp_file, 'wb') as file:
+                    pickle.dump({'version': Fingerprint.VERSION, 'files': self._files, 'verdicts': self._verdicts}, file)
+                os.replace(tmp_file, self._file)
+                self._modified = False
+            except Exception as e:
+                print('failed to write %s: %s' % (self._file, e), file=sys.stderr)
+
+    def _stat(file):
+        file = path.realpath(file)
+        try:
+            return (file, os.stat(file))
+        except OSError:
+            return (file, None)
+
+    def _get_digest(self, file, st):
+        if st==None or not stat.S_ISREG(st.st_mode):
+            return None
+        with self._lock:
+            self._load()
+            entry = self._files.get(file, None)
+        if entry!=None and entry[0:3]==(st.st_ino, st.st_mtime_ns, st.st_size):
+            return entry[3]
+        digest = Fingerprint.hash_file(file)
+        if time.time_ns() - st.st_mtime_ns > Fingerprint.RACY_MTIME_NS:
+            with self._lock:
+                self._files[file] = (st.st_ino, st.st_mtime_ns, st.st_size, digest)
+                self._modified = True
+        return digest
+
+    # returns the digest of the file contents or None if the file does not exist
+    def get_digest(self, file):
+        return self._get_digest(*Fingerprint._stat(file))
+
+    # store the digest of a file that has just been replaced by renaming a new file
+    # the modification time is not checked, each replacement gets a new inode
+    def set_digest(self, file, digest):
+        file, st = Fingerprint._stat(file)
+        if st==None:
+            return
+        with self._lock:
+            self._load()
+            self._files[file] = (st.st_ino, st.st_mtime_ns, st.st_size, digest)
+            self._modified = True
+
+    # returns a dictionary with the realpath of the files and their digest
+    def get_digests(self, files: List[str]) -> Dict[str, str]:
+        if len(files)>=Fingerprint.PARALLEL_STAT_MIN_FILES:
+            with ThreadPoolExecutor() as executor:
+                stats = list(executor.map(Fingerprint._stat, files))
+        else:
+            stats = [Fingerprint._stat(file) for file in files]
+        return {file: self._get_digest(file, st) for file, st in stats}
+
+    # create a hash for a list of files
+    def get_hash(self, files: List[str]):
+        digests = sorted([(file, digest or '-') for file, digest in self.get_digests(files).items()])
+        return Fingerprint.hash_data(repr(digests))
+
+    # returns the cached result of func(file) for the current contents of the file
+    # name is an unique identifier for func and its arguments
+    def get_verdict(self, file, name, func):
+        digest = self.get_digest(file)
+        if digest==None:
+            return func(file)
+        with self._lock:
+            verdicts = self._verdicts.setdefault(name, {})
+            if digest in verdicts:
+                return verdicts[digest]
+        verdict = func(file)
+        with self._lock:
+            verdicts[digest] = verdict
+            self._modified = True
+        return verdict
@@ -0,0 +1,97 @@
+#
+# Author: sascha_lammers@gmx.de
+#
+
+import os
+import sys
+import pickle
+import atexit
+import threading
+from os import path
+from typing import Dict, Set
+
+# rendered fragments of the output files
+#
+# each fragment is stored with the name, value and locations of the item and the options that
+# were used to render it in build_database_dir/fragments.pickle. only items with modified
+# inputs are rendered again. fragments of a kind that has been rendered are removed if they
+# have not been used by this process
+class FragmentCache(object):
+
+    # increase to discard existing caches if the format changes
+    VERSION = 1
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, dir):
+        self._dir = dir
+        self._file = path.join(dir, 'fragments.pickle')
+        self._lock = threading.Lock()
+        # key: fragment
+        self._fragments = None # type: Dict[tuple, str]
+        # keys used by this process
+        self._used = set() # type: Set[tuple]
+        # kinds of fragments rendered by this process
+        self._kinds = set() # type: Set[str]
+        self._modified = False
+
+    # get shared instance for the database directory
+    def get_instance(dir):
+        dir = path.abspath(dir)
+        with FragmentCache._instances_lock:
+            if not dir in FragmentCache._instances:
+                instance = FragmentCache(dir)
+                FragmentCache._instances[dir] = instance
+                atexit.register(instance.write)
+            return FragmentCache._instances[dir]
+
+    def _load(self):
+        if self._fragments!=None:
+            return
+        self._fragments = {}
+        try:
+            with open(self._file, 'rb') as file:
+                data = pickle.load(file)
+            if data['version']==FragmentCache.VERSION:
+                self._fragments = data['fragments']
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print('failed to read %s: %s' % (self._file, e), file=sys.stderr)
+
+    # store cache if it has been modified. the file is replaced atomically
+    def write(self):
+        with self._lock:
+            if self._fragments==None:
+                return
+            # remove fragments of items that do not exist anymore
+            for key in [key for key in self._fragments.keys() if key[0] in self._kinds and not key in self._used]:
+                del self._fragments[key]
+                self._modified = True
+            if not self._modified:
+                return
+            try:
+                os.makedirs(self._dir, exist_ok=True)
+                tmp_file = '%s.%u.tmp' % (self._file, os.getpid())
+                with open(tmp_file, 'wb') as file:
+                    pickle.dump({'version': FragmentCache.VERSION, 'fragments': self._fragments}, file, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_file, self._file)
+                self._modified = False
+            except Exception as e:
+                print('failed to write %s: %s' % (self._file, e), file=sys.stderr)
+
+    # returns the fragment for the key or the result of render(), which is stored in the cache
+    # key[0] is the kind of the fragment. the key must contain all inputs of render()
+    def get(self, key, render):
+        with self._lock:
+            self._load()
+            self._kinds.add(key[0])
+            self._used.add(key)
+            fragment = self._fragments.get(key, None)
+        if fragment==None:
+            fragment = render()
+            with self._lock:
+                self._fragments[key] = fragment
+                self._modified = True
+        return fragment
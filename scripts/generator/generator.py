@@ -6,16 +6,21 @@ try:
     from ..spgm_extra_script import SpgmExtraScript
 except:
     pass
-from io import TextIOWrapper
+from io import TextIOWrapper, StringIO, BytesIO
 try:
     from SCons.Node import FS
 except:
     pass
+import os
 import re
 import pickle
+import threading
+from os import path
 from .item import Item
 from .config import SpgmConfig
-from .database2 import Database
+from .fingerprint import Fingerprint
+from .database2 import Database, DatabaseHelpers
+from .fragment_cache import FragmentCache
 import generator
 from typing import List, Dict
 
@@ -49,11 +54,20 @@ class Generator(object):
         self._language = {'default': 'default'} # type: Dict[str, List[str]]
         self._database = Database(self, target)
         self._database._target = target[0].get_path()
+        self._fragments = FragmentCache.get_instance(config.build_database_dir)
 
 
     def read_database(self):
         self._database.read();
 
+    # read the database again if it has been modified since the last read
+    # returns True if it has been read
+    def update_database(self):
+        if self._database.is_modified():
+            self._database.read()
+            return True
+        return False
+
     # add items from preprocessor
     # gen.copy_to_database(fcpp.items)
     def copy_to_database(self, items):
@@ -88,6 +102,21 @@ class Generator(object):
                 lre = re.sub('[_-]', '[_-]', lang.replace('*', '.*')) + r'\Z'
             self._language[lang] = lre
 
+    # get rendered output for an item from the cache
+    # write(file, item) is called to render the fragment if the name, value or locations of the item have changed
+    def get_fragment(self, kind, item, write):
+        key = (kind, item.name, self._database.get_item_value(item), self._database.get_locations_key(item), self.config.locations_one_per_line)
+        def render():
+            file = StringIO()
+            write(file, item)
+            return file.getvalue()
+        return self._fragments.get(key, render)
+
+    # encode the values of the items in a single pass before the fragments are rendered. the
+    # literals are memoized and used by write_define() and write_auto_init()
+    def encode_values(self, items):
+        DatabaseHelpers.encode_literals([self._database.get_display_value(item) for item in items])
+
     def write_header_comment(self, file: TextIOWrapper):
         print("// AUTO GENERATED FILE - DO NOT MODIFY", file=file)
 
@@ -104,67 +133,108 @@ class Generator(object):
             '#endif\n'
         ]);
 
+    # render an output file to memory and replace it only if the contents has changed
+    # write(file) renders the contents. the encoding and line endings are the same as for open(filename, 'wt')
+    # returns True if the file has been written
+    def write_output_file(self, filename, write):
+        buffer = BytesIO()
+        file = TextIOWrapper(buffer)
+        write(file)
+        file.flush()
+        data = buffer.getvalue()
+
+        # the digest of the existing file is cached by its inode, modification time and size
+        fingerprint = self._database.fingerprint
+        digest = Fingerprint.hash_data(data)
+        if fingerprint.get_digest(filename)==digest:
+            return False
+
+        try:
+            os.makedirs(path.dirname(path.abspath(filename)), exist_ok=True)
+            tmp_file = '%s.%u.%u.tmp' % (filename, os.getpid(), threading.get_ident())
+            try:
+                with open(tmp_file, 'wb') as out:
+                    out.write(data)
+                os.replace(tmp_file, filename)
+            finally:
+                if path.isfile(tmp_file):
+                    os.unlink(tmp_file)
+        except OSError as e:
+            raise RuntimeError("cannot create %s: %s" % (filename, e))
+        fingerprint.set_digest(filename, digest)
+        return True
+
     # create declarations header
     # default: spgm_auto_strings.h
     def create_output_header(self, filename, extra_includes=None):
         if extra_includes and isinstance(extra_includes, str):
             extra_includes = [extra_includes]
 
-        try:
-            with open(filename, 'wt') as file:
-                self.write_header_comment(file)
-                self.write_header_start(file, extra_includes)
-                for item in self._database.get_items().values():
-                    if self.config.add_unused or self._database.is_used(item):
-                        self._database.write_locations(file, item)
-                        file.write('PROGMEM_STRING_DECL(%s);\n' % (item.name))
-                file.writelines([
-                    '#ifdef __cplusplus\n',
-                    '} // extern "C"\n',
-                    '#endif\n'
-                ])
-        except OSError as e:
-            raise RuntimeError("cannot create %s: %s" % (filename, e))
+        def write_header(file):
+            self.write_header_comment(file)
+            self.write_header_start(file, extra_includes)
+            def write(file, item):
+                self._database.write_locations(file, item)
+                file.write('PROGMEM_STRING_DECL(%s);\n' % (item.name))
+            fragments = []
+            for item in self._database.get_items().values():
+                if self.config.add_unused or self._database.is_used(item):
+                    fragments.append(self.get_fragment('declaration', item, write))
+            file.write(''.join(fragments))
+            file.writelines([
+                '#ifdef __cplusplus\n',
+                '} // extern "C"\n',
+                '#endif\n'
+            ])
+
+        self.write_output_file(filename, write_header)
 
     # create defintions for the strings
     # default: spgm_auto_strings.cpp
     def create_output_define(self, filename):
-        try:
-            with open(filename, 'wt') as file:
-                self.write_header_comment(file)
-                print('#include "spgm_auto_strings.h"', file=file)
-                values = self._database.get_items().values()
-                for item in values:
-                    if self.config.add_unused or self._database.is_used(item):
-                        self._database.write_define(file, item)
-                return len(values)
-        except OSError as e:
-            raise RuntimeError("cannot create %s: %s" % (filename, e))
-        return 0
+        values = self._database.get_items().values()
+
+        def write_define(file):
+            self.write_header_comment(file)
+            print('#include "spgm_auto_strings.h"', file=file)
+            items = [item for item in values if self.config.add_unused or self._database.is_used(item)]
+            self.encode_values(items)
+            fragments = []
+            for item in items:
+                fragments.append(self.get_fragment('definition', item, self._database.write_define))
+            file.write(''.join(fragments))
+
+        self.write_output_file(filename, write_define)
+        return len(values)
 
     # create a list of statically defined strings
     # default: spgm_static_strings.h
     def create_output_static(self, filename):
-        try:
-            with open(filename, 'wt') as file:
-                self.write_header_comment(file)
-                print('#include <spgm_string_generator.h>', file=file)
-                for item in self._database.get_static_items().values():
-                    self._database.write_define(file, item, True)
-        except OSError as e:
-            raise RuntimeError("cannot create %s: %s" % (filename, e))
+        def write_static(file):
+            self.write_header_comment(file)
+            print('#include <spgm_string_generator.h>', file=file)
+            items = self._database.get_static_items().values()
+            self.encode_values(items)
+            fragments = []
+            for item in items:
+                fragments.append(self.get_fragment('static', item, lambda file, item: self._database.write_define(file, item, True)))
+            file.write(''.join(fragments))
+
+        self.write_output_file(filename, write_static)
 
     # create a list of automatically defined strings
     # default: spgm_auto_defined.h
     def create_output_auto_defined(self, filename):
-        try:
-            with open(filename, 'wt') as file:
-                self.write_header_comment(file)
-                print('#include <spgm_string_generator.h>', file=file)
-                print('FLASH_STRING_GENERATOR_AUTO_INIT(', file=file)
-                for item in self._database.get_items().values():
-                    if not item.has_value:
-                        self._database.write_auto_init(file, item)
-                print(')', file=file)
-        except OSError as e:
-            raise RuntimeError("cannot create %s: %s" % (filename, e))
+        def write_auto_defined(file):
+            self.write_header_comment(file)
+            print('#include <spgm_string_generator.h>', file=file)
+            print('FLASH_STRING_GENERATOR_AUTO_INIT(', file=file)
+            items = [item for item in self._database.get_items().values() if not self._database.has_value(item)]
+            self.encode_values(items)
+            fragments = []
+            for item in items:
+                fragments.append(self.get_fragment('auto_init', item, self._database.write_auto_init))
+            file.write(''.join(fragments))
+            print(')', file=file)
+
+        self.write_output_file(filename, write_auto_defined)
@@ -0,0 +1,303 @@
+#
+# Author: sascha_lammers@gmx.de
+#
+
+import os
+import re
+import sys
+import json
+import pickle
+import hashlib
+import atexit
+import threading
+from os import path
+from .fingerprint import Fingerprint
+from typing import Dict, List, Set
+
+# index of headers that are not relevant for the string generator
+#
+# for each file that has been preprocessed, the identifiers, the macros it defines and its includes are
+# stored in build_database_dir/header_index.pickle. a header can be skipped if
+#
+#   - neither the header nor any file it includes uses a string macro or a macro that expands to a string macro
+#   - none of the files defines a macro that is used by a relevant file or by the macros of a relevant file
+#   - all files have been indexed with their current contents and none of the includes is created by a macro
+#   - every include inside a conditional block resolves to an indexed file
+#
+# the index is only valid for a single preprocessor configuration. unconditional includes that have never
+# been opened are ignored, since they have not been found with this configuration. conditional includes
+# depend on macros defined by the translation unit and cannot be ignored
+class HeaderIndex(object):
+
+    # increase to discard existing indexes if the format changes
+    VERSION = 2
+
+    STRING_MACROS = frozenset(['SPGM', 'FSPGM', 'AUTO_STRING_DEF', 'PROGMEM_STRING_DEF', 'AUTO_INIT_SPGM'])
+
+    ID_RE = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+    DEFINE_RE = re.compile(r'^[ \t]*#[ \t]*(?:define|undef)[ \t]+([A-Za-z_][A-Za-z0-9_]*)(.*)$', re.M)
+    DIRECTIVE_RE = re.compile(r'^[ \t]*#[ \t]*([A-Za-z_]+)(.*)$', re.M)
+    INCLUDE_RE = re.compile(r'[ \t]*(?:<([^>\n]+)>|"([^"\n]+)"|(.*))$')
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, dir, key):
+        self._dir = dir
+        self._file = path.join(dir, 'header_index.pickle')
+        self._key = key
+        self._lock = threading.RLock()
+        self._fingerprint = Fingerprint.get_instance(dir)
+        # realpath: entry
+        self._files = None # type: Dict[str, dict]
+        self._modified = set()
+        self._relevant = None # type: Set[str]
+        self._by_basename = None # type: Dict[str, List[str]]
+        self._prunable = {}
+        self._valid = {}
+        # files modified since the relevance has been updated
+        self._pending = set()
+        # files skipped and files with modified contents in the current translation unit
+        self._pruned = set()
+        self._changed = False
+
+    def get_key(config, pcpp_version):
+        return hashlib.md5(json.dumps([
+            HeaderIndex.VERSION,
+            pcpp_version,
+            config['defines'],
+            config['pcpp_defines'],
+            config['include_dirs'],
+            config['skip_includes']
+        ]).encode()).digest().hex()
+
+    # get shared instance for the database directory and the preprocessor configuration
+    def get_instance(dir, key):
+        dir = path.abspath(dir)
+        with HeaderIndex._instances_lock:
+            if not (dir, key) in HeaderIndex._instances:
+                instance = HeaderIndex(dir, key)
+                HeaderIndex._instances[(dir, key)] = instance
+                atexit.register(instance.write)
+            return HeaderIndex._instances[(dir, key)]
+
+    def _read(self):
+        try:
+            with open(self._file, 'rb') as file:
+                data = pickle.load(file)
+            if data['version']==HeaderIndex.VERSION and data['key']==self._key:
+                return data['files']
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print('failed to read %s: %s' % (self._file, e), file=sys.stderr)
+        return {}
+
+    def _load(self):
+        if self._files==None:
+            self._files = self._read()
+
+    # store modified entries. the index is merged with the current file that might have been
+    # modified by another process and replaced atomically
+    def write(self):
+        with self._lock:
+            if not self._modified:
+                return
+            try:
+                files = self._read()
+                for file in self._modified:
+                    if file in self._files:
+                        files[file] = self._files[file]
+                os.makedirs(self._dir, exist_ok=True)
+                tmp_file = '%s.%u.tmp' % (self._file, os.getpid())
+                with open(tmp_file, 'wb') as file:
+                    pickle.dump({'version': HeaderIndex.VERSION, 'key': self._key, 'files': files}, file, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_file, self._file)
+                self._modified = set()
+            except Exception as e:
+                print('failed to write %s: %s' % (self._file, e), file=sys.stderr)
+
+    # start a new translation unit
+    # the relevance is updated if any files have been modified during the previous one
+    def reset(self):
+        with self._lock:
+            self._valid = {}
+            self._pruned = set()
+            self._changed = False
+            if self._pending:
+                self._pending = set()
+                self._relevant = None
+                self._by_basename = None
+                self._prunable = {}
+
+    # index the contents of a file if it is not indexed or has been modified
+    def update(self, file, text):
+        digest = self._fingerprint.get_digest(file)
+        if digest==None:
+            return
+        file = path.realpath(file)
+        with self._lock:
+            self._load()
+            if file in self._files and self._files[file]['digest']==digest:
+                return
+        text = text.replace('\\\n', ' ')
+        defines = {}
+        for m in HeaderIndex.DEFINE_RE.finditer(text):
+            defines[m.group(1)] = frozenset(HeaderIndex.ID_RE.findall(m.group(2)))
+        includes = []
+        conditional = []
+        macro_include = False
+        # True for an include guard, False for any other conditional block
+        blocks = []
+        guard = None
+        for n, m in enumerate(HeaderIndex.DIRECTIVE_RE.finditer(text)):
+            directive = m.group(1)
+            arg = m.group(2).strip()
+            if directive in ('if', 'ifdef', 'ifndef'):
+                blocks.append(False)
+                if n==0 and directive=='ifndef':
+                    guard = HeaderIndex.ID_RE.match(arg)
+            elif directive=='endif':
+                if blocks:
+                    blocks.pop()
+            elif directive=='define':
+                # #ifndef NAME followed by #define NAME
+                name = HeaderIndex.ID_RE.match(arg)
+                if n==1 and guard and name and name.group(0)==guard.group(0) and blocks:
+                    blocks[0] = True
+            elif directive in ('include', 'include_next'):
+                m = HeaderIndex.INCLUDE_RE.match(m.group(2))
+                name = m.group(1) or m.group(2)
+                if name:
+                    name = path.normpath(name.strip())
+                    includes.append(name)
+                    if False in blocks:
+                        conditional.append(name)
+                elif m.group(3).strip():
+                    macro_include = True
+        entry = {
+            'digest': digest,
+            'ids': frozenset(HeaderIndex.ID_RE.findall(text)),
+            'defines': defines,
+            'includes': includes,
+            'conditional': conditional,
+            'macro_include': macro_include,
+            'opened': set()
+        }
+        with self._lock:
+            self._files[file] = entry
+            self._modified.add(file)
+            self._pending.add(file)
+            self._changed = True
+
+    # add file that has been opened by an include in parent
+    def add_include(self, parent, file):
+        parent = path.realpath(parent)
+        file = path.realpath(file)
+        with self._lock:
+            self._load()
+            if parent in self._files and not file in self._files[parent]['opened']:
+                self._files[parent]['opened'].add(file)
+                self._modified.add(parent)
+                self._pending.add(parent)
+
+    def _update_relevance(self):
+        if self._relevant!=None:
+            return
+        # macros that expand to string macros
+        string_macros = set(HeaderIndex.STRING_MACROS)
+        changed = True
+        while changed:
+            changed = False
+            for entry in self._files.values():
+                for name, ids in entry['defines'].items():
+                    if not name in string_macros and not ids.isdisjoint(string_macros):
+                        string_macros.add(name)
+                        changed = True
+        # files using them and files defining macros that are used by relevant files
+        relevant = set()
+        needed = set()
+        for file, entry in self._files.items():
+            if not entry['ids'].isdisjoint(string_macros):
+                relevant.add(file)
+                needed |= entry['ids']
+        changed = True
+        while changed:
+            changed = False
+            for file, entry in self._files.items():
+                if not file in relevant and not needed.isdisjoint(entry['defines'].keys()):
+                    relevant.add(file)
+                    needed |= entry['ids']
+                    changed = True
+        self._relevant = relevant
+        self._by_basename = {}
+        for file in self._files.keys():
+            self._by_basename.setdefault(path.basename(file), []).append(file)
+
+    # indexed files matching the name of an include
+    def _resolve(self, name):
+        return [file for file in self._by_basename.get(path.basename(name), []) if file.endswith(os.sep + name) or file==name]
+
+    # returns the indexed files of all includes or None if a conditional include cannot be resolved
+    def _get_includes(self, entry):
+        files = set(entry['opened'])
+        for name in entry['includes']:
+            files.update(self._resolve(name))
+        for name in entry['conditional']:
+            if not self._resolve(name):
+                return None
+        return files
+
+    # returns the file and all files it includes or None if the file is relevant, unknown or has conditional
+    # includes that have not been indexed
+    def _get_closure(self, file):
+        closure = set()
+        stack = [file]
+        while stack:
+            file = stack.pop()
+            if file in closure:
+                continue
+            if not file in self._files or file in self._relevant or file in self._pending:
+                return None
+            entry = self._files[file]
+            if entry['macro_include']:
+                return None
+            includes = self._get_includes(entry)
+            if includes==None:
+                return None
+            closure.add(file)
+            stack.extend(includes)
+        return closure
+
+    # check if the indexed contents of the file is still valid
+    def _is_valid(self, file):
+        if not file in self._valid:
+            self._valid[file] = self._fingerprint.get_digest(file)==self._files[file]['digest']
+        return self._valid[file]
+
+    # returns a list of files if the file can be skipped, otherwise None
+    # the files should be added to the dependencies of the target
+    def get_prunable(self, file):
+        file = path.realpath(file)
+        with self._lock:
+            self._load()
+            if not file in self._files:
+                return None
+            self._update_relevance()
+            if not file in self._prunable:
+                self._prunable[file] = self._get_closure(file)
+            closure = self._prunable[file]
+            if closure==None:
+                return None
+            for include in closure:
+                if include in self._pending or not self._is_valid(include):
+                    return None
+            self._pruned.add(file)
+            return sorted(closure)
+
+    # returns False if headers have been skipped in the current translation unit and the contents of
+    # any file has been modified. the modified file might use macros of a skipped header and the
+    # translation unit must be processed again without skipping headers
+    def is_pruning_valid(self):
+        with self._lock:
+            return not (self._pruned and self._changed)
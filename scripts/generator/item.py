@@ -174,6 +174,20 @@ class Item(SourceLocation):
 
 
 
+    # add token of the macro arguments
+    def append_token(self, type, value):
+        if type=='CPP_STRING':
+            self.append_value_buffer(value[1:-1])
+        elif (type=='CPP_DOT' and value=='=') or type=='CPP_EQUAL':
+            self.push_value()
+        elif (type=='CPP_DOT' and value==',') or type=='CPP_COMMA':
+            self.push_value()
+        elif (type=='CPP_DOT' and value==':') or type=='CPP_COLON':
+            # assign lanuage
+            self.push_value()
+        elif type in ['CPP_ID', 'CPP_MINUS', 'CPP_DOT', 'CPP_SEMICOLON']:
+            self.append_value_buffer(value)
+
     def validate(self):
         if self.name==None:
             raise RuntimeError('Name/id missing: %s' % (self))
@@ -189,6 +203,23 @@ class Item(SourceLocation):
                 res += ' source=%s' % self._lineno.value
         return res
 
+    # convert items to the format stored in the database
+    def get_database_items(items):
+        result = []
+        for item in items:
+            for location in item.locations:
+                item_out = {
+                    'source': item.source_str,
+                    'name': item.name,
+                    'type': str(location.definition_type),
+                    'value': item._value,
+                    'auto': item._value,
+                    'data': item._data
+                    # 'i18n': item.i18n.translations
+                }
+                result.append(item_out)
+        return result
+
     # cleanup object before storing
     def cleanup(self):
         del self._lang
@@ -0,0 +1,445 @@
+#
+# Author: sascha_lammers@gmx.de
+#
+
+import os
+import re
+import fnmatch
+import threading
+from os import path
+from .item import Item
+from .types import DefinitionType
+from .fingerprint import Fingerprint
+from typing import Dict, List, Set
+
+# exception raised if a translation unit requires the preprocessor
+class LexicalFallback(Exception):
+    pass
+
+# invocation of a string macro found by the scanner
+class LexicalInvocation(object):
+    def __init__(self, definition_type, lineno, column, tokens, ids, conditional, error):
+        self.definition_type = definition_type
+        self.lineno = lineno
+        self.column = column
+        # (type, value) tuples of the expanded arguments, using the pcpp token types
+        self.tokens = tokens
+        # identifiers that would change the result if they are defined as macros
+        self.ids = ids
+        self.conditional = conditional
+        self.error = error
+
+# result of scanning a single file
+class LexicalScan(object):
+    def __init__(self):
+        # ('include', name, is_system_include, conditional) or ('invocation', LexicalInvocation)
+        self.events = []
+        # name: identifiers of the macro body
+        self.defines = {}
+        # identifiers outside of directives
+        self.ids = set()
+        self.guard = None
+        self.once = False
+        self.error = None
+
+# extract strings from source files without preprocessing them
+#
+# the files are tokenized like the pcpp lexer does and the string macros are read directly from
+# the tokens. the includes are followed using the same search paths as the preprocessor. the
+# result is identical to SpgmPreprocessor.find_strings() for any translation unit that does not
+# raise LexicalFallback, which is raised if the strings depend on the preprocessor
+#
+#   - a string macro is used inside a conditional block or in a file that is included conditionally
+#   - the name or arguments of a string macro contain macros, nested parentheses or anything else than strings and languages
+#   - a macro that expands to a string macro is used
+#   - a macro is used on the same line before a string macro or the string macro is an argument of a macro
+#   - more than one string macro is used on a single line or comments and line continuations change the location
+#   - an include is created by a macro
+class LexicalExtractor(object):
+
+    STRING_MACROS = {
+        'SPGM': DefinitionType.SPGM,
+        'FSPGM': DefinitionType.SPGM,
+        'PROGMEM_STRING_DEF': DefinitionType.DEFINE,
+        'AUTO_STRING_DEF': DefinitionType.AUTO_INIT,
+        'AUTO_INIT_SPGM': DefinitionType.AUTO_INIT
+    }
+
+    # minimum and maximum number of arguments
+    STRING_MACRO_ARGS = {
+        'PROGMEM_STRING_DEF': (2, 2),
+        'AUTO_STRING_DEF': (2, None)
+    }
+
+    # macros defined by pcpp and SpgmPreprocessor
+    BUILTIN_MACROS = frozenset(['__FILE__', '__LINE__', '__DATE__', '__TIME__', '__COUNTER__', '__PCPP__', 'FLASH_STRINGS_AUTO_INIT'])
+
+    # the same tokens as the pcpp lexer, all other operators have the same length if split into single characters
+    TOKEN_RE = re.compile(r'''
+        (?P<nl>\n)
+        |(?P<ws>[ \t]+)
+        |(?P<cont>\\[ \t]*\n)
+        |(?P<string>"(?:[^\\\n]|\\(?:.|\n))*?")
+        |(?P<char>L?'(?:[^\\\n]|\\(?:.|\n))*?')
+        |(?P<comment>/\*(?:.|\n)*?\*/|//[^\n]*)
+        |(?P<id>[A-Za-z_][\w_]*)
+        |(?P<number>\d+)
+        |(?P<punct>.)
+    ''', re.X)
+
+    TRIGRAPH_RE = re.compile(r'''\?\?[=/\'\(\)\!<>\-]''')
+    TRIGRAPHS = {'=': '#', '/': '\\', "'": '^', '(': '[', ')': ']', '!': '|', '<': '{', '>': '}', '-': '~'}
+
+    # tokens that are passed to Item.append_token()
+    ARG_TOKENS = {',': 'CPP_COMMA', ':': 'CPP_COLON', ';': 'CPP_SEMICOLON', '-': 'CPP_MINUS', '.': 'CPP_DOT'}
+
+    MAX_INCLUDE_DEPTH = 200
+
+    ID_RE = re.compile(r'[A-Za-z_][\w_]*')
+
+    def __init__(self, config):
+        self._paths = list(config['include_dirs'])
+        self._skip_includes = list(config['skip_includes'])
+        self._macros = set(LexicalExtractor.BUILTIN_MACROS)
+        # name: identifiers of the value of the defines of the configuration
+        self._defines = {}
+        for define, value in config['defines'] + config['pcpp_defines']:
+            name = re.split(r'[\s(]', define.strip(), 1)[0]
+            self._macros.add(name)
+            if not name in LexicalExtractor.STRING_MACROS:
+                self._defines[name] = self._defines.get(name, frozenset()) | frozenset(LexicalExtractor.ID_RE.findall(str(value)))
+        # same order as pcpp: current directory first, then the include paths
+        self._rewrite_paths = [(re.escape(path.abspath('') + os.sep) + '(.*)', '\\1')]
+        for dir in self._paths:
+            try:
+                self._rewrite_paths.append((re.escape(path.abspath(dir) + os.sep) + '(.*)', path.join(path.relpath(dir), '\\1')))
+            except ValueError:
+                pass
+        self._fingerprint = Fingerprint.get_instance(config['build_database_dir'])
+        self._scans = {} # type: Dict[str, LexicalScan]
+        self._lock = threading.Lock()
+
+    # returns a list of items and a list of all files or raises LexicalFallback
+    def extract(self, files: List[str]):
+        state = {'files': [], 'once': set(), 'invocations': [], 'defines': dict(self._defines), 'ids': set()}
+        for file in files:
+            self._include(state, file, False, [], False, 0)
+
+        macros = self._macros | set(state['defines'].keys())
+
+        # macros that expand to string macros
+        aliases = set(LexicalExtractor.STRING_MACROS.keys())
+        changed = True
+        while changed:
+            changed = False
+            for name, ids in state['defines'].items():
+                if not name in aliases and not ids.isdisjoint(aliases):
+                    aliases.add(name)
+                    changed = True
+        aliases -= set(LexicalExtractor.STRING_MACROS.keys())
+        used = aliases & state['ids']
+        if used:
+            raise LexicalFallback('%s expands to a string macro' % ', '.join(sorted(used)))
+
+        items = []
+        for source, invocation in state['invocations']:
+            location = '%s:%u' % (source, invocation.lineno)
+            if invocation.error:
+                raise LexicalFallback('%s: %s' % (location, invocation.error))
+            if invocation.conditional:
+                raise LexicalFallback('%s: string inside conditional block' % location)
+            used = invocation.ids & macros
+            if used:
+                raise LexicalFallback('%s: depends on macro %s' % (location, ', '.join(sorted(used))))
+            item = Item(invocation.definition_type, source, invocation.lineno, column=invocation.column)
+            for type, value in invocation.tokens:
+                item.append_token(type, value)
+            if item.has_value_buffer:
+                item.push_value()
+            item.validate()
+            item.cleanup()
+            items.append(item)
+
+        return (items, state['files'])
+
+    # resolve include like Preprocessor.include()
+    def _include(self, state, name, is_system_include, temp_path, conditional, depth):
+        if is_system_include:
+            search_path = self._paths
+        else:
+            search_path = temp_path + self._paths
+        for dir in (search_path or ['']):
+            file = path.abspath(path.join(dir, name))
+            if file in state['once']:
+                return
+            if path.isfile(file):
+                for skip_include in self._skip_includes:
+                    if fnmatch.fnmatch(file, skip_include):
+                        return
+                self._process(state, file, temp_path, conditional, depth)
+                return
+
+    def _process(self, state, file, temp_path, conditional, depth):
+        if depth>LexicalExtractor.MAX_INCLUDE_DEPTH:
+            raise LexicalFallback('%s: maximum include depth exceeded' % file)
+        if not file in state['files']:
+            state['files'].append(file)
+        scan = self._get_scan(file)
+        if scan.error:
+            raise LexicalFallback('%s: %s' % (file, scan.error))
+        if scan.once or scan.guard:
+            state['once'].add(file)
+        # the contents are skipped if the include guard is already defined
+        if scan.guard and scan.guard in self._macros:
+            conditional = True
+        for name, ids in scan.defines.items():
+            state['defines'][name] = state['defines'].get(name, frozenset()) | ids
+        state['ids'] |= scan.ids
+        source = self._rewrite(file)
+        temp_path = [path.dirname(file)] + temp_path
+        for event in scan.events:
+            if event[0]=='include':
+                self._include(state, event[1], event[2], temp_path, conditional or event[3], depth + 1)
+            else:
+                invocation = event[1]
+                if conditional:
+                    invocation.conditional = True
+                state['invocations'].append((source, invocation))
+
+    # source name of the tokens created by pcpp
+    def _rewrite(self, file):
+        for pattern, replace in self._rewrite_paths:
+            source = re.sub(pattern, replace, file)
+            if source!=file:
+                if os.sep!='/':
+                    source = source.replace(os.sep, '/')
+                return source
+        return file
+
+    # the scan is stored for the contents of the file
+    # a copy of the invocations is returned since their state depends on the translation unit
+    def _get_scan(self, file):
+        digest = self._fingerprint.get_digest(file)
+        with self._lock:
+            scan = self._scans.get(digest, None)
+        if scan==None:
+            with open(file, 'rt', encoding='utf-8', errors='surrogateescape') as fh:
+                scan = self._scan(fh.read())
+            with self._lock:
+                self._scans[digest] = scan
+        copy = LexicalScan()
+        copy.__dict__.update(scan.__dict__)
+        copy.events = [event if event[0]=='include' else ('invocation', LexicalInvocation(**event[1].__dict__)) for event in scan.events]
+        return copy
+
+    def _tokenize(self, text):
+        text = '\n'.join([line.rstrip() for line in text.splitlines()])
+        text = LexicalExtractor.TRIGRAPH_RE.sub(lambda m: LexicalExtractor.TRIGRAPHS[m.group()[-1]], text)
+        tokens = []
+        lineno = 1
+        for m in LexicalExtractor.TOKEN_RE.finditer(text):
+            value = m.group()
+            tokens.append((m.lastgroup, value, lineno))
+            lineno += value.count('\n')
+        tokens.append(('nl', '\n', lineno))
+        return tokens
+
+    def _scan(self, text):
+        scan = LexicalScan()
+        tokens = self._tokenize(text)
+        # conditional blocks: [directive index, state] with the states live, cond and dead
+        conditions = []
+        directives = []
+        guard_endif = None
+        parens = []
+        # state of the current output line
+        line_start = True
+        line_lineno = 1
+        line_length = 0
+        line_ids = set()
+        line_parens = set()
+        line_invalid = False
+        line_invocations = 0
+
+        i = 0
+        count = len(tokens)
+        while i<count:
+            type, value, lineno = tokens[i]
+
+            if type=='nl':
+                line_start = True
+                line_lineno = lineno + 1
+                line_length = 0
+                line_ids = set()
+                line_parens = set([id for id in parens if id])
+                line_invalid = False
+                line_invocations = 0
+                i += 1
+                continue
+
+            if line_start and type=='punct' and value=='#':
+                # read directive until the end of the line
+                directive = []
+                i += 1
+                while tokens[i][0]!='nl':
+                    if tokens[i][0] in ('id', 'number', 'string', 'char', 'punct'):
+                        directive.append(tokens[i])
+                    i += 1
+                name = directive and directive[0][1] or ''
+                args = directive[1:]
+                dead = 'dead' in [state for index, state in conditions]
+                if name in ('if', 'ifdef', 'ifndef'):
+                    state = 'cond'
+                    if dead or (name=='if' and len(args)==1 and args[0][1]=='0'):
+                        state = 'dead'
+                    conditions.append([len(directives), state])
+                elif name in ('elif', 'else'):
+                    if conditions and conditions[-1][1]=='dead' and not 'dead' in [state for index, state in conditions[:-1]]:
+                        conditions[-1][1] = name=='else' and 'live' or 'cond'
+                    elif conditions and conditions[-1][1]=='live':
+                        conditions[-1][1] = 'dead'
+                elif name=='endif':
+                    if conditions:
+                        if conditions[-1][0]==0:
+                            guard_endif = len(directives)
+                        conditions.pop()
+                elif dead:
+                    pass
+                elif name=='define' and args and args[0][0]=='id':
+                    # the string macros are not modified by the preprocessor
+                    if not args[0][1] in LexicalExtractor.STRING_MACROS:
+                        scan.defines[args[0][1]] = scan.defines.get(args[0][1], frozenset()) | frozenset([value for type, value, lineno in args[1:] if type=='id'])
+                elif name=='include':
+                    if args and args[0][0]=='string':
+                        scan.events.append(('include', args[0][1][1:-1], False, list(conditions)))
+                    elif args and args[0][1]=='<' and '>' in [value for type, value, lineno in args]:
+                        filename = ''
+                        for type, value, lineno in args[1:]:
+                            if value=='>':
+                                break
+                            filename += value
+                        scan.events.append(('include', filename, True, list(conditions)))
+                    else:
+                        scan.error = 'include created by a macro'
+                elif name=='pragma' and args and args[0][1]=='once':
+                    scan.once = True
+                directives.append((name, args and args[0][1] or None))
+                continue
+
+            if type not in ('ws', 'comment', 'cont'):
+                line_start = False
+
+            if conditions and 'dead' in [state for index, state in conditions]:
+                i += 1
+                continue
+
+            if type=='id' and value in LexicalExtractor.STRING_MACROS:
+                j = i + 1
+                while j<count and tokens[j][0] in ('ws', 'comment'):
+                    j += 1
+                if j<count and tokens[j][1]=='(':
+                    invocation = self._scan_invocation(value, tokens, j, line_lineno, line_length + 1, line_ids | line_parens | set([id for id in parens if id]))
+                    if line_invalid:
+                        invocation.error = 'comment or line continuation before the string'
+                    elif line_invocations:
+                        invocation.error = 'multiple strings in one line'
+                    line_invocations += 1
+                    scan.events.append(('invocation', invocation, list(conditions)))
+                    i = invocation._end
+                    del invocation._end
+                    continue
+
+            if type=='id':
+                scan.ids.add(value)
+                line_ids.add(value)
+            elif type in ('comment', 'cont') or (type=='string' and '\n' in value):
+                line_invalid = True
+            elif value=='(':
+                parens.append(i>0 and tokens[i - 1][0]=='id' and tokens[i - 1][1] or None)
+            elif value==')':
+                if parens:
+                    parens.pop()
+            line_length += len(value)
+            i += 1
+
+        # include guard: #ifndef GUARD, #define GUARD and the matching #endif is the last directive
+        if len(directives)>=3 and directives[0][0]=='ifndef' and directives[1]==('define', directives[0][1]) and guard_endif==len(directives) - 1:
+            if not [True for event in scan.events if not event[-1] or event[-1][0][0]!=0]:
+                scan.guard = directives[0][1]
+
+        # blocks that are not removed by the preprocessor, except the include guard
+        events = []
+        for event in scan.events:
+            conditional = 'cond' in [state for index, state in event[-1] if not (scan.guard and index==0)]
+            if event[0]=='include':
+                events.append(('include', event[1], event[2], conditional))
+            else:
+                event[1].conditional = conditional
+                events.append(('invocation', event[1]))
+        scan.events = events
+        return scan
+
+    # read arguments of the string macro starting at the opening parenthesis
+    def _scan_invocation(self, macro, tokens, i, lineno, column, ids):
+        ids = set(ids)
+        error = None
+        args = [[]]
+        depth = 0
+        count = len(tokens)
+        i += 1
+        while True:
+            if i>=count:
+                error = 'unterminated argument list'
+                break
+            type, value, tok_lineno = tokens[i]
+            i += 1
+            if type=='punct' and value==')':
+                if depth==0:
+                    break
+                depth -= 1
+            elif type=='punct' and value=='(':
+                depth += 1
+                error = error or 'nested parentheses'
+            elif depth>0:
+                continue
+            elif type in ('ws', 'cont'):
+                pass
+            elif type=='nl':
+                j = i
+                while j<count and tokens[j][0]=='ws':
+                    j += 1
+                if j<count and tokens[j][1]=='#':
+                    error = error or 'directive inside the arguments'
+            elif type=='punct' and value==',':
+                args.append([])
+            elif type=='string' and not '\n' in value:
+                args[-1].append(('CPP_STRING', value))
+            elif type=='id':
+                ids.add(value)
+                args[-1].append(('CPP_ID', value))
+            elif type=='number' and len(args)==1:
+                args[-1].append(('CPP_INTEGER', value))
+            elif type=='punct' and value in LexicalExtractor.ARG_TOKENS and not (value=='-' and tokens[i][1] in '-=>'):
+                args[-1].append((LexicalExtractor.ARG_TOKENS[value], value))
+            else:
+                error = error or 'unsupported token %s' % value.strip()
+
+        min_args, max_args = LexicalExtractor.STRING_MACRO_ARGS.get(macro, (1, None))
+        if len(args)<min_args or (max_args!=None and len(args)>max_args):
+            error = error or 'invalid number of arguments'
+        elif len(args[0])!=1 or not args[0][0][0] in ('CPP_ID', 'CPP_INTEGER'):
+            error = error or 'invalid name'
+
+        # tokens of START(#name,__VA_ARGS__,END)
+        result = []
+        if not error:
+            result = [('CPP_STRING', '"%s"' % args[0][0][1]), ('CPP_COMMA', ',')]
+            for n, arg in enumerate(args[1:]):
+                if n:
+                    result.append(('CPP_COMMA', ','))
+                result.extend(arg)
+            result.append(('CPP_COMMA', ','))
+
+        invocation = LexicalInvocation(LexicalExtractor.STRING_MACROS[macro], lineno, column, result, ids, False, error)
+        invocation._end = i
+        return invocation
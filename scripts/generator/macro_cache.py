@@ -0,0 +1,106 @@
+#
+# Author: sascha_lammers@gmx.de
+#
+
+import os
+import sys
+import copy
+import json
+import pickle
+import hashlib
+from os import path
+
+# persistent cache for the macros of the preprocessor configuration
+#
+# the macros are stored after all defines have been added and before any file is preprocessed.
+# the key is created from the defines, include_dirs and the pcpp version, and each configuration
+# uses its own file in build_database_dir
+class MacroCache(object):
+
+    # increase to discard existing caches if the format changes
+    VERSION = 1
+
+    # macros that depend on the time or file and are not stored
+    EXCLUDE = ('__DATE__', '__TIME__', '__FILE__')
+
+    def __init__(self, dir, config, pcpp_version):
+        self._pcpp_version = pcpp_version
+        self._key = MacroCache.get_key(config, pcpp_version)
+        self._file = path.join(dir, 'pcpp_macros_%s.pickle' % self._key[0:16])
+
+    def get_key(config, pcpp_version):
+        return hashlib.md5(json.dumps([
+            MacroCache.VERSION,
+            pcpp_version,
+            config['defines'],
+            config['pcpp_defines'],
+            config['include_dirs']
+        ]).encode()).digest().hex()
+
+    @property
+    def filename(self):
+        return self._file
+
+    # copy token without any references to the lexer
+    def _copy_token(tok, token_class):
+        new_tok = token_class()
+        new_tok.type = tok.type
+        new_tok.value = tok.value
+        new_tok.lineno = tok.lineno
+        new_tok.lexpos = getattr(tok, 'lexpos', 0)
+        new_tok.source = getattr(tok, 'source', None)
+        if hasattr(tok, 'expanded_from'):
+            new_tok.expanded_from = tok.expanded_from
+        return new_tok
+
+    # load macros into the preprocessor
+    # returns False if the cache does not exist or is invalid
+    def load(self, fcpp):
+        try:
+            with open(self._file, 'rb') as file:
+                data = pickle.load(file)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            print('failed to read macro cache %s: %s' % (self._file, e), file=sys.stderr)
+            return False
+        if not isinstance(data, dict) or data.get('version')!=MacroCache.VERSION or data.get('pcpp_version')!=self._pcpp_version or data.get('key')!=self._key:
+            return False
+        fcpp.macros.update(data['macros'])
+        fcpp.include_once.update(data['include_once'])
+        return True
+
+    # store the macros of the preprocessor
+    # the file is replaced atomically and concurrent writers do not corrupt it
+    def store(self, fcpp):
+        token_class = None
+        macros = {}
+        for name, macro in fcpp.macros.items():
+            if name in MacroCache.EXCLUDE:
+                continue
+            macro = copy.copy(macro)
+            if macro.value:
+                if token_class==None:
+                    token_class = type(macro.value[0])
+                macro.value = [MacroCache._copy_token(tok, token_class) for tok in macro.value]
+            macros[name] = macro
+        tmp_file = '%s.%u.tmp' % (self._file, os.getpid())
+        try:
+            os.makedirs(path.dirname(self._file), exist_ok=True)
+            with open(tmp_file, 'wb') as file:
+                pickle.dump({
+                    'version': MacroCache.VERSION,
+                    'pcpp_version': self._pcpp_version,
+                    'key': self._key,
+                    'macros': macros,
+                    'include_once': fcpp.include_once
+                }, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, self._file)
+        except Exception as e:
+            print('failed to write macro cache %s: %s' % (self._file, e), file=sys.stderr)
+            try:
+                os.unlink(tmp_file)
+            except OSError:
+                pass
+            return False
+        return True
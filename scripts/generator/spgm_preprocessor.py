@@ -8,10 +8,15 @@ import fnmatch
 from os import path
 from . import Item
 try:
-    from pcpp.preprocessor import Preprocessor, OutputDirective, Action
+    from pcpp.preprocessor import Preprocessor, OutputDirective, Action, LexToken
+    import pcpp
 
 
     class SpgmPreprocessor(Preprocessor):
+
+        # the version is part of the target hash, the output may change with a different version
+        version = pcpp.__version__
+
         def __init__(self, display_info = True):
             Preprocessor.__init__(self)
             self.define('FLASH_STRINGS_AUTO_INIT 1')
@@ -25,11 +30,90 @@ try:
             # self._include_once = []
             self._files = []
             self._display_info = display_info
+            self._token_cache = None
+            self._header_index = None
+            self._prune = True
+            self._snapshot = None
             # self.debugout = sys.stdout
 
         def add_skip_include(self, include):
             self._skip_includes.append(include)
 
+        # store the current state as baseline for all translation units
+        # this should be called after all defines and include paths have been added
+        def snapshot(self):
+            self._snapshot = (self.macros.copy(), self.include_once.copy())
+
+        # restore the baseline created with snapshot()
+        # the macro objects are not modified after being defined and can be shared between all
+        # copies. #define and #undef only replace or remove them from the dictionary of the copy
+        def restore(self):
+            if self._snapshot==None:
+                return
+            macros, include_once = self._snapshot
+            self.macros = macros.copy()
+            self.include_once = include_once.copy()
+            self.temp_path = []
+            self.include_depth = 0
+            self.include_times = []
+            self.countermacro = 0
+            self.return_code = 0
+            if self._header_index:
+                self._header_index.reset()
+
+        def set_token_cache(self, token_cache):
+            self._token_cache = token_cache
+
+        def set_header_index(self, header_index):
+            self._header_index = header_index
+
+        # restore the baseline, preprocess the source and find the strings
+        # if the header index has skipped headers that might be required because a file has been modified
+        # during the translation unit, it is processed again without skipping any headers
+        def process(self, source):
+            self.restore()
+            self.parse(source)
+            self.find_strings()
+            if self._header_index and not self._header_index.is_pruning_valid():
+                self.cleanup()
+                self.restore()
+                self._prune = False
+                try:
+                    self.parse(source)
+                    self.find_strings()
+                finally:
+                    self._prune = True
+
+        # lexing the files is the most expensive part. the tokens of all files opened by on_file_open()
+        # are stored in the token cache and only the tokens objects need to be created for cached files
+        def group_lines(self, input, abssource):
+            if self._header_index and abssource:
+                self._header_index.update(abssource, input)
+            if self._token_cache==None or not abssource:
+                return Preprocessor.group_lines(self, input, abssource)
+            lines = self._token_cache.get(input)
+            if lines==None:
+                lines = list(Preprocessor.group_lines(self, input, abssource))
+                self._token_cache.set(input, [[(tok.type, tok.value, tok.lineno, tok.lexpos) for tok in line] for line in lines])
+                return lines
+            return self._create_tokens(lines, abssource)
+
+        # create tokens from cached tuples. pcpp modifies the tokens and new objects are required for each run
+        def _create_tokens(self, lines, abssource):
+            result = []
+            for line in lines:
+                toks = []
+                for type, value, lineno, lexpos in line:
+                    tok = LexToken()
+                    tok.type = type
+                    tok.value = value
+                    tok.lineno = lineno
+                    tok.lexpos = lexpos
+                    tok.source = abssource
+                    toks.append(tok)
+                result.append(toks)
+            return result
+
         # def on_include_not_found(self,is_system_include,curdir,includepath):
         #     print('******** on_include_not_found')
         #     print(is_system_include)
@@ -96,12 +180,24 @@ try:
                         # SpgmConfig.debug('skip include %s pattern=%s' % (includepath, skip_include))
                         raise OutputDirective(Action.IgnoreAndPassThrough)
 
+                # skip headers without any strings. the skipped files are added to the list of
+                # processed files to detect any modifications
+                if self._header_index and self._prune and self.source:
+                    files = self._header_index.get_prunable(includepath)
+                    if files!=None:
+                        for file in files:
+                            if not file in self._files:
+                                self._files.append(file)
+                        raise OutputDirective(Action.IgnoreAndPassThrough)
+
             # SpgmConfig.debug('pcpp %s' % includepath)
 
             try:
                 result = Preprocessor.on_file_open(self, is_system_include, includepath)
                 if not includepath in self._files:
                     self._files.append(includepath)
+                if self._header_index and self.source:
+                    self._header_index.add_include(self.source, includepath)
                 if self._display_info:
                     # tmp = includepath.split(os.sep)
                     # if len(tmp)>4:
@@ -200,8 +296,9 @@ try:
                         while newlinesneeded > 0:
                             # oh.write('\n')
                             newlinesneeded -= 1
-                if self.lineno!=toks[0].lineno:
-                    self.column = 1
+                # the column starts at 1 for each line. consecutive lines of different files or of a file
+                # that is included multiple times can have the same line number
+                self.column = 1
                 self.lineno = toks[0].lineno
                 # Account for those newlines in a multiline comment
                 if toks[0].type == self.t_COMMENT1:
@@ -220,19 +317,7 @@ try:
                         item = self.add_item(item, toks)
                     elif item!=None:
                         self.column += len(tok.value)
-                        if tok.type=='CPP_STRING':
-                            item.append_value_buffer(tok.value[1:-1])
-                        elif (tok.type=='CPP_DOT' and tok.value=='=') or tok.type=='CPP_EQUAL':
-                            item.push_value()
-                        elif (tok.type=='CPP_DOT' and tok.value==',') or tok.type=='CPP_COMMA':
-                            item.push_value()
-                        elif (tok.type=='CPP_DOT' and tok.value==':') or tok.type=='CPP_COLON':
-                            # assign lanuage
-                            item.push_value()
-                        elif tok.type in ['CPP_ID', 'CPP_MINUS', 'CPP_DOT', 'CPP_SEMICOLON']:
-                            item.append_value_buffer(tok.value)
-                        elif tok.type=='CPP_STRING':
-                            item.append_value_buffer(tok.value[1:-1])
+                        item.append_token(tok.type, tok.value)
                     else:
                         self.column += len(tok.value)
 
@@ -266,4 +351,4 @@ try:
 except Exception as e:
 
     class SpgmPreprocessor:
-        pass
\ No newline at end of file
+        version = None
\ No newline at end of file
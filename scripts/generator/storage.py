@@ -0,0 +1,783 @@
+#
+# Author: sascha_lammers@gmx.de
+#
+
+import os
+import sys
+import json
+import pickle
+import sqlite3
+import zlib
+import atexit
+import struct
+import shutil
+import hashlib
+import threading
+from os import path
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from .types import CompressionType, DatabaseEngineType
+from .file_wrapper import FileWrapper
+from .fingerprint import Fingerprint
+from .binary_database import BinaryDatabase, BinaryDatabaseReader
+
+# storage engine of the build database
+#
+# read() returns a dictionary with
+#   'defined': {name: item}                     first item with a value for each name
+#   'targets': {target_idx: {'files', 'hash'}}  processed files and hash of each target
+#   'items': {target_idx: {index: item}}        items found in each target
+#
+# write(database) stores the current target of the database
+# write_all(data) replaces the database with the dictionary returned by read()
+class DatabaseStorage(object):
+
+    def __init__(self, dir):
+        self._dir = dir
+
+    # compression_level: level for writing compressed files, None for the default of the codec
+    def create(engine, dir, compression=CompressionType.NONE, journal_size=0, compression_level=None):
+        if engine==DatabaseEngineType.JOURNAL:
+            return JournalStorage(dir, compression, journal_size, compression_level)
+        if engine==DatabaseEngineType.SQLITE:
+            return SqliteStorage(dir)
+        if engine==DatabaseEngineType.SHARDED:
+            return ShardedStorage(dir, compression, compression_level)
+        if engine==DatabaseEngineType.BINARY:
+            return BinaryStorage(dir)
+        return PickleStorage(dir, compression, compression_level)
+
+    # compression types that can be read
+    def _get_compression_types():
+        return [type for type in CompressionType if FileWrapper.is_available(type)]
+
+    # all databases stored in the directory
+    def find_all(dir):
+        storages = []
+        if path.isfile(path.join(dir, SqliteStorage.FILENAME)):
+            storages.append(SqliteStorage(dir))
+        if path.isfile(path.join(dir, ShardedStorage.DIRNAME, ShardedStorage.MANIFEST)):
+            storages.append(ShardedStorage(dir))
+        if path.isfile(path.join(dir, BinaryStorage.FILENAME)):
+            storages.append(BinaryStorage(dir))
+        for compression in DatabaseStorage._get_compression_types():
+            storage = JournalStorage(dir, compression)
+            if path.isfile(storage.filename) or path.isfile(storage.journal_filename):
+                storages.append(storage)
+        for compression in DatabaseStorage._get_compression_types():
+            storage = PickleStorage(dir, compression)
+            if path.isfile(storage.filename):
+                storages.append(storage)
+        return storages
+
+    # detect the engine of an existing database. if the directory contains more than one database,
+    # the most recently modified one is used
+    # returns None if the directory does not contain any database
+    def find(dir):
+        storages = DatabaseStorage.find_all(dir)
+        if not storages:
+            return None
+        if len(storages)>1:
+            storages.sort(key=lambda storage: storage.get_mtime(), reverse=True)
+            print('multiple databases found in %s, using %s: %s' % (dir, storages[0].filename, ', '.join([storage.filename for storage in storages[1:]])), file=sys.stderr)
+        return storages[0]
+
+    # files and directories of the database
+    def _get_files(self):
+        return [self.filename]
+
+    # time of the last modification
+    def get_mtime(self):
+        mtime = 0
+        for file in self._get_files():
+            try:
+                mtime = max(mtime, os.stat(file).st_mtime_ns)
+            except FileNotFoundError:
+                pass
+        return mtime
+
+    # remove the database
+    def remove(self):
+        for file in self._get_files():
+            if path.isdir(file):
+                shutil.rmtree(file)
+            elif path.isfile(file):
+                os.unlink(file)
+
+    @property
+    def filename(self):
+        raise NotImplementedError()
+
+    def read(self):
+        raise NotImplementedError()
+
+    def write(self, database):
+        raise NotImplementedError()
+
+    def write_all(self, data):
+        raise NotImplementedError()
+
+    def _empty():
+        return {'defined': {}, 'targets': {}, 'items': {}}
+
+    # rows store the path of the source file, line and column
+    def _create_item(key, name, type, path, line, column, value, data):
+        from .database2 import v2
+        return v2.Item.from_path(name, type, path, line, column, value, data)
+
+    def _get_item_row(item):
+        return (item.name, item.type.value, item.file, item.line, item.column, item.own_value, item._data)
+
+    # all attributes of a database in the order of its dictionaries to compare databases
+    # database: dictionary returned by read()
+    def get_rows(database):
+        return (
+            [(target_idx, target['hash'], list(target['files'])) for target_idx, target in database['targets'].items()],
+            [(target_idx, [(index, DatabaseStorage._get_item_row(item)) for index, item in items.items()]) for target_idx, items in database['items'].items()],
+            [(name, DatabaseStorage._get_item_row(item)) for name, item in database['defined'].items()]
+        )
+
+# all targets in a single pickled dictionary
+#
+# each write reads the entire database, merges the current target and writes it back
+class PickleStorage(DatabaseStorage):
+
+    def __init__(self, dir, compression=CompressionType.NONE, compression_level=None):
+        DatabaseStorage.__init__(self, dir)
+        self._compression = compression
+        self._compression_level = compression_level
+
+    @property
+    def filename(self):
+        return path.join(self._dir, 'database.pickle' + self._compression.extension)
+
+    # load database from file if it is exists
+    def read(self):
+        if not path.isfile(self.filename):
+            return DatabaseStorage._empty()
+
+        file = FileWrapper.open(self.filename, 'rb')
+        try:
+            database = pickle.load(file)
+        finally:
+            file.close()
+
+        return database
+
+    # write to a temporary file and replace the database atomically. readers that do not hold
+    # the lock either read the old or the new file
+    def _write(self, database: dict):
+
+        tmp_file = '%s.%u.%u.tmp' % (self.filename, os.getpid(), threading.get_ident()) + self._compression.extension
+        file = FileWrapper.open(tmp_file, 'wb', self._compression_level)
+        try:
+            pickle.dump(database, file)
+        finally:
+            file.close()
+        os.replace(tmp_file, self.filename)
+
+    def write_all(self, data):
+        os.makedirs(self._dir, exist_ok=True)
+        self._write(data)
+
+    def write(self, database):
+        os.makedirs(self._dir, exist_ok=True)
+
+        merged_database = self.read()
+        merged_database['targets'].update(database._targets)
+        merged_database['defined'].update(database._defined)
+        if database._target_idx in database._items_per_file:
+            merged_database['items'].update({database._target_idx: database._items_per_file[database._target_idx]})
+        self._write(merged_database)
+
+# binary database in build_database_dir/database.spgmdb, see BinaryDatabase
+#
+# each write reads the entire database, merges the current target and writes it back. the file
+# can be opened with BinaryDatabaseReader to access single items without reading the database
+class BinaryStorage(DatabaseStorage):
+
+    FILENAME = 'database.spgmdb'
+
+    @property
+    def filename(self):
+        return path.join(self._dir, BinaryStorage.FILENAME)
+
+    def open(self):
+        return BinaryDatabaseReader(self.filename)
+
+    def read(self):
+        if not path.isfile(self.filename):
+            return DatabaseStorage._empty()
+        with self.open() as reader:
+            return reader.read()
+
+    def write_all(self, data):
+        os.makedirs(self._dir, exist_ok=True)
+        BinaryDatabase.write(data, self.filename)
+
+    def write(self, database):
+        merged_database = self.read()
+        merged_database['targets'].update(database._targets)
+        merged_database['defined'].update(database._defined)
+        if database._target_idx in database._items_per_file:
+            merged_database['items'].update({database._target_idx: database._items_per_file[database._target_idx]})
+        self.write_all(merged_database)
+
+# sqlite database in build_database_dir/database.sqlite
+#
+# each write replaces the rows of the current target in a single transaction. the order of
+# the rows is preserved to create the same output files as the pickle engine
+#
+# targets that only have data or only have items are stored with has_data=0 or items_order=NULL
+# and read() returns the same dictionaries as the pickle engine
+class SqliteStorage(DatabaseStorage):
+
+    FILENAME = 'database.sqlite'
+
+    # increase to discard existing databases if the schema changes
+    VERSION = 3
+
+    SCHEMA = [
+        # paths of the source files of all items
+        'CREATE TABLE sources (id INTEGER PRIMARY KEY, path TEXT NOT NULL UNIQUE)',
+        # has_data: the target has files and a hash, items_order: position in the items dictionary or NULL
+        'CREATE TABLE targets (target TEXT PRIMARY KEY, hash TEXT, has_data INTEGER NOT NULL, items_order INTEGER)',
+        # digest of the file contents when the target was processed
+        'CREATE TABLE files (target TEXT NOT NULL, file TEXT NOT NULL, digest TEXT, PRIMARY KEY (target, file))',
+        # the primary key is used for lookups by target
+        'CREATE TABLE items (target TEXT NOT NULL, idx TEXT NOT NULL, name TEXT NOT NULL, type TEXT NOT NULL, source INTEGER NOT NULL, line INTEGER, col INTEGER, value TEXT, data TEXT, PRIMARY KEY (target, idx))',
+        'CREATE INDEX items_name ON items (name)',
+        'CREATE INDEX items_source ON items (source)',
+        'CREATE TABLE defined (name TEXT PRIMARY KEY, type TEXT NOT NULL, source INTEGER NOT NULL, line INTEGER, col INTEGER, value TEXT, data TEXT)'
+    ]
+
+    # seconds to wait for other processes
+    TIMEOUT = 60
+
+    @property
+    def filename(self):
+        return path.join(self._dir, SqliteStorage.FILENAME)
+
+    def _get_files(self):
+        return [self.filename, self.filename + '-wal', self.filename + '-shm']
+
+    def _connect(self, create=False):
+        if not create and not path.isfile(self.filename):
+            return None
+        os.makedirs(self._dir, exist_ok=True)
+        conn = sqlite3.connect(self.filename, timeout=SqliteStorage.TIMEOUT, isolation_level=None)
+        try:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            if version!=SqliteStorage.VERSION:
+                conn.execute('BEGIN EXCLUSIVE')
+                # check again, another process might have created the tables in the meantime
+                version = conn.execute('PRAGMA user_version').fetchone()[0]
+                if version!=SqliteStorage.VERSION:
+                    for (type, name) in conn.execute("SELECT type, name FROM sqlite_master WHERE type IN ('table', 'index') AND name NOT LIKE 'sqlite_%'").fetchall():
+                        if type=='table':
+                            conn.execute('DROP TABLE IF EXISTS %s' % name)
+                    for statement in SqliteStorage.SCHEMA:
+                        conn.execute(statement)
+                    conn.execute('PRAGMA user_version=%u' % SqliteStorage.VERSION)
+                conn.execute('COMMIT')
+                conn.execute('PRAGMA journal_mode=WAL')
+        except:
+            conn.close()
+            raise
+        return conn
+
+    def _create_item(sources, key, name, type, source, line, column, value, data):
+        return DatabaseStorage._create_item(key, name, type, sources[source], line, column, value, data and json.loads(data) or None)
+
+    def read(self):
+        database = DatabaseStorage._empty()
+        conn = self._connect()
+        if conn==None:
+            return database
+        with closing(conn):
+            conn.execute('BEGIN')
+            try:
+                targets = database['targets']
+                items = database['items']
+                for target, hash, has_data in conn.execute('SELECT target, hash, has_data FROM targets ORDER BY rowid'):
+                    if has_data:
+                        targets[target] = {'files': [], 'hash': hash}
+                for (target,) in conn.execute('SELECT target FROM targets WHERE items_order IS NOT NULL ORDER BY items_order'):
+                    items[target] = {}
+                for target, file in conn.execute('SELECT target, file FROM files ORDER BY rowid'):
+                    targets[target]['files'].append(file)
+                sources = dict(conn.execute('SELECT id, path FROM sources'))
+                for row in conn.execute('SELECT target, name, type, source, line, col, value, data FROM items ORDER BY rowid'):
+                    item = SqliteStorage._create_item(sources, *row)
+                    items[row[0]][item.index] = item
+                for row in conn.execute('SELECT name, name, type, source, line, col, value, data FROM defined ORDER BY rowid'):
+                    database['defined'][row[0]] = SqliteStorage._create_item(sources, *row)
+            finally:
+                conn.execute('COMMIT')
+        return database
+
+    # sources: {path: id in the sources table}
+    def _get_item_row(sources, item):
+        row = DatabaseStorage._get_item_row(item)
+        return row[0:2] + (sources[row[2]],) + row[3:6] + (row[6] and json.dumps(row[6]) or None,)
+
+    # add missing paths to the sources table and return the ids
+    def _get_sources(conn, items):
+        paths = set(item.file for item in items)
+        conn.executemany('INSERT OR IGNORE INTO sources (path) VALUES (?)', [(path,) for path in paths])
+        sources = {}
+        for id, path in conn.execute('SELECT id, path FROM sources'):
+            if path in paths:
+                sources[path] = id
+        return sources
+
+    # replace the data of a target
+    def _write_target_data(conn, fingerprint, target_idx, target):
+        digests = fingerprint.get_digests(target['files'])
+        # keep the rowid of existing targets
+        conn.execute('INSERT INTO targets (target, hash, has_data) VALUES (?, ?, 1) ON CONFLICT (target) DO UPDATE SET hash=excluded.hash, has_data=1', (target_idx, target['hash']))
+        conn.execute('DELETE FROM files WHERE target=?', (target_idx,))
+        conn.executemany('INSERT OR REPLACE INTO files (target, file, digest) VALUES (?, ?, ?)', [(target_idx, file, digests.get(path.realpath(file), None)) for file in target['files']])
+
+    # replace the items of a target. new targets are added at the end of the items dictionary
+    def _write_target_items(conn, sources, target_idx, items):
+        conn.execute('INSERT INTO targets (target, has_data, items_order) VALUES (?, 0, (SELECT COALESCE(MAX(items_order), -1) + 1 FROM targets)) ON CONFLICT (target) DO UPDATE SET items_order=COALESCE(targets.items_order, excluded.items_order)', (target_idx,))
+        conn.execute('DELETE FROM items WHERE target=?', (target_idx,))
+        conn.executemany('INSERT INTO items (target, idx, name, type, source, line, col, value, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', [(target_idx, index) + SqliteStorage._get_item_row(sources, item) for index, item in items.items()])
+
+    def write(self, database):
+        target_idx = database._target_idx
+        items = database._items_per_file.get(target_idx, {})
+        fingerprint = Fingerprint.get_instance(self._dir)
+
+        with closing(self._connect(True)) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if target_idx in database._targets:
+                    SqliteStorage._write_target_data(conn, fingerprint, target_idx, database._targets[target_idx])
+                defined = [database._defined[name] for name in database._defined_added if name in database._defined]
+                sources = SqliteStorage._get_sources(conn, list(items.values()) + defined)
+                if target_idx in database._items_per_file:
+                    SqliteStorage._write_target_items(conn, sources, target_idx, items)
+                conn.executemany('INSERT OR IGNORE INTO defined (name, type, source, line, col, value, data) VALUES (?, ?, ?, ?, ?, ?, ?)', [SqliteStorage._get_item_row(sources, item) for item in defined])
+                conn.execute('COMMIT')
+            except:
+                conn.execute('ROLLBACK')
+                raise
+        database._defined_added = []
+
+    def write_all(self, data):
+        fingerprint = Fingerprint.get_instance(self._dir)
+        items = [item for target_items in data['items'].values() for item in target_items.values()]
+
+        with closing(self._connect(True)) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                for table in ('targets', 'files', 'items', 'defined', 'sources'):
+                    conn.execute('DELETE FROM %s' % table)
+                for target_idx, target in data['targets'].items():
+                    SqliteStorage._write_target_data(conn, fingerprint, target_idx, target)
+                sources = SqliteStorage._get_sources(conn, items + list(data['defined'].values()))
+                for target_idx, target_items in data['items'].items():
+                    SqliteStorage._write_target_items(conn, sources, target_idx, target_items)
+                conn.executemany('INSERT INTO defined (name, type, source, line, col, value, data) VALUES (?, ?, ?, ?, ?, ?, ?)', [SqliteStorage._get_item_row(sources, item) for item in data['defined'].values()])
+                conn.execute('COMMIT')
+            except:
+                conn.execute('ROLLBACK')
+                raise
+
+# one file for each target and a manifest in build_database_dir/database.shards
+#
+# the manifest only contains the hash of each target, the order of the items and the shard of each
+# target. the shard contains the files and the items of the target, the defined items are stored in
+# a separate file. each write replaces the shard of the current target and the manifest, the defined
+# items are only written if new names have been added. shards that have not been modified since the
+# last read are not loaded again
+#
+# manifest: {'version', 'targets': {target_idx: hash}, 'items': [target_idx], 'shards': {target_idx: name}}
+# shard: {'files': list or None, 'items': rows or None}
+class ShardedStorage(DatabaseStorage):
+
+    DIRNAME = 'database.shards'
+    MANIFEST = 'manifest.pickle'
+    DEFINED = 'defined.pickle'
+
+    # increase to discard existing databases if the format changes
+    VERSION = 3
+
+    # load shards with a thread pool if there are more
+    PARALLEL_LOAD_MIN_SHARDS = 16
+
+    # filename: (stat, data)
+    _cache = {}
+    _cache_lock = threading.Lock()
+
+    def __init__(self, dir, compression=CompressionType.NONE, compression_level=None):
+        DatabaseStorage.__init__(self, dir)
+        self._compression = compression
+        self._compression_level = compression_level
+        self._shard_dir = path.join(dir, ShardedStorage.DIRNAME)
+
+    @property
+    def filename(self):
+        return path.join(self._shard_dir, ShardedStorage.MANIFEST)
+
+    @property
+    def defined_filename(self):
+        return path.join(self._shard_dir, ShardedStorage.DEFINED + self._compression.extension)
+
+    def _get_files(self):
+        return [self.filename, self._shard_dir]
+
+    def _get_shard_name(self, target_idx):
+        return hashlib.md5(target_idx.encode()).digest().hex() + '.pickle' + self._compression.extension
+
+    def _load(self, filename):
+        file = FileWrapper.open(filename, 'rb')
+        try:
+            return pickle.load(file)
+        finally:
+            file.close()
+
+    # store data and replace the file atomically
+    def _store(self, filename, data):
+        tmp_file = '%s.%u.%u.tmp' % (filename, os.getpid(), threading.get_ident()) + CompressionType.fromFilename(filename).extension
+        file = FileWrapper.open(tmp_file, 'wb', self._compression_level)
+        try:
+            pickle.dump(data, file, protocol=pickle.HIGHEST_PROTOCOL)
+        finally:
+            file.close()
+        os.replace(tmp_file, filename)
+
+    def _read_manifest(self):
+        try:
+            manifest = self._load(self.filename)
+            if manifest['version']==ShardedStorage.VERSION:
+                return manifest
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print('failed to read %s: %s' % (self.filename, e), file=sys.stderr)
+        return {'version': ShardedStorage.VERSION, 'targets': {}, 'items': [], 'shards': {}}
+
+    # returns the contents of a file in the shard directory or default if it does not exist
+    def _read_cached(self, filename, default=None):
+        try:
+            st = os.stat(filename)
+        except FileNotFoundError:
+            return default
+        key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        with ShardedStorage._cache_lock:
+            entry = ShardedStorage._cache.get(filename, None)
+        if entry!=None and entry[0]==key:
+            return entry[1]
+        data = self._load(filename)
+        with ShardedStorage._cache_lock:
+            ShardedStorage._cache[filename] = (key, data)
+        return data
+
+    def _read_shard(self, name):
+        return self._read_cached(path.join(self._shard_dir, name), {'files': None, 'items': None})
+
+    # rows of the defined items
+    def _read_defined(self):
+        return self._read_cached(self.defined_filename, [])
+
+    def read(self):
+        database = DatabaseStorage._empty()
+        manifest = self._read_manifest()
+        for row in self._read_defined():
+            database['defined'][row[0]] = DatabaseStorage._create_item(row[0], *row)
+
+        shards = list(manifest['shards'].items())
+        if len(shards)>=ShardedStorage.PARALLEL_LOAD_MIN_SHARDS:
+            with ThreadPoolExecutor() as executor:
+                shard_data = list(executor.map(lambda shard: self._read_shard(shard[1]), shards))
+        else:
+            shard_data = [self._read_shard(shard[1]) for shard in shards]
+        shard_data = dict((target_idx, data) for (target_idx, name), data in zip(shards, shard_data))
+
+        for target_idx, hash in manifest['targets'].items():
+            database['targets'][target_idx] = {'files': list(shard_data[target_idx]['files']), 'hash': hash}
+        for target_idx in manifest['items']:
+            items = {}
+            for row in shard_data[target_idx]['items']:
+                items[row[0]] = DatabaseStorage._create_item(*row)
+            database['items'][target_idx] = items
+
+        return database
+
+    # target: files and hash or None, items: {index: item} or None
+    def _get_shard(target, items):
+        return {
+            'files': None if target==None else list(target['files']),
+            'items': None if items==None else [(index,) + DatabaseStorage._get_item_row(item) for index, item in items.items()]
+        }
+
+    def write(self, database):
+        os.makedirs(self._shard_dir, exist_ok=True)
+
+        target_idx = database._target_idx
+        name = self._get_shard_name(target_idx)
+        manifest = self._read_manifest()
+        target = database._targets.get(target_idx, None)
+        items = database._items_per_file.get(target_idx, None)
+        # keep the data or the items of the shard that are not part of the database
+        if (target==None or items==None) and target_idx in manifest['shards']:
+            shard = self._read_shard(manifest['shards'][target_idx])
+            if target==None and target_idx in manifest['targets']:
+                target = {'files': shard['files'], 'hash': manifest['targets'][target_idx]}
+            if items==None and target_idx in manifest['items']:
+                items = dict((row[0], DatabaseStorage._create_item(*row)) for row in shard['items'])
+        self._store(path.join(self._shard_dir, name), ShardedStorage._get_shard(target, items))
+
+        if target!=None:
+            manifest['targets'][target_idx] = target['hash']
+        if items!=None and not target_idx in manifest['items']:
+            manifest['items'].append(target_idx)
+        manifest['shards'][target_idx] = name
+        self._store(self.filename, manifest)
+
+        added = [database._defined[name] for name in database._defined_added if name in database._defined]
+        if added:
+            rows = list(self._read_defined())
+            names = set([row[0] for row in rows])
+            for item in added:
+                if not item.name in names:
+                    rows.append(DatabaseStorage._get_item_row(item))
+                    names.add(item.name)
+            self._store(self.defined_filename, rows)
+        database._defined_added = []
+
+    # shards that are not part of the new manifest are removed
+    def write_all(self, data):
+        os.makedirs(self._shard_dir, exist_ok=True)
+
+        manifest = {'version': ShardedStorage.VERSION, 'targets': {}, 'items': list(data['items'].keys()), 'shards': {}}
+        for target_idx in list(data['targets'].keys()) + [target_idx for target_idx in data['items'].keys() if not target_idx in data['targets']]:
+            target = data['targets'].get(target_idx, None)
+            name = self._get_shard_name(target_idx)
+            self._store(path.join(self._shard_dir, name), ShardedStorage._get_shard(target, data['items'].get(target_idx, None)))
+            if target!=None:
+                manifest['targets'][target_idx] = target['hash']
+            manifest['shards'][target_idx] = name
+        self._store(self.defined_filename, [DatabaseStorage._get_item_row(item) for item in data['defined'].values()])
+        self._store(self.filename, manifest)
+
+        files = set(manifest['shards'].values())
+        files.add(ShardedStorage.MANIFEST)
+        files.add(path.basename(self.defined_filename))
+        for name in os.listdir(self._shard_dir):
+            if not name in files and not name.endswith('.tmp'):
+                os.unlink(path.join(self._shard_dir, name))
+
+# snapshot of the database and an append-only journal
+#
+# each write appends a record with the items, files and hash of the current target and the new
+# defined items to build_database_dir/database.journal. readers replay the journal on top of
+# build_database_dir/database.snapshot.pickle. the journal is folded into the snapshot when it
+# exceeds the maximum size and at exit
+#
+# each record starts with a header containing a magic number, the length and the crc32 of the
+# pickled record. replaying stops at the first incomplete or damaged record, which is removed
+# before the next record is appended
+class JournalStorage(DatabaseStorage):
+
+    JOURNAL = 'database.journal'
+
+    # increase to discard existing databases if the format changes
+    VERSION = 2
+
+    MAGIC = b'SPGJ'
+    HEADER = struct.Struct('<4sII')
+
+    # journals to compact at exit
+    _compact_at_exit = {}
+    _compact_at_exit_lock = threading.Lock()
+
+    def __init__(self, dir, compression=CompressionType.NONE, max_size=0, compression_level=None):
+        DatabaseStorage.__init__(self, dir)
+        self._compression = compression
+        self._compression_level = compression_level
+        # maximum size of the journal in byte, 0 to compact at exit only
+        self._max_size = max_size
+
+    @property
+    def filename(self):
+        return path.join(self._dir, 'database.snapshot.pickle' + self._compression.extension)
+
+    @property
+    def journal_filename(self):
+        return path.join(self._dir, JournalStorage.JOURNAL)
+
+    def _get_files(self):
+        return [self.filename, self.journal_filename]
+
+    def _read_snapshot(self):
+        try:
+            file = FileWrapper.open(self.filename, 'rb')
+            try:
+                snapshot = pickle.load(file)
+            finally:
+                file.close()
+            if snapshot['version']==JournalStorage.VERSION:
+                return snapshot
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print('failed to read %s: %s' % (self.filename, e), file=sys.stderr)
+        return {'version': JournalStorage.VERSION, 'targets': {}, 'items': {}, 'defined': []}
+
+    def _write_snapshot(self, snapshot):
+        tmp_file = '%s.%u.tmp' % (self.filename, os.getpid()) + self._compression.extension
+        file = FileWrapper.open(tmp_file, 'wb', self._compression_level)
+        try:
+            pickle.dump(snapshot, file, protocol=pickle.HIGHEST_PROTOCOL)
+        finally:
+            file.close()
+        os.replace(tmp_file, self.filename)
+
+    # returns a list of valid records and the end of the last valid record
+    def _read_journal(self):
+        records = []
+        try:
+            with open(self.journal_filename, 'rb') as file:
+                data = file.read()
+        except FileNotFoundError:
+            return records, 0
+        pos = 0
+        while pos + JournalStorage.HEADER.size<=len(data):
+            magic, length, crc = JournalStorage.HEADER.unpack_from(data, pos)
+            start = pos + JournalStorage.HEADER.size
+            payload = data[start:start + length]
+            if magic!=JournalStorage.MAGIC or len(payload)!=length or zlib.crc32(payload)!=crc:
+                break
+            try:
+                records.append(pickle.loads(payload))
+            except Exception:
+                break
+            pos = start + length
+        return records, pos
+
+    # find the end of the last complete record by following the headers
+    # the crc of the last record is verified
+    def _get_journal_end(self, file, size):
+        pos = 0
+        last = None
+        while pos + JournalStorage.HEADER.size<=size:
+            file.seek(pos)
+            magic, length, crc = JournalStorage.HEADER.unpack(file.read(JournalStorage.HEADER.size))
+            end = pos + JournalStorage.HEADER.size + length
+            if magic!=JournalStorage.MAGIC or end>size:
+                break
+            last = (pos, length, crc)
+            pos = end
+        if last:
+            file.seek(last[0] + JournalStorage.HEADER.size)
+            if zlib.crc32(file.read(last[1]))!=last[2]:
+                return last[0]
+        return pos
+
+    def _apply(database, record):
+        target_idx = record['target']
+        if record['data']!=None:
+            database['targets'][target_idx] = record['data']
+        database['items'][target_idx] = record['items']
+        names = set([row[0] for row in database['defined']])
+        for row in record['defined']:
+            if not row[0] in names:
+                database['defined'].append(row)
+                names.add(row[0])
+
+    # returns the snapshot with all records of the journal applied
+    def _replay(self):
+        snapshot = self._read_snapshot()
+        records, end = self._read_journal()
+        for record in records:
+            JournalStorage._apply(snapshot, record)
+        return snapshot, len(records)
+
+    def read(self):
+        snapshot, count = self._replay()
+        database = DatabaseStorage._empty()
+        database['targets'] = snapshot['targets']
+        for target_idx, rows in snapshot['items'].items():
+            items = {}
+            for row in rows:
+                items[row[0]] = DatabaseStorage._create_item(*row)
+            database['items'][target_idx] = items
+        for row in snapshot['defined']:
+            database['defined'][row[0]] = DatabaseStorage._create_item(row[0], *row)
+        return database
+
+    def write(self, database):
+        os.makedirs(self._dir, exist_ok=True)
+
+        target_idx = database._target_idx
+        items = database._items_per_file.get(target_idx, {})
+        record = {
+            'target': target_idx,
+            'data': database._targets.get(target_idx, None),
+            'items': [(index,) + DatabaseStorage._get_item_row(item) for index, item in items.items()],
+            'defined': [DatabaseStorage._get_item_row(database._defined[name]) for name in database._defined_added if name in database._defined]
+        }
+        payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+
+        with open(self.journal_filename, 'a+b') as file:
+            size = file.seek(0, os.SEEK_END)
+            end = self._get_journal_end(file, size)
+            if end!=size:
+                # remove incomplete record
+                file.truncate(end)
+            file.write(JournalStorage.HEADER.pack(JournalStorage.MAGIC, len(payload), zlib.crc32(payload)))
+            file.write(payload)
+            file.flush()
+            size = file.tell()
+        database._defined_added = []
+
+        if self._max_size and size>=self._max_size:
+            self.compact()
+        else:
+            with JournalStorage._compact_at_exit_lock:
+                if not JournalStorage._compact_at_exit:
+                    atexit.register(JournalStorage._compact_all)
+                JournalStorage._compact_at_exit[self.journal_filename] = self
+
+    # replace the snapshot and remove the journal
+    def write_all(self, data):
+        os.makedirs(self._dir, exist_ok=True)
+
+        snapshot = {
+            'version': JournalStorage.VERSION,
+            'targets': dict(data['targets']),
+            'items': dict((target_idx, [(index,) + DatabaseStorage._get_item_row(item) for index, item in items.items()]) for target_idx, items in data['items'].items()),
+            'defined': [DatabaseStorage._get_item_row(item) for item in data['defined'].values()]
+        }
+        self._write_snapshot(snapshot)
+        try:
+            os.unlink(self.journal_filename)
+        except FileNotFoundError:
+            pass
+
+    # fold the journal into the snapshot
+    def compact(self):
+        snapshot, count = self._replay()
+        if count==0:
+            return
+        self._write_snapshot(snapshot)
+        # records that are written again after a crash at this point are replayed twice. the result
+        # is the same, each record replaces the items of its target
+        with open(self.journal_filename, 'r+b') as file:
+            file.truncate(0)
+
+    def _compact_all():
+        with JournalStorage._compact_at_exit_lock:
+            storages = list(JournalStorage._compact_at_exit.values())
+            JournalStorage._compact_at_exit = {}
+        from .database2 import FileLock
+        for storage in storages:
+            try:
+                with FileLock(storage._dir, False, 60):
+                    storage.compact()
+            except Exception as e:
+                print('failed to compact %s: %s' % (storage.journal_filename, e), file=sys.stderr)
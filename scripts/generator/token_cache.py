@@ -0,0 +1,146 @@
+#
+# Author: sascha_lammers@gmx.de
+#
+
+import os
+import sys
+import pickle
+import hashlib
+import threading
+from os import path
+from collections import OrderedDict
+
+# persistent cache for the tokens created by the pcpp lexer
+#
+# the tokens of each file are stored as a list of lines with (type, value, lineno, lexpos) tuples
+# in build_database_dir/tokens. the key is created from the pcpp version and the contents of the
+# file. the size of the directory is limited to max_size, the least recently used files are removed
+class TokenCache(object):
+
+    # increase to discard existing caches if the format changes
+    VERSION = 1
+
+    # number of files kept in memory
+    MAX_MEMORY_ITEMS = 1024
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, dir, pcpp_version, max_size):
+        self._dir = path.join(dir, 'tokens')
+        self._pcpp_version = pcpp_version
+        self._max_size = max_size
+        self._size = None
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+    # get shared instance for the database directory
+    # max_size is the size of the cache directory in bytes
+    def get_instance(dir, pcpp_version, max_size):
+        dir = path.abspath(dir)
+        key = (dir, pcpp_version)
+        with TokenCache._instances_lock:
+            if not key in TokenCache._instances:
+                TokenCache._instances[key] = TokenCache(dir, pcpp_version, max_size)
+            instance = TokenCache._instances[key]
+            instance._max_size = max_size
+            return instance
+
+    def _get_key(self, input):
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(('%u:%s:' % (TokenCache.VERSION, self._pcpp_version)).encode())
+        digest.update(input.encode('utf-8', errors='surrogatepass'))
+        return digest.hexdigest()
+
+    def _get_filename(self, key):
+        return path.join(self._dir, '%s.pickle' % key)
+
+    # returns a list of lines with token tuples or None
+    def get(self, input):
+        key = self._get_key(input)
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+        filename = self._get_filename(key)
+        try:
+            with open(filename, 'rb') as file:
+                lines = pickle.load(file)
+            # update modification time for removing the least recently used files
+            os.utime(filename)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print('failed to read token cache %s: %s' % (filename, e), file=sys.stderr)
+            return None
+        self._add_memory(key, lines)
+        return lines
+
+    # store lines with token tuples
+    def set(self, input, lines):
+        key = self._get_key(input)
+        self._add_memory(key, lines)
+        if self._max_size<=0:
+            return
+        filename = self._get_filename(key)
+        tmp_file = '%s.%u.%u.tmp' % (filename, os.getpid(), threading.get_ident())
+        try:
+            os.makedirs(self._dir, exist_ok=True)
+            with open(tmp_file, 'wb') as file:
+                pickle.dump(lines, file, protocol=pickle.HIGHEST_PROTOCOL)
+                size = file.tell()
+            os.replace(tmp_file, filename)
+        except Exception as e:
+            print('failed to write token cache %s: %s' % (filename, e), file=sys.stderr)
+            try:
+                os.unlink(tmp_file)
+            except OSError:
+                pass
+            return
+        with self._lock:
+            if self._size==None:
+                self._size = self._get_size()
+            else:
+                self._size += size
+            if self._size>self._max_size:
+                self._evict()
+
+    def _add_memory(self, key, lines):
+        with self._lock:
+            self._memory[key] = lines
+            self._memory.move_to_end(key)
+            while len(self._memory)>TokenCache.MAX_MEMORY_ITEMS:
+                self._memory.popitem(last=False)
+
+    def _get_files(self):
+        files = []
+        try:
+            with os.scandir(self._dir) as entries:
+                for entry in entries:
+                    if entry.name.endswith('.pickle'):
+                        try:
+                            st = entry.stat()
+                            files.append((st.st_mtime_ns, st.st_size, entry.path))
+                        except OSError:
+                            pass
+        except FileNotFoundError:
+            pass
+        return files
+
+    def _get_size(self):
+        return sum([size for mtime, size, file in self._get_files()])
+
+    # remove least recently used files until the size is below 75% of max_size
+    def _evict(self):
+        files = sorted(self._get_files())
+        size = sum([size for mtime, size, file in files])
+        max_size = self._max_size * 3 // 4
+        for mtime, file_size, file in files:
+            if size<=max_size:
+                break
+            try:
+                os.unlink(file)
+                size -= file_size
+            except OSError:
+                pass
+        self._size = size
@@ -13,13 +13,50 @@ class ExportType(enum.Enum):
 class CompressionType(enum.Enum):
     NONE = None
     LZMA = 'lzma'
+    GZIP = 'gzip'
+    BZ2 = 'bz2'
+    # requires the module zstandard
+    ZSTD = 'zstd'
+    # requires the module lz4
+    LZ4 = 'lz4'
 
     def fromString(value: str):
         value = value.lower()
         if value in ('false', '0', 'null', 'none', 'off', 'no', 'disable', 'disabled'):
             return CompressionType.NONE
+        if value in ('xz', 'gz', 'zstandard'):
+            value = {'xz': 'lzma', 'gz': 'gzip', 'zstandard': 'zstd'}[value]
         return CompressionType(value)
 
+    # file extension of the compressed files
+    @property
+    def extension(self):
+        return {
+            CompressionType.NONE: '',
+            CompressionType.LZMA: '.xz',
+            CompressionType.GZIP: '.gz',
+            CompressionType.BZ2: '.bz2',
+            CompressionType.ZSTD: '.zst',
+            CompressionType.LZ4: '.lz4'
+        }[self]
+
+    def fromFilename(filename: str):
+        filename = filename.lower()
+        for type in CompressionType:
+            if type.extension and filename.endswith(type.extension):
+                return type
+        return CompressionType.NONE
+
+class DatabaseEngineType(enum.Enum):
+    PICKLE = 'pickle'
+    SQLITE = 'sqlite'
+    SHARDED = 'sharded'
+    JOURNAL = 'journal'
+    BINARY = 'binary'
+
+    def fromString(value: str):
+        return DatabaseEngineType(value.strip().lower())
+
 class SubstListType(enum.Enum):
     STR = 'str'
     ABSPATH = 'abspath'
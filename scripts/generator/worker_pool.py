@@ -0,0 +1,99 @@
+#
+# Author: sascha_lammers@gmx.de
+#
+
+import json
+import atexit
+import threading
+import subprocess
+from typing import List
+
+# preprocessor process started with pcpp_cli.py --worker
+#
+# the worker reads one request per line from stdin and writes the result as a single line to stdout.
+# the preprocessor is created once for each configuration and kept between requests
+class PreprocessorWorker(object):
+
+    def __init__(self, args: List[str]):
+        self._args = args
+        self._proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    @property
+    def is_running(self):
+        return self._proc.poll()==None
+
+    # send request and wait for the result
+    def run(self, config):
+        try:
+            self._proc.stdin.write(json.dumps(config).encode() + b'\n')
+            self._proc.stdin.flush()
+            line = self._proc.stdout.readline()
+        except OSError as e:
+            raise RuntimeError('preprocessor worker failed: %s. cmd: %s' % (e, ' '.join(self._args)))
+        if not line:
+            raise RuntimeError('preprocessor worker terminated with exit code %s. cmd: %s' % (self._proc.wait(), ' '.join(self._args)))
+        result = json.loads(line.decode())
+        if 'error' in result:
+            raise RuntimeError('preprocessor worker: %s' % result['error'])
+        return result
+
+    def close(self):
+        try:
+            self._proc.stdin.close()
+            self._proc.wait(timeout=10)
+        except Exception:
+            self._proc.kill()
+
+# pool of preprocessor workers
+#
+# the workers are started on demand, up to the size of the pool, and each thread that calls run() gets
+# its own worker until the request has been completed
+class PreprocessorPool(object):
+
+    def __init__(self, args: List[str], size):
+        self._args = args
+        self._size = max(1, size)
+        self._idle = []
+        self._workers = []
+        self._lock = threading.Lock()
+        self._semaphore = threading.BoundedSemaphore(self._size)
+        atexit.register(self.close)
+
+    @property
+    def size(self):
+        return self._size
+
+    def _get_worker(self):
+        with self._lock:
+            while self._idle:
+                worker = self._idle.pop()
+                if worker.is_running:
+                    return worker
+                self._workers.remove(worker)
+            worker = PreprocessorWorker(self._args)
+            self._workers.append(worker)
+            return worker
+
+    # preprocess the files of the configuration in one of the workers
+    # returns a dictionary with the processed files and the items
+    def run(self, config):
+        with self._semaphore:
+            worker = self._get_worker()
+            try:
+                result = worker.run(config)
+            except:
+                with self._lock:
+                    self._workers.remove(worker)
+                worker.close()
+                raise
+            with self._lock:
+                self._idle.append(worker)
+            return result
+
+    def close(self):
+        with self._lock:
+            workers = self._workers
+            self._workers = []
+            self._idle = []
+        for worker in workers:
+            worker.close()
@@ -5,7 +5,8 @@
 import argparse
 import json
 import sys
-import pickle
+import os
+import threading
 from os import path
 try:
     from pcpp.preprocessor import Preprocessor, OutputDirective, Action
@@ -18,101 +19,146 @@ except Exception as e:
     print("Run 'pio run -t spgm_install_requirements' to install the requirements")
     print()
     sys.exit(1)
-from generator import SpgmPreprocessor
-
-class LexToken(object):
-    def __init__(self, tok):
-        self.type = tok.type
-        self.value = tok.value
-        self.source = tok.source
-        self.lineno = tok.lineno
-        if hasattr(tok, 'expanded_from'):
-            self.expanded_from = getattr(tok, 'expanded_from')
+from generator import SpgmPreprocessor, TokenCache, MacroCache, HeaderIndex, Item, PreprocessorDaemonServer
 
 parser = argparse.ArgumentParser(description='PCPP')
-parser.add_argument('--file', help="temporary file to exchange data", required=True, type=argparse.FileType('r+t'))
-parser.add_argument('--cache', help="temporary file to cache the preprocessor object", type=argparse.FileType('r+b'))
+parser.add_argument('--file', help="temporary file to exchange data", type=argparse.FileType('r+t'))
+parser.add_argument('--cache-dir', help="directory to store the macro cache")
+parser.add_argument('--worker', help="read requests from stdin and write the results to stdout, one per line", action='store_true', default=False)
+parser.add_argument('--daemon', help="run as daemon and process requests from the socket stored in the cache directory", action='store_true', default=False)
+parser.add_argument('--idle-timeout', help="time in seconds until the daemon exits if no requests are received", type=int, default=600)
 parser.add_argument('-v', '--verbose', help='enable verbose output', action='store_true', default=False)
 parser.add_argument('-i', '--info', help='display files being processed', action='store_true', default=False)
 args = parser.parse_args()
 
+if not args.file and not args.worker and not args.daemon:
+    parser.error('--file, --worker or --daemon required')
+if args.daemon and not args.cache_dir:
+    parser.error('--daemon requires --cache-dir')
+
 def verbose(*vargs, **kwargs):
     if args.verbose:
         print(*vargs, **kwargs)
 
-config = json.loads(args.file.read())
-
-try:
-    fcpp = SpgmPreprocessor(args.info)
-    data = pickle.load(args.cache)
-    fcpp.include_once = data['include_once']
-    fcpp.macros = data['macros']
-    verbose('cached macros: %u' % len(fcpp.macros))
-except EOFError as e:
-    fcpp = SpgmPreprocessor(args.info)
-except Exception as e:
-    verbose('failed to load object from cache: %s' % e)
+def create_preprocessor(config):
     fcpp = SpgmPreprocessor(args.info)
 
-for define, value in config['defines']:
-    verbose('define %s=%s' % (define, value))
-    fcpp.define('%s %s' % (define, value))
-
-for define, value in config['pcpp_defines']:
-    verbose('pcpp_defines %s=%s' % (define, value))
-    fcpp.define('%s %s' % (define, value))
-
-for include in config['include_dirs']:
-    verbose('include_dir %s' % include)
-    fcpp.add_path(include)
-
-for skip_include in config['skip_includes']:
-    verbose('skip_include %s' % skip_include)
-    fcpp.add_skip_include(skip_include)
-
-# print('source_excludes', True)
-# for exclude_pattern in config.source_excludes:
-#     print('exclude_pattern %s' % exclude_pattern)
-#     fcpp.add_skip_include(exclude_pattern)
-
-# verbose('target %s' % config['target'])
-
-# combine all source files to speed up parsing
-source = ''
-for (absfile, file) in config['files']:
-    verbose('files %s' % absfile)
-    source += '#include "%s"\n' % absfile
-
-verbose('preprocessing files %u files' % len(config['files']))
-# parse files
-fcpp.parse(source)
-fcpp.find_strings()
-
-items = []
-for item in fcpp.items:
-    for location in item.locations:
-        item_out = {
-            'source': item.source_str,
-            'name': item.name,
-            'type': str(location.definition_type),
-            'value': item._value,
-            'auto': item._value,
-            'data': item._data
-            # 'i18n': item.i18n.translations
-        }
-        items.append(item_out)
-
-verbose('creating output files... %u items from %u files' % (len(items), len(fcpp.files)))
-
-processed_files = sorted(fcpp.files)
-
-out = {
-    'files': processed_files,
-    'items': items
-}
-
-# if args.verbose:
-#     print(json.dumps(out, indent=2))
+    macro_cache = None
+    if args.cache_dir:
+        macro_cache = MacroCache(args.cache_dir, config, SpgmPreprocessor.version)
+
+    if macro_cache and macro_cache.load(fcpp):
+        verbose('cached macros: %u' % len(fcpp.macros))
+    else:
+        for define, value in config['defines']:
+            verbose('define %s=%s' % (define, value))
+            fcpp.define('%s %s' % (define, value))
+
+        for define, value in config['pcpp_defines']:
+            verbose('pcpp_defines %s=%s' % (define, value))
+            fcpp.define('%s %s' % (define, value))
+
+        if macro_cache:
+            verbose('storing %u macros in cache %s' % (len(fcpp.macros), macro_cache.filename))
+            macro_cache.store(fcpp)
+
+    for include in config['include_dirs']:
+        verbose('include_dir %s' % include)
+        fcpp.add_path(include)
+
+    for skip_include in config['skip_includes']:
+        verbose('skip_include %s' % skip_include)
+        fcpp.add_skip_include(skip_include)
+
+    if config.get('token_cache_size', 0)>0:
+        verbose('token cache %s' % config['build_database_dir'])
+        fcpp.set_token_cache(TokenCache.get_instance(config['build_database_dir'], SpgmPreprocessor.version, config['token_cache_size']))
+
+    if config.get('header_index', False):
+        verbose('header index %s' % config['build_database_dir'])
+        fcpp.set_header_index(HeaderIndex.get_instance(config['build_database_dir'], HeaderIndex.get_key(config, SpgmPreprocessor.version)))
+
+    # print('source_excludes', True)
+    # for exclude_pattern in config.source_excludes:
+    #     print('exclude_pattern %s' % exclude_pattern)
+    #     fcpp.add_skip_include(exclude_pattern)
+
+    # baseline for each request
+    fcpp.snapshot()
+
+    return fcpp
+
+def preprocess(fcpp, config):
+    # verbose('target %s' % config['target'])
+
+    # combine all source files to speed up parsing
+    source = ''
+    for (absfile, file) in config['files']:
+        verbose('files %s' % absfile)
+        source += '#include "%s"\n' % absfile
+
+    verbose('preprocessing files %u files' % len(config['files']))
+    # parse files
+    fcpp.process(source)
+
+    items = Item.get_database_items(fcpp.items)
+
+    verbose('creating output files... %u items from %u files' % (len(items), len(fcpp.files)))
+
+    out = {
+        'files': sorted(fcpp.files),
+        'items': items
+    }
+
+    fcpp.cleanup()
+
+    # if args.verbose:
+    #     print(json.dumps(out, indent=2))
+
+    return out
+
+# preprocessor for each configuration
+preprocessors = {}
+
+def get_preprocessor(config):
+    key = json.dumps([MacroCache.get_key(config, SpgmPreprocessor.version), config['skip_includes'], config.get('token_cache_size', 0), config.get('header_index', False)])
+    if not key in preprocessors:
+        preprocessors[key] = create_preprocessor(config)
+    return preprocessors[key]
+
+if args.daemon:
+    lock = threading.Lock()
+
+    def handler(config):
+        with lock:
+            out = preprocess(get_preprocessor(config), config)
+            # store the index after each request, the daemon might be killed
+            if config.get('header_index', False):
+                HeaderIndex.get_instance(config['build_database_dir'], HeaderIndex.get_key(config, SpgmPreprocessor.version)).write()
+            return out
+
+    verbose('daemon started, pid %u' % os.getpid())
+    PreprocessorDaemonServer(args.cache_dir, args.idle_timeout, handler).serve()
+    verbose('daemon stopped, pid %u' % os.getpid())
+    sys.exit(0)
+
+if args.worker:
+    # keep stdout for the results, any other output goes to stderr
+    output = sys.stdout
+    sys.stdout = sys.stderr
+    for line in sys.stdin:
+        try:
+            config = json.loads(line)
+            out = preprocess(get_preprocessor(config), config)
+        except Exception as e:
+            out = {'error': '%s: %s' % (e.__class__.__name__, e)}
+        output.write(json.dumps(out) + '\n')
+        output.flush()
+    sys.exit(0)
+
+config = json.loads(args.file.read())
+
+out = preprocess(create_preprocessor(config), config)
 
 # store output in temporary file
 args.file.seek(0)
@@ -120,20 +166,4 @@ args.file.truncate(0)
 args.file.write(json.dumps(out))
 args.file.close()
 
-fcpp.cleanup()
-
-args.cache.seek(0)
-args.cache.truncate(0)
-
-verbose('storing %u macros in cache' % (len(fcpp.macros)))
-
-for key, macro in fcpp.macros.items():
-    if macro.value!=None:
-        for i, tok in enumerate(macro.value):
-            macro.value[i] = LexToken(tok)
-pickle.dump({
-    'include_once': fcpp.include_once,
-    'macros': fcpp.macros
-}, args.cache)
-
-sys.exit(0)
\ No newline at end of file
+sys.exit(0)
@@ -40,4 +40,3 @@ if not 'spgm_build' in COMMAND_LINE_TARGETS:
         SpgmConfig.verbose('SPGM generator auto run: never')
 
 env.AlwaysBuild(env.Alias("spgm_install_requirements", None, spgm_extra_script.run_install_requirements))
-env.AlwaysBuild(env.Alias("spgm_build", None, spgm_extra_script.run_spgm_build))
@@ -4,12 +4,14 @@
 
 import argparse
 import sys
+import os
+import time
 import pickle
 import fnmatch
 from os import path
 import re
 from pprint import pprint
-from generator import FileWrapper, DefinitionType, DatabaseHelpers
+from generator import DefinitionType, DatabaseEngineType, CompressionType, DatabaseHelpers, DatabaseStorage, BinaryStorage, DebugExport, FileWrapper, FileLock
 
 class Database(object):
     def __init__(self, data):
@@ -22,13 +24,16 @@ class Database(object):
         self._items = data['items']
         self._values = {}
         self._source_files = []
+        # {path: [items]}
+        self._items_per_source = {}
         self._static = []
         for target_idx, items in self._items.items():
             self.source_locations += len(items)
             for item in items.values():
-                tmp = item.location.split(':', 2)
-                if not tmp[1] in self._source_files:
-                    self._source_files.append(tmp[1])
+                if not item.file in self._items_per_source:
+                    self._items_per_source[item.file] = []
+                    self._source_files.append(item.file)
+                self._items_per_source[item.file].append(item)
                 if not item.name in self._values:
                     self._values[item.name] = None
                 if item['own_value']!=None:
@@ -77,18 +82,101 @@ class Database(object):
             for item in items.values():
                 if fnmatch.fnmatch(item.name, query):
                     result['items'][item.name] = item
-                    tmp = item.location.split(':', 1)
                     if not item.name in result['locations']:
                         result['locations'][item.name] = []
                         result['values'][item.name] = []
                     if item['own_value']!=None:
                         result['values'][item.name] = item['own_value']
-                    result['locations'][item.name].append((tmp[1], item['type']))
+                    result['locations'][item.name].append((item.source, item['type']))
         result['items'] = sorted(list(result['items'].values()), key=lambda item: item.name)
         return result
 
+    # items of all source files matching the pattern. wildcards allowed
+    def query_file(self, pattern):
+        result = {}
+        for file, items in self._items_per_source.items():
+            if fnmatch.fnmatch(file, pattern) or fnmatch.fnmatch(path.basename(file), pattern):
+                items = sorted(items, key=lambda item: (item.line or 0, item.column or 0, item.name))
+                result[file] = ['%s:%s %s %s' % (item.line, item.column, item.type, item.name) for item in items]
+        return result
+
+# query a binary database without reading all items
+# returns the same result as Database.query()
+def query_binary(reader, query):
+    if query.startswith('SPGM_'):
+        query = query[5:]
+    result = {
+        'items': [],
+        'values': {},
+        'locations': {}
+    }
+    for name in reader.find_names(query):
+        items = reader.get_items(name)
+        if not items:
+            continue
+        result['items'].append(items[-1])
+        result['values'][name] = []
+        result['locations'][name] = []
+        for item in items:
+            if item['own_value']!=None:
+                result['values'][name] = item['own_value']
+            result['locations'][name].append((item.source, item['type']))
+    result['items'] = sorted(result['items'], key=lambda item: item.name)
+    return result
+
+# compression levels to benchmark. None is the default of the codec
+BENCHMARK_LEVELS = {
+    CompressionType.NONE: [None],
+    CompressionType.LZMA: [0, None],
+    CompressionType.GZIP: [1, None, 9],
+    CompressionType.BZ2: [1, None],
+    CompressionType.ZSTD: [1, None, 19],
+    CompressionType.LZ4: [None, 9]
+}
+
+# compress and decompress the pickled database with each codec
+# returns a list of (type, level, size, write time, read time)
+def benchmark_compression(data, dir, repeat=3):
+    payload = pickle.dumps(data)
+    results = []
+    for type, levels in BENCHMARK_LEVELS.items():
+        if not FileWrapper.is_available(type):
+            print('%s: not available, requires the python module %s' % (type.value, FileWrapper.CODECS[type][0].split('.')[0]))
+            continue
+        for level in levels:
+            tmp_file = path.join(dir, 'benchmark.%u.tmp%s' % (os.getpid(), type.extension))
+            write_time = read_time = None
+            try:
+                for n in range(repeat):
+                    start = time.perf_counter()
+                    with FileWrapper.open(tmp_file, 'wb', level) as file:
+                        file.write(payload)
+                    write_time = min(write_time or float('inf'), time.perf_counter() - start)
+                    start = time.perf_counter()
+                    with FileWrapper.open(tmp_file, 'rb') as file:
+                        while file.read(1 << 16):
+                            pass
+                    read_time = min(read_time or float('inf'), time.perf_counter() - start)
+                size = os.path.getsize(tmp_file)
+            finally:
+                if path.isfile(tmp_file):
+                    os.unlink(tmp_file)
+            results.append((type, level, size, write_time, read_time))
+    return results
+
+# the pickle engine reads and writes the entire database for each object. the recommended
+# setting is the fastest codec that creates less than twice the size of the smallest file
+def get_recommended_compression(results):
+    min_size = min([result[2] for result in results])
+    candidates = [result for result in results if result[2]<=min_size * 2]
+    return min(candidates, key=lambda result: result[3] + result[4])
+
+# encode all values in one pass, format_value() uses the memoized results
+def prepare_values(values):
+    DatabaseHelpers.encode_literals([value for value in values if isinstance(value, str)])
+
 def format_value(value):
-    value = DatabaseHelpers.split_hex(DatabaseHelpers.encode_binary(value))
+    value = DatabaseHelpers.encode_literal(value)
     # value = value.replace('\\', '\\\\').replace('"', '\\"')
     return value
 
@@ -124,21 +212,86 @@ parser.add_argument('-d', '--database-dir', help='database directory', required=
 parser.add_argument('-q', '--query', help='query database. wildcards allowed')
 parser.add_argument('-f', '--format', help='query output format', choices=['auto_init', 'define', 'declare', 'kv'])
 parser.add_argument('-l', '--list', help='list source files', action='store_true')
+parser.add_argument('-F', '--file', help='list items of source files. wildcards allowed')
 parser.add_argument('-c', '--create', help='create spgm_auto_strings.*', nargs=2)
+parser.add_argument('--benchmark', help='benchmark compression codecs with the current database', action='store_true')
+parser.add_argument('--convert', help='convert database to another engine', choices=[type.value for type in DatabaseEngineType])
+parser.add_argument('-j', '--export-json', help='export database as JSON. default: <database-dir>/_debug.json', nargs='?', const='', metavar='FILE')
 # parser.add_argument('--cache', help='temporary file to cache the preprocessor object', type=argparse.FileType('r+b'))
 # parser.add_argument('-v', '--verbose', help='enable verbose output', action='store_true', default=False)
 args = parser.parse_args()
 
 debug_db_file = path.join(args.database_dir, '_debug.json')
-db_file = path.join(args.database_dir, 'database.pickle')
-if not path.isfile(db_file):
-    db_file += '.xz'
-    if not path.isfile(db_file):
-        parser.error('cannot find database in %s' % args.database_dir)
+storage = DatabaseStorage.find(args.database_dir)
+if not storage:
+    parser.error('cannot find database in %s' % args.database_dir)
+
+if args.query and isinstance(storage, BinaryStorage) and not (args.list or args.file or args.create or args.export_json!=None or args.convert):
+    # the file is replaced atomically, the mapped file does not change while it is open
+    with storage.open() as reader:
+        query = query_binary(reader, args.query)
+        if not query['items']:
+            print('could not find any item for "%s"' % args.query);
+            sys.exit(0)
+        if args.format:
+            prepare_values(query['values'].values())
+            for item in query['items']:
+                print_formatted(args.format, query, item)
+        else:
+            query['items'] = [item.name for item in query['items']]
+            pprint(query)
+    sys.exit(0)
+
+# wait for builds that are writing the database
+with FileLock(args.database_dir, True, 60):
+    data = storage.read()
+
+if args.benchmark:
+    results = benchmark_compression(data, args.database_dir)
+    size = results[0][2]
+    print('%-6s %-7s %12s %7s %10s %10s' % ('codec', 'level', 'size', 'ratio', 'write ms', 'read ms'))
+    for type, level, compressed_size, write_time, read_time in results:
+        print('%-6s %-7s %12u %6.1f%% %10.2f %10.2f' % (type.value or 'none', level==None and 'default' or level, compressed_size, compressed_size * 100.0 / max(1, size), write_time * 1000, read_time * 1000))
+    type, level = get_recommended_compression(results)[0:2]
+    print()
+    print('recommended setting:')
+    print('custom_spgm_generator.build_database_compression = %s' % (type.value or 'none'))
+    if level!=None:
+        print('custom_spgm_generator.build_database_compression_level = %u' % level)
+    sys.exit(0)
+
+if args.convert:
+    target_storage = DatabaseStorage.create(DatabaseEngineType.fromString(args.convert), args.database_dir)
+    if target_storage.filename==storage.filename:
+        parser.error('database is already stored as %s' % args.convert)
+    # the source database is removed after the conversion has been verified. otherwise both
+    # databases would exist and builds and queries might use the old one
+    # the items are compared by their rows, which contain all attributes. if the conversion fails,
+    # the new database is removed
+    with FileLock(args.database_dir, False, 60):
+        try:
+            target_storage.write_all(data)
+            if DatabaseStorage.get_rows(target_storage.read())!=DatabaseStorage.get_rows(data):
+                raise RuntimeError('failed to convert database: %s' % target_storage.filename)
+        except:
+            target_storage.remove()
+            raise
+        storage.remove()
+    print('created %s' % target_storage.filename)
+    print('removed %s' % storage.filename)
+    sys.exit(0)
+
+if args.export_json!=None:
+    filename = args.export_json or debug_db_file
+    if filename=='-':
+        DebugExport(data).write(sys.stdout)
+        print()
+    else:
+        DebugExport(data).write_file(filename)
+        print('created %s' % filename)
+    sys.exit(0)
 
-with FileWrapper.open(db_file, 'rb') as file:
-    data = pickle.load(file)
-    db = Database(data)
+db = Database(data)
 
 def check_auto_gen_file(filename):
     if not path.isfile(filename):
@@ -180,12 +333,13 @@ if args.create:
         print('// AUTO GENERATED FILE - DO NOT MODIFY', file=file)
         print('#include "spgm_auto_strings.h"', file=file)
 
+        prepare_values([db.get_value(name) for name in db._unique.keys()])
         for item in db._unique.values():
             item = list(item.values())[0]
             if not item.name in db._static:
                 # if item['value']:
                 try:
-                    print('PROGMEM_STRING_DEF(%s, "%s");' % (item.name, DatabaseHelpers.split_hex(DatabaseHelpers.encode_binary(db.get_value(item.name)))), file=file)
+                    print('PROGMEM_STRING_DEF(%s, "%s");' % (item.name, DatabaseHelpers.encode_literal(db.get_value(item.name))), file=file)
                 except:
                     pass
 
@@ -198,6 +352,17 @@ if args.list:
         print(file)
     sys.exit(0)
 
+if args.file:
+    result = db.query_file(args.file)
+    if not result:
+        print('could not find any source file for "%s"' % args.file);
+        sys.exit(0)
+    for file in sorted(result.keys()):
+        print(file)
+        for location in result[file]:
+            print('  %s' % location)
+    sys.exit(0)
+
 if not args.query:
     print('Database info')
     print('-'*40)
@@ -213,6 +378,7 @@ if not query['items']:
     print('could not find any item for "%s"' % args.query);
     sys.exit(0)
 if args.format:
+    prepare_values(query['values'].values())
     for item in query['items']:
         print_formatted(args.format, query, item)
 else:
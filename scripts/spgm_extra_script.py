@@ -13,7 +13,7 @@ import sys
 import tempfile
 import subprocess
 import fnmatch
-from generator import SpgmConfig,  Generator, DatabaseHelpers, SpgmPreprocessor
+from generator import SpgmConfig,  Generator, DatabaseHelpers, SpgmPreprocessor, Fingerprint, TokenCache, HeaderIndex, LexicalExtractor, LexicalFallback, PreprocessorPool, PreprocessorDaemon, Item
 import threading
 import generator
 import atexit
@@ -21,8 +21,8 @@ import json
 import tempfile
 import time
 import click
-import hashlib
-import re
+import mmap
+from concurrent.futures import ThreadPoolExecutor
 
 env = None # type: SConsEnvironment
 DefaultEnvironmentCall('Import')("env")
@@ -31,6 +31,12 @@ class SpgmExtraScript(object):
 
     temporary_files = []
 
+    # output files
+    OUTPUT_DECLARATION = 'declaration'
+    OUTPUT_DEFINITION = 'definition'
+    OUTPUT_STATIC = 'static'
+    OUTPUT_AUTO_DEFINED = 'auto_defined'
+
     # add file to list of temporary files to be deleted up on exit
     def temporary_files_add(file):
         if file in SpgmExtraScript.temporary_files:
@@ -67,9 +73,15 @@ class SpgmExtraScript(object):
         self._use_cli = False
         self.verbose = SpgmConfig._verbose
         self._source_files = []
+        self._auto_strings_target = None
         # self._read_lock = threading.Lock()
         self._write_lock = threading.BoundedSemaphore()
-        self._pcpp_cache = None
+        # lock for the shared preprocessor
+        self._pcpp_lock = threading.Lock()
+        self._pcpp_pool = None
+        self._pcpp_daemon = None
+        self._include_pattern_executor = None
+        self._include_pattern_futures = {}
         atexit.register(SpgmExtraScript.exit_handler)
 
     #
@@ -128,6 +140,7 @@ class SpgmExtraScript(object):
                     if fnmatch.fnmatch(file, pattern):
                         return node
                 self._source_files.append(node)
+                self._include_pattern_prefetch(file, config)
                 return node
             return None
 
@@ -141,13 +154,22 @@ class SpgmExtraScript(object):
         SpgmConfig.debug('spgm_extra_script.add_pre_actions', True)
         DatabaseHelpers._env = env
         DatabaseHelpers._script = self
+        render = None
+        if self._auto_strings_target and SpgmConfig(env).batch:
+            # render the output files once after all targets have been processed. the action cannot be a
+            # pre action of the definition file's object since it runs only if the object is out of date
+            render = env.Alias('spgm_render', [], self.run_spgm_render)
+            env.AlwaysBuild(render)
+            env.Requires(self._auto_strings_target.get_path() + '.o', render)
         if self._source_files:
             for node in self._source_files:
                 # add pre actions for every target to be scanned
                 env.AddPreAction(node.get_path() + '.o', self.run_spgm_generator)
                 # add all source files to the requirements of the definition file
                 # to compile it after collection all strings
-                if self._auto_strings_target:
+                if render:
+                    env.Requires(render, node.get_path() + '.o')
+                elif self._auto_strings_target:
                     env.Requires(self._auto_strings_target.get_path() + '.o', node.get_path() + '.o')
 
         # env.AddPreAction(env.get("PIOMAINPROG"), spgm_extra_script.run_mainprog)
@@ -162,22 +184,39 @@ class SpgmExtraScript(object):
     #         file.write('\n')
 
 
-    def _include_pattern_match(self, filename, pattern=None):
+    def _include_pattern_scan(pattern, filename):
+        with open(filename, 'rb') as file:
+            try:
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    return pattern.search(data)!=None
+            except ValueError:
+                # empty files cannot be mapped
+                return pattern.search(file.read())!=None
+
+    # check if the file matches the include_pattern
+    # the result is stored for the contents of the file and unmodified files are not scanned again
+    def _include_pattern_match(self, filename, config):
+        pattern = config.include_pattern_bytes
         if not pattern:
             return True
         try:
-            with open(filename, 'rt') as file:
-                line = file.readline()
-                while line:
-                    if re.match(pattern, line):
-                        return True
-                    line = file.readline()
-        except UnicodeDecodeError as e:
-            click.secho('skipping %s cause of %s' % (filename, e), fg='yellow')
-            return False
+            name = 'include_pattern:%s:%u' % (pattern.pattern, pattern.flags)
+            return Fingerprint.get_instance(config.build_database_dir).get_verdict(filename, name, lambda file: SpgmExtraScript._include_pattern_scan(pattern, file))
         except Exception as e:
             raise RuntimeError("Exception while checking file %s: %s" % (filename, e));
-        return False
+
+    # check the files in the background while the nodes are being collected
+    def _include_pattern_prefetch(self, filename, config):
+        if not config.include_pattern_bytes or filename in self._include_pattern_futures:
+            return
+        if self._include_pattern_executor==None:
+            self._include_pattern_executor = ThreadPoolExecutor()
+        self._include_pattern_futures[filename] = self._include_pattern_executor.submit(self._include_pattern_match, filename, config)
+
+    def _include_pattern_result(self, filename, config):
+        if filename in self._include_pattern_futures:
+            return self._include_pattern_futures[filename].result()
+        return self._include_pattern_match(filename, config)
 
     def _create_pcpp(self, config):
         fcpp = SpgmPreprocessor(False)
@@ -198,12 +237,169 @@ class SpgmExtraScript(object):
             SpgmConfig.verbose('skip_include %s' % skip_include)
             fcpp.add_skip_include(skip_include)
 
+        if config['token_cache_size']>0:
+            fcpp.set_token_cache(TokenCache.get_instance(config['build_database_dir'], SpgmPreprocessor.version, config['token_cache_size']))
+
+        if config['header_index']:
+            fcpp.set_header_index(HeaderIndex.get_instance(config['build_database_dir'], HeaderIndex.get_key(config, SpgmPreprocessor.version)))
+
+        # baseline for each translation unit
+        fcpp.snapshot()
+
         return fcpp
 
+    # returns the items and processed files or None if the files require the preprocessor
+    def _run_lexical_extractor(self, gen, data, config):
+        extractor = config.cache('lexical_extractor', lambda: LexicalExtractor(data))
+        try:
+            items, files = extractor.extract([absfile for absfile, file in gen.files])
+        except (LexicalFallback, RuntimeError) as e:
+            if config.extractor=='lexical':
+                raise RuntimeError('%s: cannot extract strings without preprocessor: %s' % (gen._database._target, e))
+            SpgmConfig.debug_verbose('%s requires preprocessor: %s' % (gen._database._target, e))
+            return None
+        SpgmConfig.verbose('lexical extractor: %u items from %u files' % (len(items), len(files)))
+        return (Item.get_database_items(items), sorted(files))
+
+    # preprocess files with the shared preprocessor of the configuration
+    def _run_pcpp(self, gen, data, config):
+        with self._pcpp_lock:
+            pcpp = config.cache('pcpp', lambda: self._create_pcpp(data))
+
+            source = ''
+            for (absfile, file) in gen.files:
+                SpgmConfig.verbose('files %s' % absfile)
+                source += '#include "%s"\n' % absfile
+
+            # start with the macros from the configuration only
+            pcpp.process(source)
+
+            items = Item.get_database_items(pcpp.items)
+            processed_files = sorted(pcpp.files)
+
+            pcpp.cleanup()
+
+        return (items, processed_files)
+
+    # preprocess files in one of the worker processes
+    def _run_pcpp_pool(self, gen, data, config):
+        with self._pcpp_lock:
+            if self._pcpp_pool==None:
+                args = config.pcpp_bin.split(' ') + ['--worker', '--cache-dir', config.build_database_dir]
+                if SpgmConfig._verbose:
+                    args.append('--verbose')
+                self._pcpp_pool = PreprocessorPool(args, config.jobs)
+                SpgmConfig.verbose('started preprocessor pool with %u workers' % self._pcpp_pool.size)
+        for file in gen.files:
+            click.echo('Preprocessing %s' % (file[1]))
+        try:
+            output = self._pcpp_pool.run(data)
+        except RuntimeError as e:
+            gen._database.add_error(str(e), fatal=True)
+        return (output['items'], output['files'])
+
+    # preprocess files with the daemon, which is started if not running
+    def _run_pcpp_daemon(self, gen, data, config):
+        with self._pcpp_lock:
+            if self._pcpp_daemon==None:
+                args = config.pcpp_bin.split(' ')
+                if SpgmConfig._verbose:
+                    args.append('--verbose')
+                self._pcpp_daemon = PreprocessorDaemon(args, config.build_database_dir, config.daemon_idle_timeout)
+        for file in gen.files:
+            click.echo('Preprocessing %s' % (file[1]))
+        try:
+            output = self._pcpp_daemon.run(data)
+        except RuntimeError as e:
+            gen._database.add_error(str(e), fatal=True)
+        return (output['items'], output['files'])
+
+    # preprocess files with pcpp_cli.py
+    def _run_pcpp_cli(self, gen, data, config):
+        tmpfile = None
+        try:
+            with tempfile.NamedTemporaryFile('wt', delete=False) as file:
+                file.write(json.dumps(data))
+                tmpfile = file.name
+                SpgmExtraScript.temporary_files_add(tmpfile)
+
+                for file in gen.files:
+                    click.echo('Preprocessing %s' % (file[1]))
+
+            args = config.pcpp_bin.split(' ')
+            args += ['--file', tmpfile, '--cache-dir', config.build_database_dir]
+            if SpgmConfig._verbose:
+                args.append('--verbose')
+                args.append('--info')
+                # display all output
+                proc = subprocess.Popen(args, text=True)
+                result = proc.wait(timeout=300)
+                outs = ''
+                errs = ''
+            else:
+                # collect stderr output and display on error
+                proc = subprocess.Popen(args, stderr=subprocess.PIPE)
+                outs, errs = proc.communicate(timeout=300)
+                result = proc.returncode
+
+            if result!=0:
+                gen._database.add_error('processor failed with exit code %u. cmd:\n%s\nstdout: %s\nstderr: %s' % (result, ' '.join(args), str(outs), str(errs)), fatal=True)
+
+            with open(tmpfile, 'rt') as file:
+                output = json.loads(file.read())
+
+            # output['files']: all files processed
+            # output['items']: items found in the files
+            return (output['items'], output['files'])
+
+        finally:
+            SpgmExtraScript.temporary_files_unlink(tmpfile)
+
+    # returns the items and all processed files
+    def _extract_strings(self, gen, data, config):
+        # extract the strings without the preprocessor if the files allow it
+        if config.extractor!='pcpp':
+            result = self._run_lexical_extractor(gen, data, config)
+            if result!=None:
+                return result
+        # the daemon preprocesses a single file at a time, parallel builds use the worker pool
+        if config.jobs>1:
+            return self._run_pcpp_pool(gen, data, config)
+        if config.daemon:
+            return self._run_pcpp_daemon(gen, data, config)
+        if self._use_cli:
+            return self._run_pcpp_cli(gen, data, config)
+        return self._run_pcpp(gen, data, config)
+
+    # create output files
+    # outputs: list of OUTPUT_* or None for all files
+    def _create_output_files(self, gen, config, outputs=None):
+        output_files = [
+            (SpgmExtraScript.OUTPUT_DECLARATION, config.declaration_file, lambda filename: gen.create_output_header(filename, config.declaration_include_file)),
+            (SpgmExtraScript.OUTPUT_DEFINITION, config.definition_file, gen.create_output_define),
+            (SpgmExtraScript.OUTPUT_STATIC, config.statics_file, gen.create_output_static),
+            (SpgmExtraScript.OUTPUT_AUTO_DEFINED, config.auto_defined_file, gen.create_output_auto_defined)
+        ]
+        output_files = [(filename, create) for output, filename, create in output_files if outputs==None or output in outputs]
+
+        # the files are only replaced if their contents has changed, see Generator.write_output_file()
+        for filename, create in output_files:
+            create(filename)
+
     #
     # Run SPGM generator on given target
     #
     def run_spgm_generator(self, target, source, env):
+        config = SpgmConfig(env)
+        # in batch mode, only the declarations are required to compile the target
+        if config.batch and self._auto_strings_target:
+            self._update_target(target, source, env, [SpgmExtraScript.OUTPUT_DECLARATION])
+        else:
+            self._update_target(target, source, env)
+
+    # extract the strings of the target, merge them into the database and create the output files
+    # outputs: list of OUTPUT_* or None for all files
+    def _update_target(self, target, source, env, outputs=None):
 
         start_time = time.monotonic()
         config = SpgmConfig(env)
@@ -213,7 +409,7 @@ class SpgmExtraScript(object):
         files = []
         for node in source:
             file = node.get_abspath()
-            if file!=config.definition_file and not config.is_source_excluded(file) and self._include_pattern_match(file, config.include_pattern):
+            if file!=config.definition_file and not config.is_source_excluded(file) and self._include_pattern_result(file, config):
                 SpgmConfig.debug('source %s' % file)
                 files.append((file, node.get_path()))
 
@@ -246,179 +442,47 @@ class SpgmExtraScript(object):
                 'defines': config.defines,
                 'pcpp_defines': config.pcpp_defines,
                 'include_dirs': config.include_dirs,
-                'skip_includes': config.skip_includes
+                'skip_includes': config.skip_includes,
+                'pcpp_version': SpgmPreprocessor.version,
+                'build_database_dir': config.build_database_dir,
+                'token_cache_size': config.token_cache_size * 1024 * 1024,
+                'header_index': config.header_index
             }
 
-            pcpp = config.cache('pcpp', lambda: self._create_pcpp(data))
+            # skip preprocessing if the files and configuration did not change since the last run
+            # the items stored in the database for this target are still valid
+            if not config.is_first_run and gen._database.is_target_up_to_date(data):
+                SpgmConfig.debug_verbose('%s is up to date, skipping preprocessor (%.3f seconds)' % (gen._database._target, time.monotonic() - start_time))
+                return
 
-            if self._use_cli==False:
-
-                source = ''
-                for (absfile, file) in gen.files:
-                    SpgmConfig.verbose('files %s' % absfile)
-                    source += '#include "%s"\n' % absfile
-
-                pcpp.parse(source)
-                pcpp.find_strings()
-
-                items = []
-                for item in pcpp.items:
-                    for location in item.locations:
-                        item_out = {
-                            'source': item.source_str,
-                            'name': item.name,
-                            'type': str(location.definition_type),
-                            'value': item._value,
-                            'auto': item._value,
-                            'data': item._data
-                            # 'i18n': item.i18n.translations
-                        }
-                        items.append(item_out)
+        finally:
+            DatabaseHelpers.release_lock(self, self._write_lock)
 
-                processed_files = sorted(pcpp.files)
+        # the files are preprocessed without holding the lock, other targets can be processed in parallel
+        items, processed_files = self._extract_strings(gen, data, config)
+        target_hash = gen._database.get_target_hash(processed_files, data)
 
-                SpgmConfig.verbose('creating output files... %u items from %u files' % (len(items), len(processed_files)))
+        DatabaseHelpers.acquire_lock(gen._database, self._write_lock, 3600)
+        try:
+            # the items have been extracted from the snapshot read above. the database is only read
+            # again if other targets or processes have modified it in the meantime
+            if gen.update_database():
+                SpgmConfig.debug('database modified by other targets, read again')
 
-                gen._database.add_target_files(processed_files, DatabaseHelpers.get_hash(processed_files))
+            SpgmConfig.verbose('creating output files... %u items from %u files' % (len(items), len(processed_files)))
 
-                gen.copy_to_database(items)
+            gen._database.add_target_files(processed_files, target_hash)
 
-                SpgmConfig.debug('creating output files', True)
+            gen.copy_to_database(items)
 
-                num = len(items)
-                include_counter = len(processed_files)
+            SpgmConfig.debug('creating output files', True)
 
-                gen.create_output_header(config.declaration_file, config.declaration_include_file)
-                gen.create_output_define(config.definition_file)
-                gen.create_output_static(config.statics_file)
-                gen.create_output_auto_defined(config.auto_defined_file)
+            num = len(items)
+            include_counter = len(processed_files)
 
-                pcpp.cleanup()
+            self._create_output_files(gen, config, outputs)
 
-            else:
-                # DatabaseHelpers.acquire_lock(gen._database, self._write_lock, 300)
-                try:
-                    tmpfile = None
-                    cachefile = None
-
-                    if self._pcpp_cache==None:
-                        with tempfile.NamedTemporaryFile('wb', delete=False) as file:
-                            cachefile = file.name
-                            SpgmExtraScript.temporary_files_add(cachefile)
-                    else:
-                        cachefile = self._pcpp_cache
-
-                    with tempfile.NamedTemporaryFile('wt', delete=False) as file:
-                        file.write(json.dumps(data))
-                        tmpfile = file.name
-                        SpgmExtraScript.temporary_files_add(tmpfile)
-
-                        for file in gen.files:
-                            click.echo('Preprocessing %s' % (file[1]))
-
-                    args = config.pcpp_bin.split(' ')
-                    args += ['--file', tmpfile, '--cache', cachefile]
-                    if SpgmConfig._verbose:
-                        args.append('--verbose')
-                        args.append('--info')
-                        # display all output
-                        proc = subprocess.Popen(args, text=True)
-                        result = proc.wait(timeout=300)
-                        errs = ''
-                    else:
-                        # collect stderr output and display on error
-                        proc = subprocess.Popen(args, stderr=subprocess.PIPE)
-                        outs, errs = proc.communicate(timeout=300)
-                        result = proc.returncode
-
-                    if result!=0:
-                        gen._database.add_error('processor failed with exit code %u. cmd:\n%s\nstdout: %s\nstderr: %s' % (result, ' '.join(args), str(outs), str(errs)), fatal=True)
-
-                    with open(tmpfile, 'rt') as file:
-                        output = json.loads(file.read())
-
-                    # output['files']: all files processed
-                    # output['items']: items found in the files
-
-                    gen._database.add_target_files(output['files'], DatabaseHelpers.get_hash(output['files']))
-
-                    # get a lock for updating files
-                    # DatabaseHelpers.acquire_lock(gen._database, self._write_lock, 300)
-                    try:
-                        if self._pcpp_cache==None:
-                            # update our cache file
-                            self._pcpp_cache = cachefile
-                            cachefile = None
-                        elif cachefile==self._pcpp_cache:
-                            # do not delete our current cache
-                            cachefile = None
-                        else:
-                            st1 = os.stat(cachefile)
-                            st2 = os.stat(self._pcpp_cache)
-                            if st1.st_mtime_ns>st2.st_mtime_ns:
-                                # the new cache is more recent
-                                SpgmExtraScript.temporary_files_unlink(self._pcpp_cache)
-                                self._pcpp_cache = cachefile
-                                cachefile = None
-
-                        gen.copy_to_database(output['items'])
-
-                        SpgmConfig.debug('creating output files', True)
-
-                        num = len(output['items'])
-                        include_counter = len(output['files'])
-
-                        def get_tmp():
-                            with tempfile.NamedTemporaryFile('wt', delete=False) as file:
-                                SpgmExtraScript.temporary_files_add(file.name)
-                                return file.name
-
-                        # compare contents and discard tmp file if the same
-                        def compare_move_tmpfile(tmp, out):
-                            # print('move %s -> %s' % (tmp, out))
-                            try:
-                                if not path.isfile(out):
-                                    os.renames(tmp, out)
-                                    return
-                                with open(tmp, 'rb') as file:
-                                    hash1 = hashlib.md5(file.read()).digest()
-                                with open(out, 'rb') as file:
-                                    hash2 = hashlib.md5(file.read()).digest()
-                                if hash1==hash2:
-                                    return
-                                try:
-                                    os.unlink(out)
-                                except:
-                                    pass
-                                os.renames(tmp, out)
-                            finally:
-                                SpgmExtraScript.temporary_files_unlink(tmp)
-
-                        tmp1 = get_tmp()
-                        gen.create_output_header(tmp1, config.declaration_include_file)
-                        compare_move_tmpfile(tmp1, config.declaration_file)
-
-                        tmp1 = get_tmp()
-                        gen.create_output_define(tmp1)
-                        compare_move_tmpfile(tmp1, config.definition_file)
-
-                        tmp1 = get_tmp()
-                        gen.create_output_static(tmp1)
-                        compare_move_tmpfile(tmp1, config.statics_file)
-
-                        tmp1 = get_tmp()
-                        gen.create_output_auto_defined(tmp1)
-                        compare_move_tmpfile(tmp1, config.auto_defined_file)
-
-                        SpgmConfig.debug_verbose('created %u items from %u include files in %.3f seconds' % (num, include_counter, time.monotonic() - start_time))
-
-                    finally:
-                        # DatabaseHelpers.release_lock(self, self._write_lock)
-                        pass
-
-                finally:
-                    SpgmExtraScript.temporary_files_unlink(tmpfile)
-                    SpgmExtraScript.temporary_files_unlink(cachefile)
+            SpgmConfig.debug_verbose('created %u items from %u include files in %.3f seconds' % (num, include_counter, time.monotonic() - start_time))
 
             SpgmConfig.debug('output_language %s' % gen.language)
             SpgmConfig.debug('declaration_file %s' % config.declaration_file)
@@ -429,10 +493,46 @@ class SpgmExtraScript(object):
             DatabaseHelpers.release_lock(self, self._write_lock)
 
     #
-    # run SPGM generator on target
+    # Render all output files once in batch mode
+    #
+    def run_spgm_render(self, target, source, env):
+        start_time = time.monotonic()
+        config = SpgmConfig(env)
+        gen = Generator(config, [], target, env)
+
+        DatabaseHelpers.acquire_lock(gen._database, self._write_lock, 3600)
+        try:
+            gen.read_database()
+            gen.language = config.output_language
+
+            SpgmConfig.debug('creating output files', True)
+            self._create_output_files(gen, config)
+
+            SpgmConfig.debug_verbose('created output files in %.3f seconds' % (time.monotonic() - start_time))
+
+        finally:
+            DatabaseHelpers.release_lock(self, self._write_lock)
+
+    #
+    # Process all source files in a single pass without compiling them
     #
     def run_spgm_build(self, target, source, env):
-        self.add_pre_actions(env)
+        start_time = time.monotonic()
+        config = SpgmConfig(env)
+        DatabaseHelpers._env = env
+        DatabaseHelpers._script = self
+
+        SpgmConfig.debug('spgm_build: %u source files' % len(self._source_files), True)
+        with ThreadPoolExecutor(max_workers=config.jobs) as executor:
+            futures = []
+            for node in self._source_files:
+                futures.append(executor.submit(self._update_target, [env.File(node.get_path() + '.o')], [node], env, []))
+            for future in futures:
+                future.result()
+
+        self.run_spgm_render(target, source, env)
+
+        SpgmConfig.debug_verbose('processed %u source files in %.3f seconds' % (len(self._source_files), time.monotonic() - start_time))
 
 if int(ARGUMENTS.get("PIOVERBOSE", 0)):
     SpgmConfig._verbose = True
@@ -445,7 +545,7 @@ if not hasattr(generator, 'spgm_extra_script'):
 
 spgm_extra_script = generator.spgm_extra_script
 
-env.AddCustomTarget("spgm_build", [env.get("PIOMAINPROG")], [], title="build spgm strings", description=None, always_build=False)
+env.AddCustomTarget("spgm_build", None, [ spgm_extra_script.run_spgm_build ], title="build spgm strings", description="extract the strings of all source files and create the output files", always_build=True)
 env.AddCustomTarget("spgm_install_requirements", None, [ lambda target, source, env: click.secho('Installing requirements for SPGM generator...', fg='yellow') ], title="install requirements", description="install requirements for SPGM generator", always_build=True)
 
 spgm_extra_script.register_middle_ware(env)
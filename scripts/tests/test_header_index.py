@@ -0,0 +1,82 @@
+#
+# Author: sascha_lammers@gmx.de
+#
+
+import os
+import sys
+import tempfile
+import unittest
+from os import path
+
+sys.path.insert(0, path.abspath(path.join(path.dirname(__file__), '..')))
+
+from generator import SpgmPreprocessor, HeaderIndex
+
+# preprocess translation units with a shared preprocessor and header index like the daemon or a worker
+class HeaderIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self._dir = self._tmp.name
+        self._cache_dir = path.join(self._dir, 'build')
+        os.makedirs(self._cache_dir)
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def _write(self, name, text):
+        file = path.join(self._dir, name)
+        with open(file, 'wt') as f:
+            f.write(text)
+        return file
+
+    def _create_preprocessor(self):
+        fcpp = SpgmPreprocessor(False)
+        fcpp.add_path(self._dir)
+        fcpp.set_header_index(HeaderIndex(self._cache_dir, 'test'))
+        fcpp.snapshot()
+        return fcpp
+
+    def _get_names(self, fcpp, file):
+        fcpp.process('#include "%s"\n' % file)
+        names = set(item.name for item in fcpp.items)
+        fcpp.cleanup()
+        return names
+
+    def test_conditional_include(self):
+        self._write('a.h', '#pragma once\n#ifdef WITH_B\n#include "b.h"\n#endif\n')
+        self._write('b.h', '#pragma once\nSPGM(HiddenString, "hidden");\n')
+        tu1 = self._write('tu1.cpp', '#include "a.h"\n')
+        tu2 = self._write('tu2.cpp', '#define WITH_B 1\n#include "a.h"\n')
+
+        fcpp = self._create_preprocessor()
+        self.assertEqual(self._get_names(fcpp, tu1), set())
+        self.assertIn('HiddenString', self._get_names(fcpp, tu2))
+
+    def test_modified_file_uses_skipped_header(self):
+        self._write('h.h', '#pragma once\n#define ENABLE_X 1\n')
+        self._write('u.h', '#pragma once\nint u;\n')
+        tu = self._write('tu.cpp', '#include "h.h"\n#include "u.h"\n')
+
+        fcpp = self._create_preprocessor()
+        self.assertEqual(self._get_names(fcpp, tu), set())
+        self.assertEqual(self._get_names(fcpp, tu), set())
+        # h.h is skipped before the modified u.h is indexed
+        self._write('u.h', '#pragma once\n#ifdef ENABLE_X\nSPGM(Enabled, "enabled");\n#endif\n')
+        self.assertIn('Enabled', self._get_names(fcpp, tu))
+        self.assertIn('Enabled', self._get_names(fcpp, tu))
+
+    def test_include_guard(self):
+        self._write('a.h', '#ifndef A_H\n#define A_H\n#include "c.h"\n#endif\n')
+        self._write('c.h', '#pragma once\nint c;\n')
+        tu1 = self._write('tu1.cpp', '#include "a.h"\n')
+        tu2 = self._write('tu2.cpp', '#include "a.h"\nSPGM(Visible, "visible");\n')
+
+        fcpp = self._create_preprocessor()
+        self._get_names(fcpp, tu1)
+        self.assertIn('Visible', self._get_names(fcpp, tu2))
+        # headers behind an include guard without strings can be skipped
+        self.assertIsNotNone(fcpp._header_index.get_prunable(path.join(self._dir, 'a.h')))
+
+if __name__ == '__main__':
+    unittest.main()
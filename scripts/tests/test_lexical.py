@@ -0,0 +1,41 @@
+#
+# Author: sascha_lammers@gmx.de
+#
+
+import os
+import sys
+import tempfile
+import unittest
+from os import path
+
+sys.path.insert(0, path.abspath(path.join(path.dirname(__file__), '..')))
+
+from generator.lexical import LexicalExtractor, LexicalFallback
+
+class LexicalExtractorTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self._dir = self._tmp.name
+        self._file = path.join(self._dir, 'main.cpp')
+        with open(self._file, 'wt') as file:
+            file.write('MY_STR(Hidden);\nSPGM(Shown, "shown");\n')
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def _create_extractor(self, defines):
+        return LexicalExtractor({'include_dirs': [], 'skip_includes': [], 'defines': defines, 'pcpp_defines': [], 'build_database_dir': self._dir})
+
+    # a define of the configuration that expands to a string macro requires the preprocessor
+    def test_config_define_alias(self):
+        extractor = self._create_extractor([('MY_STR(x)', 'SPGM(x)')])
+        with self.assertRaises(LexicalFallback):
+            extractor.extract([self._file])
+
+    def test_config_define(self):
+        items, files = self._create_extractor([('MY_STR(x)', 'x')]).extract([self._file])
+        self.assertEqual([item.name for item in items], ['Shown'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+#
+# Author: sascha_lammers@gmx.de
+#
+
+import os
+import sys
+import tempfile
+import unittest
+from os import path
+
+sys.path.insert(0, path.abspath(path.join(path.dirname(__file__), '..')))
+
+from generator import DatabaseEngineType
+from generator.storage import DatabaseStorage
+
+class StorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self._dir = self._tmp.name
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def _create_items(self, source, rows):
+        items = {}
+        for row in rows:
+            item = DatabaseStorage._create_item(None, *((row[0], row[1], source) + row[2:]))
+            items[item.index] = item
+        return items
+
+    # database with a target that only has data, one that only has items and unsorted files
+    def _create_database(self):
+        source1 = path.join(self._dir, 'src', 'main.cpp')
+        source2 = path.join(self._dir, 'src', 'other.cpp')
+        return {
+            'defined': dict((item.name, item) for item in self._create_items(source1, [('Defined', 'DEFINE', 3, 1, 'value', None)]).values()),
+            'targets': {
+                'main.cpp.o': {'files': [source1, path.join(self._dir, 'include', 'b.h'), path.join(self._dir, 'include', 'a.h')], 'hash': 'hash1'},
+                'data_only.cpp.o': {'files': [], 'hash': 'hash2'}
+            },
+            'items': {
+                'other.cpp.o': self._create_items(source2, [('Other', 'SPGM', 5, 9, None, None)]),
+                'main.cpp.o': self._create_items(source1, [('Defined', 'DEFINE', 3, 1, 'value', None), ('Auto', 'AUTO_INIT', 7, 5, None, {'lang': 'en'})])
+            }
+        }
+
+    def test_round_trip(self):
+        database = self._create_database()
+        expected = DatabaseStorage.get_rows(database)
+        for engine in DatabaseEngineType:
+            with self.subTest(engine=engine.value):
+                dir = path.join(self._dir, engine.value)
+                storage = DatabaseStorage.create(engine, dir)
+                storage.write_all(database)
+                data = storage.read()
+                self.assertEqual(DatabaseStorage.get_rows(data), expected)
+                # and back to pickle
+                storage = DatabaseStorage.create(DatabaseEngineType.PICKLE, path.join(dir, 'pickle'))
+                storage.write_all(data)
+                self.assertEqual(DatabaseStorage.get_rows(storage.read()), expected)
+
+if __name__ == '__main__':
+    unittest.main()